@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+from datetime import date, timedelta
+
+# Compares the in-memory workbook helpers with the streaming report writer on a large report
+# Each variant runs in its own process so peak memory isn't shared between them
+#
+#   python benchmarks/workbook_benchmark.py --rows 100000
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COLUMN_NAMES = ['Branch ID', 'Name', 'City', 'State', 'Opened', 'Deposits', 'Share']
+FORMATS = [None, None, None, None, 'yyyy-mm-dd', '#,##0.00', '0.00%']
+
+def load_functions():
+    # functions and libs share a namespace once they are compiled into a task
+    namespace = {}
+    for path in [os.path.join(ROOT_DIR, 'libs', 'workbook_lib.py'), os.path.join(ROOT_DIR, 'functions', 'workbook_fns.py')]:
+        with open(path) as f:
+            exec(compile(f.read(), path, 'exec'), namespace)
+    return namespace
+
+def generate_rows(row_count):
+    rng = random.Random(42)
+    cities = ['Springfield', 'Riverside', 'Franklin', 'Greenville', 'Bristol', 'Clinton']
+    states = ['Illinois', 'California', 'Tennessee', 'South Carolina', 'Virginia', 'Iowa']
+    for index in range(row_count):
+        yield [
+            index,
+            f'Branch {index}',
+            rng.choice(cities),
+            rng.choice(states),
+            date(1990, 1, 1) + timedelta(days=rng.randrange(12000)),
+            rng.uniform(1000, 10000000),
+            rng.random()
+        ]
+
+def run_in_memory(fns, path, row_count):
+    workbook = fns['create_workbook']()
+    worksheet = fns['add_worksheet'](workbook, 'Branches')
+    fns['add_table_header'](worksheet, 1, 1, COLUMN_NAMES)
+    fns['add_table_rows'](worksheet, 2, 1, list(generate_rows(row_count)), FORMATS)
+    fns['auto_size_column_width'](worksheet)
+    workbook.save(path)
+
+def run_streaming(fns, path, row_count, batch_size=1000):
+    os.environ['DATA_FILES'] = os.path.dirname(path)
+    report_writer = fns['create_report_writer'](os.path.basename(path), 'Branches', COLUMN_NAMES, FORMATS)
+    batch = []
+    for row in generate_rows(row_count):
+        batch.append(row)
+        if len(batch) == batch_size:
+            fns['append_report_rows'](report_writer, batch)
+            batch = []
+    fns['append_report_rows'](report_writer, batch)
+    fns['close_report_writer'](report_writer)
+
+VARIANTS = {
+    'in_memory': run_in_memory,
+    'streaming': run_streaming
+}
+
+def run_variant(variant, row_count):
+    fns = load_functions()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, f'{variant}.xlsx')
+        start = time.perf_counter()
+        VARIANTS[variant](fns, path, row_count)
+        duration = time.perf_counter() - start
+        file_size = os.path.getsize(path)
+
+    # ru_maxrss is reported in kilobytes on linux and in bytes on macos
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+
+    print(json.dumps({
+        'variant': variant,
+        'rows': row_count,
+        'duration_s': duration,
+        'rows_per_s': row_count / duration,
+        'peak_rss_mb': peak_rss_mb,
+        'file_size_mb': file_size / (1024 * 1024)
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark workbook generation')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--variant', choices=list(VARIANTS), help='Run a single variant in this process')
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args.variant, args.rows)
+        return
+
+    results = []
+    for variant in VARIANTS:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--rows', str(args.rows), '--variant', variant],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{'variant':<12}{'rows':>10}{'seconds':>10}{'rows/s':>12}{'peak MB':>10}{'file MB':>10}")
+    for result in results:
+        print(
+            f"{result['variant']:<12}{result['rows']:>10}{result['duration_s']:>10.2f}"
+            f"{result['rows_per_s']:>12.0f}{result['peak_rss_mb']:>10.1f}{result['file_size_mb']:>10.2f}"
+        )
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,7 @@ import requests
 
 def get_bank_branches(bank_id):
     url = f'https://banks.data.fdic.gov/api/locations?filters=CERT%3A{bank_id}&fields=NAME%2CUNINUM%2CSERVTYPE%2CRUNDATE%2CCITY%2CSTNAME%2CZIP%2CCOUNTY%2CADDRESS%2CMAINOFF&sort_by=NAME&sort_order=DESC&limit=10000&offset=0&format=json&download=false'
-    response = requests.get(url)
+    response = http_get(url)
     response_data = response.json()
     return [
         {
@@ -17,7 +17,7 @@ def get_bank_branches(bank_id):
 
 def get_bank_financials(bank_id):
     url = f'https://banks.data.fdic.gov/api/financials?filters=CERT%3A{bank_id}&fields=CERT%2CREPDTE%2CASSET%2CDEP&sort_by=REPDTE&sort_order=DESC&limit=10&offset=0&agg_by=REPDTE&agg_sum_fields=DEP&agg_limit=1000&format=json&download=false&filename=data_file'
-    response = requests.get(url)
+    response = http_get(url)
     response_data = response.json()
     # with faqtiv serve or standalone export, this will be handled as an agent event
     if 'streamWriter' in globals() and streamWriter:
@@ -34,6 +34,6 @@ def get_bank_financials(bank_id):
 
 def get_bank_id_by_name(name):
     url = f'https://banks.data.fdic.gov/api/institutions?filters=ACTIVE%3A1&search=NAME:{requests.utils.quote(name)}&fields=NAME'
-    response = requests.get(url)
+    response = http_get(url)
     response_data = response.json()
     return response_data['data'][0]['data']['ID']
\ No newline at end of file
@@ -1,4 +1,6 @@
+import os
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
 
 def create_workbook():
     return openpyxl.Workbook()
@@ -33,4 +35,80 @@ def add_table_header(worksheet, row, col, column_names):
             left=openpyxl.styles.Side(style='thin'),
             bottom=openpyxl.styles.Side(style='thin'), 
             right=openpyxl.styles.Side(style='thin')
-        )
\ No newline at end of file
+        )
+
+def create_report_writer(file_name, sheet_name, column_names, formats=None):
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet(title=sheet_name)
+
+    # named styles are stored once in the workbook and shared by every cell that uses them
+    header_style = openpyxl.styles.NamedStyle(name='report_header')
+    header_style.font = openpyxl.styles.Font(bold=True)
+    header_style.alignment = openpyxl.styles.Alignment(vertical='center', horizontal='center')
+    thin = openpyxl.styles.Side(style='thin')
+    header_style.border = openpyxl.styles.Border(top=thin, left=thin, bottom=thin, right=thin)
+    workbook.add_named_style(header_style)
+
+    column_styles = []
+    for number_format in (formats or [None] * len(column_names)):
+        style_name = f'report_format_{number_format}' if number_format else None
+        if style_name and style_name not in workbook.named_styles:
+            workbook.add_named_style(openpyxl.styles.NamedStyle(name=style_name, number_format=number_format))
+        column_styles.append(style_name)
+
+    header = []
+    for column_name in column_names:
+        cell = WriteOnlyCell(worksheet, value=column_name)
+        cell.style = 'report_header'
+        header.append(cell)
+
+    return {
+        'workbook': workbook,
+        'worksheet': worksheet,
+        'path': os.path.join(os.getenv('DATA_FILES', os.getcwd()), file_name),
+        'column_styles': column_styles,
+        'column_widths': [len(str(column_name)) for column_name in column_names],
+        # column widths must be set before the first row is written, they are measured on the first rows
+        'pending_rows': [header],
+        'width_sample_rows': 1000,
+        'row_count': 0
+    }
+
+def append_report_rows(report_writer, rows):
+    worksheet = report_writer['worksheet']
+    column_styles = report_writer['column_styles']
+    column_widths = report_writer['column_widths']
+    has_styles = any(column_styles)
+
+    for row_data in rows:
+        if has_styles:
+            row = []
+            for index, value in enumerate(row_data):
+                style_name = column_styles[index] if index < len(column_styles) else None
+                if style_name and value is not None:
+                    cell = WriteOnlyCell(worksheet, value=value)
+                    cell.style = style_name
+                    row.append(cell)
+                else:
+                    row.append(value)
+        else:
+            row = list(row_data)
+
+        report_writer['row_count'] += 1
+        if report_writer['pending_rows'] is None:
+            worksheet.append(row)
+            continue
+
+        for index, value in enumerate(row_data):
+            if value is not None and index < len(column_widths):
+                column_widths[index] = max(column_widths[index], len(str(value)))
+        report_writer['pending_rows'].append(row)
+        if report_writer['row_count'] >= report_writer['width_sample_rows']:
+            flush_report_widths(report_writer)
+
+def close_report_writer(report_writer):
+    if report_writer['pending_rows'] is not None:
+        flush_report_widths(report_writer)
+    report_writer['workbook'].save(report_writer['path'])
+    report_writer['workbook'].close()
+    return report_writer['path']
@@ -0,0 +1,7 @@
+import requests
+
+# httpClient is injected by standalone exports with keep-alive connection pools, timeouts and retries
+def http_get(url, **kwargs):
+    client = httpClient if 'httpClient' in globals() and httpClient else requests
+    kwargs.setdefault('timeout', 30)
+    return client.get(url, **kwargs)
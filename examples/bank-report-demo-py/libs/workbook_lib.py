@@ -0,0 +1,11 @@
+import openpyxl
+
+# write-only worksheets write the column widths before the first row, so rows are held until the widths are known
+def flush_report_widths(report_writer):
+    worksheet = report_writer['worksheet']
+    for index, width in enumerate(report_writer['column_widths']):
+        column_letter = openpyxl.utils.get_column_letter(index + 1)
+        worksheet.column_dimensions[column_letter].width = max(width, 10)
+    for row in report_writer['pending_rows']:
+        worksheet.append(row)
+    report_writer['pending_rows'] = None
@@ -0,0 +1,105 @@
+# Compares the prompt size and latency of ad-hoc retries in "full" and "repair" retry modes, fully offline.
+#
+# Run it from the exported agent directory:
+#   python benchmarks/adhoc_retry.py --failures 3 --prefill-ms-per-1k 40
+#
+# The fake model fails the first attempts with code that raises a long error and then returns working code,
+# its latency grows with the prompt size to approximate the prefill time of a real model.
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+os.environ.setdefault('OPENAI_MODEL', 'gpt-4o')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from langchain_core.outputs import LLMResult, ChatGeneration
+from langchain_core.messages import AIMessage, AIMessageChunk
+from components import tools
+from components import examples
+
+FAILING_CODE = '''def doTask():
+    rows = [{"id": i, "name": f"row {i}"} for i in range(300)]
+    total = int(json.dumps(rows))
+    print(json.dumps({"total": total}))'''
+
+WORKING_CODE = '''def doTask():
+    rows = [{"id": i, "name": f"row {i}"} for i in range(300)]
+    print(json.dumps({"total": len(rows)}))'''
+
+def count_tokens(text):
+    try:
+        return tools.get_tokens(tools.model, text)
+    except Exception:
+        # the tokenizer files can't be downloaded, approximate
+        return len(text) // 4
+
+class FakeAdhocModel:
+    def __init__(self, failures, base_ms, prefill_ms_per_1k):
+        self.failures = failures
+        self.base_ms = base_ms
+        self.prefill_ms_per_1k = prefill_ms_per_1k
+        self.calls = []
+
+    async def respond(self, messages):
+        prompt_tokens = sum(count_tokens(message.content) for message in messages)
+        latency_ms = self.base_ms + prompt_tokens / 1000 * self.prefill_ms_per_1k
+        await asyncio.sleep(latency_ms / 1000)
+        self.calls.append({'prompt_tokens': prompt_tokens, 'latency_ms': latency_ms})
+
+        code = FAILING_CODE if len(self.calls) <= self.failures else WORKING_CODE
+        return f"```python\n{code}\n```"
+
+    async def agenerate(self, batches, **kwargs):
+        content = await self.respond(batches[0])
+        return LLMResult(generations=[[ChatGeneration(message=AIMessage(content=content))]])
+
+    async def astream(self, messages, **kwargs):
+        yield AIMessageChunk(content=await self.respond(messages))
+
+def get_benchmark_examples(query, k=10):
+    return [
+        {"task": example['document']['task'], "code": example['document']['code']}
+        for example in examples.load_examples()[:k]
+    ]
+
+async def run_mode(mode, args):
+    fake_model = FakeAdhocModel(args.failures, args.base_ms, args.prefill_ms_per_1k)
+    tools.get_adhoc_llm = lambda model_name=None: fake_model
+    tools.ADHOC_RETRY_MODE = mode
+
+    start = time.perf_counter()
+    await tools.generate_and_execute_adhoc("Count the rows", max_retries=args.failures + 1)
+    total_ms = (time.perf_counter() - start) * 1000
+
+    return fake_model.calls, total_ms
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ad-hoc retry prompts")
+    parser.add_argument("--failures", type=int, default=3, help="Failed attempts before the code works")
+    parser.add_argument("--base-ms", type=float, default=300, help="Fixed latency of each model call")
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=40, help="Latency added per 1000 prompt tokens")
+    args = parser.parse_args()
+
+    async def get_benchmark_examples_async(query, k=10):
+        return get_benchmark_examples(query, k)
+
+    tools.get_relevant_examples_async = get_benchmark_examples_async
+    tools.get_tokens = lambda model, text: count_tokens(text)
+
+    results = {mode: asyncio.run(run_mode(mode, args)) for mode in ('full', 'repair')}
+
+    print(f"\n{'mode':<8}{'attempt':>8}{'prompt tokens':>15}{'latency ms':>12}")
+    for mode, (calls, _) in results.items():
+        for attempt, call in enumerate(calls, 1):
+            print(f"{mode:<8}{attempt:>8}{call['prompt_tokens']:>15}{call['latency_ms']:>12.0f}")
+
+    print(f"\n{'mode':<8}{'retry tokens':>14}{'retry latency ms':>18}{'total ms':>10}")
+    for mode, (calls, total_ms) in results.items():
+        retries = calls[1:]
+        print(f"{mode:<8}{sum(c['prompt_tokens'] for c in retries):>14}{sum(c['latency_ms'] for c in retries):>18.0f}{total_ms:>10.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Compares the ad-hoc code generation time with and without streaming, fully offline.
+#
+# Run it from the exported agent directory:
+#   python benchmarks/adhoc_streaming.py --first-token-ms 400 --tokens-per-s 60
+#
+# The fake model sends its response token by token, with code followed by an explanation, a refusal with
+# a long explanation or code that fails the static validation, like real models often do.
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import install_offline_tokenizer
+from langchain_core.outputs import LLMResult, ChatGeneration
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from components import tools
+
+EXPLANATION = (
+    "\n\nThis function declares the values from the task as constants, calls the available functions to get "
+    "the data, filters the rows that match the request and prints the result as JSON so it can be used by "
+    "the agent. Let me know if you want the output in a different format. "
+) * 3
+
+RESPONSES = {
+    'code_and_explanation': (
+        '```python\ndef doTask():\n    rows = [{"id": i} for i in range(10)]\n'
+        '    print(json.dumps({"total": len(rows)}))\n```' + EXPLANATION
+    ),
+    'refusal': f"{tools.REFUSAL_MESSAGE}, none of them returns the weather forecast." + EXPLANATION,
+    'invalid_code': (
+        '```python\ndef doTask():\n    rows = get_weather_forecast("Paris")\n'
+        '    print(json.dumps(rows))\n```' + EXPLANATION
+    ),
+}
+
+class FakeStreamingModel:
+    def __init__(self, response, first_token_ms, tokens_per_s):
+        self.response = response
+        self.first_token_ms = first_token_ms
+        self.tokens_per_s = tokens_per_s
+
+    def get_tokens(self):
+        # ~4 characters per token
+        return [self.response[i:i + 4] for i in range(0, len(self.response), 4)]
+
+    async def agenerate(self, batches, **kwargs):
+        tokens = self.get_tokens()
+        await asyncio.sleep(self.first_token_ms / 1000 + len(tokens) / self.tokens_per_s)
+        return LLMResult(generations=[[ChatGeneration(message=AIMessage(content=self.response))]])
+
+    async def astream(self, messages, **kwargs):
+        await asyncio.sleep(self.first_token_ms / 1000)
+        for token in self.get_tokens():
+            await asyncio.sleep(1 / self.tokens_per_s)
+            yield AIMessageChunk(content=token)
+
+async def generate(streaming, response, args):
+    fake_model = FakeStreamingModel(response, args.first_token_ms, args.tokens_per_s)
+    tools.get_adhoc_llm = lambda model_name=None: fake_model
+    tools.ADHOC_STREAMING = streaming
+
+    start = time.perf_counter()
+    try:
+        await tools.generate_adhoc_code([HumanMessage(content="Count the rows")])
+        outcome = 'code'
+    except Exception as e:
+        outcome = type(e).__name__
+    return (time.perf_counter() - start) * 1000, outcome
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark streamed ad-hoc code generation")
+    parser.add_argument("--first-token-ms", type=float, default=400, help="Latency until the first token")
+    parser.add_argument("--tokens-per-s", type=float, default=60, help="Tokens generated per second")
+    args = parser.parse_args()
+
+    install_offline_tokenizer()
+
+    # the buffered response can fail to parse because of the text after the code block, the streamed one stops before it
+    print(f"{'response':<24}{'buffered':>22}{'ms':>8}{'streamed':>22}{'ms':>8}")
+    for name, response in RESPONSES.items():
+        buffered_ms, buffered_outcome = asyncio.run(generate(False, response, args))
+        streamed_ms, streamed_outcome = asyncio.run(generate(True, response, args))
+        print(f"{name:<24}{buffered_outcome:>22}{buffered_ms:>8.0f}{streamed_outcome:>22}{streamed_ms:>8.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# Recall, query latency, build time and memory of the example index backends as the number of examples grows,
+# fully offline with synthetic embeddings.
+#
+# Run it from the exported agent directory:
+#   python benchmarks/example_index.py --sizes 1000,10000,50000
+#   python benchmarks/example_index.py --configs flat/none,hnsw/sq8 --k 30
+#
+# The embeddings are grouped around topics like the tasks of an agent, and the queries are examples with some noise.
+# Recall@k is the share of the exact k nearest examples that the index returns. Memory is the size of the index,
+# the documents are kept apart and take the same memory with every backend.
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from components.vector_index import VectorIndex, normalize
+
+DIMENSION = 1536
+EXAMPLES_PER_TOPIC = 50
+
+def make_vectors(count, rng):
+    topics = rng.standard_normal((max(1, count // EXAMPLES_PER_TOPIC), DIMENSION), dtype=np.float32)
+    vectors = topics[rng.integers(len(topics), size=count)] + 0.8 * rng.standard_normal((count, DIMENSION), dtype=np.float32)
+    return normalize(vectors)
+
+def make_queries(vectors, count, rng):
+    queries = vectors[rng.integers(len(vectors), size=count)] + 0.5 * rng.standard_normal((count, DIMENSION), dtype=np.float32) / np.sqrt(DIMENSION)
+    return normalize(queries)
+
+def measure(config, ids, vectors, queries, nearest, args):
+    index_type, quantization = config.split('/')
+    index = VectorIndex(DIMENSION, index_type, quantization, args.probes, args.ef_search)
+    start = time.perf_counter()
+    index.build(ids, vectors)
+    build_s = time.perf_counter() - start
+
+    latencies = []
+    found = 0
+    for query, expected in zip(queries, nearest):
+        start = time.perf_counter()
+        results = index.search(query, args.k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found += len({ids[position] for position in expected} & {vector_id for vector_id, _ in results})
+    latencies.sort()
+    return {
+        'factory': index.factory_string,
+        'build_s': build_s,
+        'memory_mb': index.get_memory_size() / 1e6,
+        'recall': found / (len(queries) * args.k),
+        'p50_ms': latencies[len(latencies) // 2],
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the example index backends")
+    parser.add_argument("--sizes", default="1000,10000", help="Comma separated numbers of examples")
+    parser.add_argument("--configs", default="flat/none,flat/sq8,ivf/none,ivf/pq,hnsw/none,hnsw/sq8", help="Comma separated index/quantization pairs")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10, help="Neighbors searched, the selection searches 3 candidates per example")
+    parser.add_argument("--probes", type=int, default=16, help="EXAMPLES_IVF_PROBES")
+    parser.add_argument("--ef-search", type=int, default=64, help="EXAMPLES_HNSW_EF_SEARCH")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'examples':>9}  {'config':<11}{'index':<15}{'build s':>9}{'memory MB':>11}{'recall@' + str(args.k):>11}{'p50 ms':>9}{'p99 ms':>9}")
+    for size in [int(size) for size in args.sizes.split(',')]:
+        vectors = make_vectors(size, rng)
+        queries = make_queries(vectors, args.queries, rng)
+        ids = [f'example:{i}' for i in range(size)]
+        # exact neighbors to compare with
+        nearest = np.argsort(-(queries @ vectors.T), axis=1)[:, :args.k]
+
+        for config in args.configs.split(','):
+            result = measure(config, ids, vectors, queries, nearest, args)
+            print(
+                f"{size:>9}  {config:<11}{result['factory']:<15}{result['build_s']:>9.2f}{result['memory_mb']:>11.1f}"
+                f"{result['recall']:>11.3f}{result['p50_ms']:>9.3f}{result['p99_ms']:>9.3f}",
+                flush=True
+            )
+
+if __name__ == "__main__":
+    main()
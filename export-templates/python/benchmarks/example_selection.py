@@ -0,0 +1,111 @@
+# Compares the examples selected for ad-hoc code generation by vector search and by hybrid selection, on a fixed
+# evaluation set: every example of the agent is used as a task while it's left out of the index.
+#
+# Run it from the exported agent directory:
+#   python benchmarks/example_selection.py
+#   python benchmarks/example_selection.py --codegen --limit 20
+#
+# Offline it reports the example tokens of the prompt and how many of the agent functions called by the left out code
+# are shown by at least one selected example. With --codegen it also generates the code of every task with the
+# configured model and counts the responses that parse and pass the static checks, this needs OPENAI_API_KEY.
+import os
+import re
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeEmbeddings, install_offline_tokenizer
+from components import examples, tools
+from components.http_client import run_in_new_loop
+from components.code_validator import AGENT_CALLABLES
+
+MODES = ['vector', 'hybrid']
+
+def load_eval_set():
+    return [
+        (examples.get_file_example_id(filename), example['document'], examples.decode_base64_embedding(example['taskEmbedding']))
+        for filename in sorted(examples.list_example_files())
+        for example in [examples.read_example_file(filename)]
+    ]
+
+def get_called_functions(code):
+    return {name for name in re.findall(r'\b([A-Za-z_]\w*)\s*\(', code) if name in AGENT_CALLABLES}
+
+def select(mode, document, embedding, k):
+    examples.EXAMPLES_SELECTION = mode
+    start = time.perf_counter()
+    selected = examples.search_examples(embedding, k, document['task'])
+    return selected, (time.perf_counter() - start) * 1000
+
+async def generate(document, selected):
+    messages = tools.build_adhoc_messages(document['task'], selected)
+    try:
+        await tools.generate_adhoc_code(messages)
+        return True
+    except Exception:
+        return False
+
+async def evaluate(mode, eval_set, args):
+    results = {'tokens': [], 'count': [], 'coverage': [], 'ms': [], 'valid': 0}
+    for example_id, document, embedding in eval_set:
+        # the task can't be its own example
+        examples.remove_example(example_id)
+        try:
+            selected, elapsed_ms = select(mode, document, embedding, args.k)
+        finally:
+            examples.add_example(example_id, document, embedding, 'file')
+
+        results['ms'].append(elapsed_ms)
+        results['count'].append(len(selected))
+        results['tokens'].append(sum(
+            tools.get_tokens(tools.model, example['task']) + tools.get_tokens(tools.model, example['code']) for example in selected
+        ))
+        needed = get_called_functions(document['code'])
+        if needed:
+            shown = set().union(*(get_called_functions(example['code']) for example in selected))
+            results['coverage'].append(len(needed & shown) / len(needed))
+        if args.codegen:
+            results['valid'] += await generate(document, selected)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the selection of examples for ad-hoc code generation")
+    parser.add_argument("--k", type=int, default=10, help="Examples selected at most")
+    parser.add_argument("--limit", type=int, default=0, help="Tasks of the evaluation set used, 0 for all")
+    parser.add_argument("--codegen", action="store_true", help="Generate the code of every task with the configured model")
+    args = parser.parse_args()
+
+    if install_offline_tokenizer():
+        print("tiktoken files are not available, token counts are approximated", file=sys.stderr)
+    # the stored embeddings are used as queries, no embedding request is made
+    examples.embeddings = FakeEmbeddings()
+    # the index is only changed by this benchmark
+    examples.EXAMPLES_WATCH_INTERVAL = 0
+
+    eval_set = load_eval_set()
+    if args.limit:
+        eval_set = eval_set[:args.limit]
+    if len(eval_set) < 2:
+        print("The agent needs at least two examples")
+        return
+
+    header = f"{'selection':<12}{'tokens p50':>12}{'tokens avg':>12}{'examples':>10}{'coverage':>10}{'ms p50':>8}"
+    print(header + (f"{'valid code':>12}" if args.codegen else ''))
+    for mode in MODES:
+        # --codegen opens the OpenAI connection pool on the loop of every mode
+        results = run_in_new_loop(evaluate(mode, eval_set, args))
+        coverage = f"{statistics.mean(results['coverage']) * 100:.0f}%" if results['coverage'] else 'n/a'
+        line = (
+            f"{mode:<12}{statistics.median(results['tokens']):>12.0f}{statistics.mean(results['tokens']):>12.0f}"
+            f"{statistics.mean(results['count']):>10.1f}{coverage:>10}{statistics.median(results['ms']):>8.2f}"
+        )
+        if args.codegen:
+            line += f"{results['valid']:>7}/{len(eval_set)}"
+        print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Deterministic stand-ins for the OpenAI chat model, embeddings and tokenizer, so benchmarks run offline
+# and only measure the agent runtime itself.
+import os
+import json
+import hashlib
+from typing import Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+os.environ.setdefault('OPENAI_MODEL', 'gpt-4o')
+
+class FakeEmbeddings(Embeddings):
+    """Embeddings seeded by a hash of the text, the same text always gets the same vector."""
+    def __init__(self, size=1536):
+        self.size = size
+
+    def embed_query(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], 'little')
+        vector = np.random.default_rng(seed).random(self.size, dtype=np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+class FakeChatModel(BaseChatModel):
+    """Calls tool_name once per turn and then answers with answer_tokens tokens, streamed one by one."""
+    tool_name: Optional[str] = None
+    tool_args: dict = {}
+    answer_tokens: int = 50
+    calls: int = 0
+
+    @property
+    def _llm_type(self):
+        return 'fake-chat-model'
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _next_message(self, messages):
+        self.calls += 1
+        if self.tool_name and not isinstance(messages[-1], ToolMessage):
+            return AIMessage(content='', additional_kwargs={'tool_calls': [{
+                'id': f'call_{self.calls}',
+                'type': 'function',
+                'function': {'name': self.tool_name, 'arguments': json.dumps(self.tool_args)}
+            }]})
+        return AIMessage(content=' '.join(f'token{i}' for i in range(self.answer_tokens)))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=self._next_message(messages))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._next_message(messages)
+        if message.additional_kwargs:
+            yield ChatGenerationChunk(message=AIMessageChunk(content='', additional_kwargs=message.additional_kwargs))
+            return
+        for index, token in enumerate(message.content.split(' ')):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token if index == 0 else f' {token}'))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+def count_tokens(text):
+    return len(text) // 4
+
+def install_offline_tokenizer():
+    # the tiktoken files are downloaded on first use, fall back to an approximation when there is no network
+    from components import context_manager, tools, completions, examples
+    try:
+        context_manager.get_tokens(tools.model, 'benchmark')
+        return False
+    except Exception:
+        context_manager.get_tokens = lambda model, text: count_tokens(text)
+        tools.get_tokens = context_manager.get_tokens
+        completions.get_tokens = context_manager.get_tokens
+        examples.get_tokens = context_manager.get_tokens
+        return True
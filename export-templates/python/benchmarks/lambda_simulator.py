@@ -0,0 +1,278 @@
+# Simulates AWS Lambda invocations locally to measure cold and warm latency of src/lambda_handler.py.
+#
+# Run it from the exported agent directory:
+#   python benchmarks/lambda_simulator.py --cold-runs 3 --warm-runs 20
+#   python benchmarks/lambda_simulator.py --mode buffered --path /run_task/my-task --body '{"args": {}}'
+#
+# It serves the Lambda runtime API, starts the handler the way Lambda does and hands it function URL events.
+# "streaming" runs the runtime loop of lambda_handler.py, "buffered" calls handler() like the managed runtime.
+# Chat and embeddings requests go to the local OpenAI stub.
+import os
+import sys
+import time
+import json
+import uuid
+import queue
+import argparse
+import threading
+import statistics
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+AGENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC_DIR = os.path.join(AGENT_DIR, 'src')
+PRELUDE_DELIMITER = b'\x00' * 8
+
+# Runtime loop of the managed python runtime, simplified
+BUFFERED_RUNTIME = '''
+import os, json, urllib.request
+import lambda_handler
+url = "http://" + os.environ["AWS_LAMBDA_RUNTIME_API"] + "/2018-06-01/runtime/invocation/"
+while True:
+    with urllib.request.urlopen(url + "next") as invocation:
+        request_id = invocation.headers["Lambda-Runtime-Aws-Request-Id"]
+        event = json.loads(invocation.read())
+    response = json.dumps(lambda_handler.handler(event, None)).encode()
+    urllib.request.urlopen(urllib.request.Request(url + request_id + "/response", data=response, method="POST")).read()
+'''
+
+class RuntimeApi:
+    """Serves the Lambda runtime API, events are handed to the function one at a time."""
+    def __init__(self, port):
+        self.events = queue.Queue()
+        self.invocations = {}
+        self.results = queue.Queue()
+        self.first_poll = threading.Event()
+        self.first_poll_at = None
+        self.waiting_polls = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.create_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def invoke(self, event):
+        self.events.put(event)
+        return self.results.get()
+
+    def release_polls(self):
+        # polls of a stopped function would take the events of the next one
+        for _ in range(self.waiting_polls):
+            self.events.put(None)
+
+    def create_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (ConnectionResetError, BrokenPipeError):
+                    pass
+
+            def read_body(self, on_chunk):
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    while True:
+                        size = int(self.rfile.readline().split(b';')[0], 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            break
+                        on_chunk(self.rfile.read(size))
+                        self.rfile.readline()
+                else:
+                    on_chunk(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+            def respond(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if not self.path.endswith('/invocation/next'):
+                    return self.respond(404)
+                if not api.first_poll.is_set():
+                    api.first_poll_at = time.perf_counter()
+                    api.first_poll.set()
+
+                api.waiting_polls += 1
+                event = api.events.get()
+                api.waiting_polls -= 1
+                if event is None:
+                    self.close_connection = True
+                    return
+
+                request_id = str(uuid.uuid4())
+                api.invocations[request_id] = {'start': time.perf_counter(), 'first_byte': None}
+                self.respond(200, json.dumps(event).encode(), {
+                    'Lambda-Runtime-Aws-Request-Id': request_id,
+                    'Lambda-Runtime-Deadline-Ms': str(int(time.time() * 1000) + 900000),
+                    'Lambda-Runtime-Invoked-Function-Arn': 'arn:aws:lambda:local:000000000000:function:simulator',
+                    'Content-Type': 'application/json'
+                })
+
+            def do_POST(self):
+                parts = self.path.strip('/').split('/')
+                if 'init' in parts:
+                    self.read_body(lambda chunk: None)
+                    self.respond(202)
+                    api.results.put({'error': 'init error'})
+                    return
+
+                request_id, kind = parts[-2], parts[-1]
+                invocation = api.invocations.pop(request_id)
+                body = bytearray()
+                streaming = self.headers.get('Lambda-Runtime-Function-Response-Mode') == 'streaming'
+
+                def on_chunk(chunk):
+                    body.extend(chunk)
+                    # with streaming the first byte is the first one after the prelude
+                    if invocation['first_byte'] is None and (not streaming or 0 <= body.find(PRELUDE_DELIMITER) < len(body) - len(PRELUDE_DELIMITER)):
+                        invocation['first_byte'] = time.perf_counter()
+
+                self.read_body(on_chunk)
+                end = time.perf_counter()
+                self.respond(202)
+
+                if streaming and PRELUDE_DELIMITER in body:
+                    prelude, _, payload = bytes(body).partition(PRELUDE_DELIMITER)
+                    status = json.loads(prelude).get('statusCode')
+                elif kind == 'response':
+                    response = json.loads(body)
+                    status, payload = response.get('statusCode'), response.get('body', '').encode()
+                else:
+                    status, payload = None, bytes(body)
+
+                api.results.put({
+                    'error': payload.decode(errors='replace') if kind == 'error' else None,
+                    'status': status,
+                    'start': invocation['start'],
+                    'first_byte': invocation['first_byte'] or end,
+                    'end': end,
+                    'size': len(payload)
+                })
+
+        return Handler
+
+def create_event(args):
+    if args.event_file:
+        with open(args.event_file) as f:
+            return json.load(f)
+    return {
+        'version': '2.0',
+        'rawPath': args.path,
+        'rawQueryString': '',
+        'headers': {'content-type': 'application/json'},
+        'requestContext': {'http': {'method': 'POST', 'path': args.path, 'sourceIp': '127.0.0.1'}},
+        'body': args.body,
+        'isBase64Encoded': False
+    }
+
+def start_function(args):
+    stub_url = f'http://127.0.0.1:{args.stub_port}/v1'
+    env = {
+        **os.environ,
+        'AWS_LAMBDA_RUNTIME_API': f'127.0.0.1:{args.runtime_port}',
+        'AWS_LAMBDA_FUNCTION_NAME': 'simulator',
+        'LAMBDA_TASK_ROOT': SRC_DIR,
+        'OPENAI_BASE_URL': stub_url,
+        'OPENAI_API_BASE': stub_url,
+        'OPENAI_API_KEY': os.environ.get('OPENAI_API_KEY', 'simulator'),
+        'OPENAI_MODEL': os.environ.get('OPENAI_MODEL', 'gpt-4o'),
+        'PYTHONPATH': os.pathsep.join(filter(None, [SRC_DIR, os.environ.get('PYTHONPATH')]))
+    }
+    command = ['lambda_handler.py'] if args.mode == 'streaming' else ['-c', BUFFERED_RUNTIME]
+    return subprocess.Popen(
+        [sys.executable, *command], cwd=SRC_DIR, env=env,
+        stdout=None if args.function_logs else subprocess.DEVNULL,
+        stderr=None if args.function_logs else subprocess.DEVNULL
+    )
+
+def run_environment(api, args, event, warm_runs):
+    # one execution environment: a cold invocation followed by warm ones
+    api.first_poll.clear()
+    start = time.perf_counter()
+    function = start_function(args)
+    try:
+        if not api.first_poll.wait(timeout=120):
+            raise TimeoutError("The function didn't poll for events")
+        init = api.first_poll_at - start
+
+        cold = api.invoke(event)
+        warm = [api.invoke(event) for _ in range(warm_runs)]
+    finally:
+        function.terminate()
+        function.wait()
+        api.release_polls()
+    return init, cold, warm
+
+def print_row(name, values):
+    values = [value * 1000 for value in values]
+    print(f"{name:<24}{len(values):>6}{statistics.median(values):>10.0f}{max(values):>10.0f}"
+          f"{sorted(values)[min(len(values) - 1, int(0.99 * len(values)))]:>10.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Lambda invocation simulator")
+    parser.add_argument("--mode", choices=['streaming', 'buffered'], default='streaming')
+    parser.add_argument("--cold-runs", type=int, default=3, help="Execution environments started")
+    parser.add_argument("--warm-runs", type=int, default=10, help="Warm invocations in each environment")
+    parser.add_argument("--path", default='/completions', help="Path of the function URL event")
+    parser.add_argument("--body", default=json.dumps({'messages': [{'role': 'user', 'content': 'Hello'}], 'stream': True}))
+    parser.add_argument("--event-file", help="Use the event in this JSON file instead")
+    parser.add_argument("--runtime-port", type=int, default=9400)
+    parser.add_argument("--stub-port", type=int, default=9401)
+    parser.add_argument("--first-token-ms", type=float, default=300, help="Stub latency before the first token")
+    parser.add_argument("--tokens-per-s", type=float, default=50, help="Stub token rate")
+    parser.add_argument("--tokens", type=int, default=50, help="Stub tokens per answer")
+    parser.add_argument("--function-logs", action='store_true', help="Show the output of the function")
+    args = parser.parse_args()
+
+    stub = subprocess.Popen([
+        sys.executable, os.path.join(AGENT_DIR, 'benchmarks', 'openai_stub.py'),
+        '--port', str(args.stub_port),
+        '--first-token-ms', str(args.first_token_ms),
+        '--tokens-per-s', str(args.tokens_per_s),
+        '--tokens', str(args.tokens)
+    ])
+    api = RuntimeApi(args.runtime_port)
+    api.start()
+
+    event = create_event(args)
+    inits, colds, warms = [], [], []
+    try:
+        for _ in range(args.cold_runs):
+            init, cold, warm = run_environment(api, args, event, args.warm_runs)
+            inits.append(init)
+            colds.append(cold)
+            warms.extend(warm)
+    finally:
+        api.stop()
+        stub.terminate()
+        stub.wait()
+
+    errors = [result for result in colds + warms if result['error'] or (result['status'] or 500) >= 400]
+    print(f"\n{args.mode} invocations of {args.path}, {len(errors)} errors")
+    print(f"\n{'':<24}{'count':>6}{'p50 ms':>10}{'max ms':>10}{'p99 ms':>10}")
+    print_row('init', inits)
+    print_row('cold first byte', [result['first_byte'] - result['start'] for result in colds])
+    print_row('cold total', [result['end'] - result['start'] for result in colds])
+    print_row('cold incl. init', [init + result['end'] - result['start'] for init, result in zip(inits, colds)])
+    if warms:
+        print_row('warm first byte', [result['first_byte'] - result['start'] for result in warms])
+        print_row('warm total', [result['end'] - result['start'] for result in warms])
+
+    for error in errors[:5]:
+        print(f"\nstatus {error['status']}: {(error['error'] or '')[:300]}")
+
+if __name__ == "__main__":
+    main()
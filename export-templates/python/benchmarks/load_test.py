@@ -0,0 +1,305 @@
+# Load test of the HTTP server against the local OpenAI stub, reports throughput, time to first token,
+# inter-token latency, errors and the server memory.
+#
+# Run it from the exported agent directory, it starts the stub and the agent server itself:
+#   python benchmarks/load_test.py --mode closed --concurrency 50 --duration 60
+#   python benchmarks/load_test.py --mode open --rate 20 --mix stream=6,completion=2,run_task=1,run_adhoc=1 --task my-task
+#
+# Use --url to load an agent server that is already running, its memory is only reported with --server-pid.
+import os
+import sys
+import time
+import json
+import random
+import asyncio
+import argparse
+import subprocess
+import httpx
+
+AGENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+REQUEST_KINDS = ['stream', 'completion', 'run_task', 'run_adhoc']
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def parse_mix(mix):
+    weights = {}
+    for entry in mix.split(','):
+        kind, _, weight = entry.partition('=')
+        if kind.strip() not in REQUEST_KINDS:
+            raise ValueError(f"Unknown request kind '{kind}', use one of {', '.join(REQUEST_KINDS)}")
+        weights[kind.strip()] = float(weight or 1)
+    return weights
+
+def get_rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        output = subprocess.run(['ps', '-o', 'rss=', '-p', str(pid)], capture_output=True, text=True).stdout.strip()
+        return int(output) / 1024 if output else None
+
+async def wait_until_ready(client, url, process=None, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process and process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"{url} was not ready after {timeout} seconds")
+
+def start_servers(args):
+    stub = subprocess.Popen([
+        sys.executable, os.path.join(AGENT_DIR, 'benchmarks', 'openai_stub.py'),
+        '--port', str(args.stub_port),
+        '--first-token-ms', str(args.first_token_ms),
+        '--tokens-per-s', str(args.tokens_per_s),
+        '--tokens', str(args.tokens)
+    ])
+
+    stub_url = f'http://127.0.0.1:{args.stub_port}/v1'
+    env = {
+        **os.environ,
+        'PORT': str(args.port),
+        'OPENAI_BASE_URL': stub_url,
+        'OPENAI_API_BASE': stub_url,
+        'OPENAI_API_KEY': os.environ.get('OPENAI_API_KEY', 'load-test'),
+        'OPENAI_MODEL': os.environ.get('OPENAI_MODEL', 'gpt-4o')
+    }
+    agent = subprocess.Popen(
+        [sys.executable, os.path.join('src', 'main.py'), '--http'],
+        cwd=AGENT_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=None if args.server_logs else subprocess.DEVNULL
+    )
+    return stub, agent
+
+async def send_streaming_completion(client, args, result):
+    body = {'messages': [{'role': 'user', 'content': args.prompt}], 'stream': True}
+    async with client.stream('POST', '/completions', json=body) as response:
+        if response.status_code != 200:
+            result['error'] = f'HTTP {response.status_code}'
+            return
+
+        last_token_at = None
+        done = False
+        async for line in response.aiter_lines():
+            if line == 'data: [DONE]':
+                done = True
+                continue
+            if not line.startswith('data: '):
+                continue
+            chunk = json.loads(line[6:])
+            if chunk.get('error'):
+                result['error'] = chunk['error'].get('message')
+                return
+            if not chunk['choices'][0]['delta'].get('content'):
+                continue
+
+            now = time.perf_counter()
+            if last_token_at is None:
+                result['ttft'] = now - result['start']
+            else:
+                result['itl'].append(now - last_token_at)
+            last_token_at = now
+            result['tokens'] += 1
+
+        # a stream the server dropped is a failed request, even if it sent some tokens
+        if not done:
+            result['error'] = 'Stream ended without [DONE]'
+        elif result['tokens'] == 0:
+            result['error'] = 'Stream had no tokens'
+
+async def send_request(client, kind, args):
+    result = {'kind': kind, 'start': time.perf_counter(), 'error': None, 'ttft': None, 'itl': [], 'tokens': 0}
+    try:
+        if kind == 'stream':
+            await send_streaming_completion(client, args, result)
+        else:
+            if kind == 'completion':
+                response = await client.post('/completions', json={'messages': [{'role': 'user', 'content': args.prompt}]})
+            elif kind == 'run_task':
+                response = await client.post(f'/run_task/{args.task}', json={'args': args.task_args})
+            else:
+                response = await client.post('/run_adhoc', json={'input': args.prompt})
+
+            content = response.json() if response.headers.get('content-type', '').startswith('application/json') else {}
+            if response.status_code != 200:
+                result['error'] = f'HTTP {response.status_code}'
+            elif isinstance(content, dict) and content.get('error'):
+                result['error'] = str(content['error'])
+    except Exception as e:
+        result['error'] = str(e) or type(e).__name__
+
+    result['latency'] = time.perf_counter() - result['start']
+    return result
+
+async def run_closed_loop(client, args, choose_kind, results):
+    # every worker sends its next request as soon as the previous one finished
+    deadline = time.perf_counter() + args.duration
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            results.append(await send_request(client, choose_kind(), args))
+
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+
+async def run_open_loop(client, args, choose_kind, results):
+    # requests arrive at a poisson rate no matter how long the previous ones take
+    deadline = time.perf_counter() + args.duration
+    in_flight = set()
+
+    async def send():
+        results.append(await send_request(client, choose_kind(), args))
+
+    while time.perf_counter() < deadline:
+        task = asyncio.create_task(send())
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        await asyncio.sleep(random.expovariate(args.rate))
+
+    if in_flight:
+        await asyncio.wait(in_flight, timeout=args.drain_timeout)
+
+async def sample_rss(pid, samples, interval=0.5):
+    while True:
+        rss = get_rss_mb(pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(interval)
+
+def format_ms(value):
+    return f"{value * 1000:.0f}" if value is not None else '-'
+
+def summarize(results, duration, rss_samples):
+    summary = {'duration_s': duration, 'requests': len(results), 'throughput_rps': len(results) / duration, 'kinds': {}}
+    for kind in REQUEST_KINDS:
+        kind_results = [result for result in results if result['kind'] == kind]
+        if not kind_results:
+            continue
+        successful = [result for result in kind_results if not result['error']]
+        latencies = [result['latency'] for result in successful]
+        ttfts = [result['ttft'] for result in successful if result['ttft'] is not None]
+        itls = [itl for result in successful for itl in result['itl']]
+        errors = {}
+        for result in kind_results:
+            if result['error']:
+                errors[result['error']] = errors.get(result['error'], 0) + 1
+
+        summary['kinds'][kind] = {
+            'count': len(kind_results),
+            'error_rate': 1 - len(successful) / len(kind_results),
+            'errors': errors,
+            'rps': len(kind_results) / duration,
+            'latency': {name: percentile(latencies, fraction) for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))},
+            'ttft': {name: percentile(ttfts, fraction) for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))},
+            'itl': {name: percentile(itls, fraction) for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))},
+            'tokens_per_s': sum(result['tokens'] for result in successful) / duration
+        }
+
+    if rss_samples:
+        summary['server_rss_mb'] = {'start': rss_samples[0], 'peak': max(rss_samples), 'end': rss_samples[-1]}
+    return summary
+
+def print_summary(summary):
+    print(f"\n{summary['requests']} requests in {summary['duration_s']:.1f}s, {summary['throughput_rps']:.1f} req/s")
+    print(f"\n{'kind':<12}{'count':>7}{'errors':>8}{'req/s':>8}{'p50 ms':>8}{'p99 ms':>8}"
+          f"{'ttft p50':>10}{'ttft p99':>10}{'itl p50':>9}{'itl p99':>9}{'tok/s':>8}")
+    for kind, stats in summary['kinds'].items():
+        print(
+            f"{kind:<12}{stats['count']:>7}{stats['error_rate']:>8.1%}{stats['rps']:>8.1f}"
+            f"{format_ms(stats['latency']['p50']):>8}{format_ms(stats['latency']['p99']):>8}"
+            f"{format_ms(stats['ttft']['p50']):>10}{format_ms(stats['ttft']['p99']):>10}"
+            f"{format_ms(stats['itl']['p50']):>9}{format_ms(stats['itl']['p99']):>9}{stats['tokens_per_s']:>8.0f}"
+        )
+
+    for kind, stats in summary['kinds'].items():
+        for error, count in stats['errors'].items():
+            print(f"{kind} error x{count}: {error[:200]}")
+
+    if 'server_rss_mb' in summary:
+        rss = summary['server_rss_mb']
+        print(f"\nServer RSS: {rss['start']:.0f} MB at start, {rss['peak']:.0f} MB peak, {rss['end']:.0f} MB at the end")
+
+async def run_load_test(args):
+    weights = parse_mix(args.mix)
+    if 'run_task' in weights and not args.task:
+        raise ValueError("--task is required when the mix has run_task requests")
+    kinds, kind_weights = list(weights), list(weights.values())
+
+    def choose_kind():
+        return random.choices(kinds, kind_weights)[0]
+
+    processes = []
+    server_pid = args.server_pid
+    base_url = args.url
+    if not base_url:
+        processes = start_servers(args)
+        server_pid = processes[1].pid
+        base_url = f'http://127.0.0.1:{args.port}'
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        try:
+            if processes:
+                await wait_until_ready(client, f'http://127.0.0.1:{args.stub_port}/docs', processes[0])
+                await wait_until_ready(client, '/metrics', processes[1])
+
+            results = []
+            rss_samples = []
+            sampler = asyncio.create_task(sample_rss(server_pid, rss_samples)) if server_pid else None
+
+            start = time.perf_counter()
+            if args.mode == 'closed':
+                await run_closed_loop(client, args, choose_kind, results)
+            else:
+                await run_open_loop(client, args, choose_kind, results)
+            duration = time.perf_counter() - start
+
+            if sampler:
+                sampler.cancel()
+            return summarize(results, duration, rss_samples)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the agent HTTP server")
+    parser.add_argument("--mode", choices=['closed', 'open'], default='closed', help="closed: fixed concurrency, open: fixed arrival rate")
+    parser.add_argument("--concurrency", type=int, default=20, help="Concurrent clients in closed mode")
+    parser.add_argument("--rate", type=float, default=10, help="Requests per second in open mode")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to send requests for")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="Seconds to wait for in flight requests in open mode")
+    parser.add_argument("--timeout", type=float, default=120, help="Timeout of each request in seconds")
+    parser.add_argument("--mix", default='stream=1', help="Weights of the request kinds, e.g. stream=6,completion=2,run_task=1,run_adhoc=1")
+    parser.add_argument("--prompt", default='Give me a summary of the available data', help="Prompt of completion and ad-hoc requests")
+    parser.add_argument("--task", help="Task name of run_task requests")
+    parser.add_argument("--task-args", type=json.loads, default={}, help="JSON args of run_task requests")
+    parser.add_argument("--url", help="Load an agent server that is already running instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="Pid of the server given with --url, to report its memory")
+    parser.add_argument("--port", type=int, default=9000, help="Port of the agent server started by the load test")
+    parser.add_argument("--server-logs", action='store_true', help="Show the stderr of the agent server")
+    parser.add_argument("--stub-port", type=int, default=9100)
+    parser.add_argument("--first-token-ms", type=float, default=300, help="Stub latency before the first token")
+    parser.add_argument("--tokens-per-s", type=float, default=50, help="Stub token rate")
+    parser.add_argument("--tokens", type=int, default=100, help="Stub tokens per answer")
+    parser.add_argument("--output", help="Also write the summary as JSON to this file")
+    args = parser.parse_args()
+
+    summary = asyncio.run(run_load_test(args))
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main()
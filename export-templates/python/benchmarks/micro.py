@@ -0,0 +1,288 @@
+# Micro-benchmarks of the runtime hot paths with a fake chat model and fake embeddings, fully offline.
+#
+# Run it from the exported agent directory:
+#   python benchmarks/micro.py --size medium
+#   python benchmarks/micro.py --size medium --save-baseline
+#   python benchmarks/micro.py --size medium --compare --max-regression 0.2
+#
+# Every benchmark reports ops/sec and p50/p99 latency from a timed pass, and the peak memory allocated
+# per operation from a separate pass with tracemalloc, so tracing doesn't slow down the timed pass.
+import os
+import sys
+import time
+import json
+import asyncio
+import argparse
+import statistics
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeChatModel, FakeEmbeddings, install_offline_tokenizer
+from pydantic import create_model
+from components import completions, examples, tools
+from components.parser import extract_function_code
+from components.context_manager import get_messages_within_context_limit
+from components.types import Message
+from components.task_context import ContextStdout, emit_result, emit_row
+from components.sessions import Session
+from constants import TASK_TOOL_CALL_DESCRIPTION_TEMPLATES
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'micro.json')
+
+# rows: rows printed or emitted by tools, messages: conversation length, examples: size of the example index,
+# tokens: tokens of the final answer, code_lines: lines of generated code, tools: tasks in the tool registry
+PAYLOAD_SIZES = {
+    'small': {'rows': 10, 'row_size': 50, 'messages': 10, 'message_size': 200, 'examples': 50, 'tokens': 20, 'code_lines': 20, 'tools': 10},
+    'medium': {'rows': 500, 'row_size': 100, 'messages': 50, 'message_size': 1000, 'examples': 500, 'tokens': 200, 'code_lines': 100, 'tools': 100},
+    'large': {'rows': 5000, 'row_size': 200, 'messages': 200, 'message_size': 4000, 'examples': 5000, 'tokens': 1000, 'code_lines': 500, 'tools': 1000}
+}
+
+BENCHMARK_TOOL_NAME = 'benchmark_rows'
+
+def make_rows(size):
+    return [{'id': i, 'value': 'x' * size['row_size']} for i in range(size['rows'])]
+
+def make_messages(size):
+    # user and assistant turns with a tool call block every few turns
+    messages = []
+    content = 'lorem ipsum ' * (size['message_size'] // 12)
+    for i in range(size['messages']):
+        if i % 5 == 4:
+            tool_call = {'id': f'call_{i}', 'type': 'function', 'function': {'name': BENCHMARK_TOOL_NAME, 'arguments': '{}'}}
+            messages.append(Message(role='assistant', content='', tool_calls=[tool_call]))
+            messages.append(Message(role='tool', content=content, tool_call_id=f'call_{i}', name=BENCHMARK_TOOL_NAME))
+        else:
+            messages.append(Message(role='user' if i % 2 == 0 else 'assistant', content=content))
+    if messages[-1].role != 'user':
+        messages.append(Message(role='user', content=content))
+    return messages
+
+def make_code_response(size):
+    body = '\n'.join(f'    value_{i} = get_value({i})' for i in range(size['code_lines']))
+    return f"```python\ndef helper():\n    return 1\n\ndef doTask():\n{body}\n    print(json.dumps(value_0))\n```"
+
+def setup(size):
+    if install_offline_tokenizer():
+        print("tiktoken files are not available, token counts are approximated", file=sys.stderr)
+
+    # example index of the requested size with fake embeddings
+    fake_embeddings = FakeEmbeddings()
+    documents = [{'task': f'benchmark task {i}', 'code': f'def doTask():\n    print({i})'} for i in range(size['examples'])]
+    examples.embeddings = fake_embeddings
+    examples.build_example_index([
+        (f'benchmark:{i}', document, embedding)
+        for i, (document, embedding) in enumerate(zip(documents, fake_embeddings.embed_documents([json.dumps(document) for document in documents])))
+    ])
+
+    rows = make_rows(size)
+
+    def benchmark_rows():
+        print(json.dumps(rows))
+
+    registry = completions.get_tool_registry()
+    registry.register(BENCHMARK_TOOL_NAME, {
+        'description': 'Returns benchmark rows',
+        'input': {},
+        'args_schema': create_model(BENCHMARK_TOOL_NAME),
+        'output': list,
+        'function': benchmark_rows
+    })
+
+    # tasks with arguments and a call description, the registry has as many as the size asks for
+    def benchmark_report(bank_name, year, include_details=False):
+        pass
+
+    for i in range(size['tools']):
+        name = f'{BENCHMARK_TOOL_NAME}_{i}'
+        TASK_TOOL_CALL_DESCRIPTION_TEMPLATES[name] = 'Getting the #year# report of #bank_name#'
+        registry.register(name, {
+            'description': f'Returns benchmark report {i}',
+            'input': {'bank_name': str, 'year': int, 'include_details': bool},
+            'args_schema': create_model(name, bank_name=(str, ...), year=(int, ...), include_details=(bool, False)),
+            'output': dict,
+            'function': benchmark_report
+        })
+
+    fake_model = FakeChatModel(tool_name=BENCHMARK_TOOL_NAME, answer_tokens=size['tokens'])
+    completions.create_chat_model = lambda **kwargs: fake_model
+
+def get_benchmarks(size):
+    rows = make_rows(size)
+    messages = make_messages(size)
+    code_response = make_code_response(size)
+    tool_calls = [{'id': 'call_1', 'type': 'function', 'function': {'name': BENCHMARK_TOOL_NAME, 'arguments': '{}'}}]
+    conversation = [Message(role='user', content='Show me the benchmark rows')]
+    params = {'include_tool_messages': True}
+
+    def print_rows():
+        print(json.dumps(rows))
+
+    async def print_rows_async():
+        print(json.dumps(rows))
+
+    # the same rows through the result channel, as one result and one row at a time
+    def emit_rows_result():
+        emit_result(rows)
+
+    def emit_rows():
+        for row in rows:
+            emit_row(row)
+
+    async def run_stream():
+        async for _ in completions._stream_completion('benchmark', conversation, params):
+            pass
+
+    async def run_relevant_examples():
+        examples.get_relevant_examples('benchmark task 42')
+
+    async def run_extract_function_code():
+        extract_function_code(code_response)
+
+    async def run_context_limit():
+        get_messages_within_context_limit(tools.model, messages)
+
+    # lookup, argument validation and call description of the last registered task, without running it
+    dispatch_tool_name = f"{BENCHMARK_TOOL_NAME}_{size['tools'] - 1}"
+    dispatch_arguments = '{"bank_name": "Benchmark Bank", "year": 2024}'
+
+    # a turn of a long conversation, resent in full or as one new message of a session
+    session = Session('benchmark')
+    for message in messages[:-1]:
+        session.append(message, completions.convert_message(message), completions.count_message_tokens(message))
+
+    async def run_request_conversation():
+        completions.get_conversation(messages)
+
+    async def run_session_conversation():
+        turn_start = len(session.messages)
+        completions.get_conversation(messages[-1:], session)
+        session.rollback(turn_start)
+
+    async def run_tool_dispatch():
+        registered_tool = completions.get_tool_registry().get(dispatch_tool_name)
+        args = json.loads(dispatch_arguments)
+        registered_tool.get_call_arguments(args)
+        registered_tool.describe(args)
+
+    return {
+        'generate_completion': lambda: completions.generate_completion('benchmark', conversation, params),
+        '_stream_completion': run_stream,
+        'process_tool_calls': lambda: completions.process_tool_calls(tool_calls),
+        'tool_dispatch': run_tool_dispatch,
+        'get_conversation[request]': run_request_conversation,
+        'get_conversation[session]': run_session_conversation,
+        'capture_and_process_output[sync]': lambda: tools.capture_and_process_output(print_rows),
+        'capture_and_process_output[async]': lambda: tools.capture_and_process_output(print_rows_async),
+        'capture_and_process_output[result]': lambda: tools.capture_and_process_output(emit_rows_result),
+        'capture_and_process_output[rows]': lambda: tools.capture_and_process_output(emit_rows),
+        'get_messages_within_context_limit': run_context_limit,
+        'get_relevant_examples': run_relevant_examples,
+        'extract_function_code': run_extract_function_code
+    }
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def run_benchmark(run, iterations, warmup):
+    for _ in range(warmup):
+        await run()
+
+    durations = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        op_start = time.perf_counter()
+        await run()
+        durations.append(time.perf_counter() - op_start)
+    total = time.perf_counter() - start
+
+    allocation_runs = max(1, min(iterations // 10, 20))
+    peaks = []
+    tracemalloc.start()
+    for _ in range(allocation_runs):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        await run()
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+    tracemalloc.stop()
+
+    return {
+        'ops_per_s': iterations / total,
+        'p50_ms': percentile(durations, 0.5) * 1000,
+        'p99_ms': percentile(durations, 0.99) * 1000,
+        'alloc_kb': statistics.median(peaks) / 1024
+    }
+
+async def run_benchmarks(size, iterations, warmup, selected):
+    results = {}
+    for name, run in get_benchmarks(size).items():
+        if selected and not any(pattern in name for pattern in selected):
+            continue
+        results[name] = await run_benchmark(run, iterations, warmup)
+    return results
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def print_results(results, baseline, max_regression):
+    regressions = []
+    print(f"\n{'benchmark':<36}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'alloc KB':>10}{'vs baseline':>13}")
+    for name, result in results.items():
+        change = ''
+        if name in baseline:
+            # positive means slower than the baseline
+            ratio = baseline[name]['ops_per_s'] / result['ops_per_s'] - 1
+            change = f"{ratio:+.0%}"
+            if max_regression is not None and ratio > max_regression:
+                regressions.append(name)
+                change += ' !'
+        print(f"{name:<36}{result['ops_per_s']:>10.0f}{result['p50_ms']:>10.3f}{result['p99_ms']:>10.3f}{result['alloc_kb']:>10.1f}{change:>13}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline micro-benchmarks of the agent runtime")
+    parser.add_argument("--size", choices=list(PAYLOAD_SIZES), default='medium', help="Payload size preset")
+    parser.add_argument("--iterations", type=int, default=200, help="Timed iterations of each benchmark")
+    parser.add_argument("--warmup", type=int, default=10, help="Untimed iterations before timing")
+    parser.add_argument("--only", action='append', help="Only run benchmarks whose name contains this text")
+    parser.add_argument("--baseline-file", default=BASELINE_FILE, help="Stored baselines, keyed by payload size")
+    parser.add_argument("--save-baseline", action='store_true', help="Store these results as the baseline")
+    parser.add_argument("--compare", action='store_true', help="Exit with an error if a benchmark regressed")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    size = PAYLOAD_SIZES[args.size]
+    setup(size)
+
+    # tools print what they are doing, only the results table goes to stdout
+    # task output is still captured, ContextStdout only writes to devnull outside tasks
+    real_stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = ContextStdout(devnull)
+        try:
+            results = asyncio.run(run_benchmarks(size, args.iterations, args.warmup, args.only))
+        finally:
+            sys.stdout = real_stdout
+
+    baselines = load_baselines(args.baseline_file)
+    regressions = print_results(results, baselines.get(args.size, {}), args.max_regression if args.compare else None)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline_file), exist_ok=True)
+        baselines[args.size] = {**baselines.get(args.size, {}), **results}
+        with open(args.baseline_file, 'w') as f:
+            json.dump(baselines, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline_file}")
+
+    if regressions:
+        print(f"\nRegressed more than {args.max_regression:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
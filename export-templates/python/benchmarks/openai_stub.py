@@ -0,0 +1,104 @@
+# Local OpenAI compatible server for load tests, answers chat completions and embeddings without a real model.
+#
+#   python benchmarks/openai_stub.py --port 9100 --first-token-ms 300 --tokens-per-s 50 --tokens 100
+#
+# Chat requests with tools get a text answer, requests without tools are ad-hoc code generation and get
+# a doTask that prints its result.
+import time
+import json
+import uuid
+import base64
+import asyncio
+import argparse
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+ADHOC_CODE = '```python\ndef doTask():\n    print(json.dumps({"ok": True}))\n```'
+
+def create_stub_app(first_token_ms=300, tokens_per_s=50, tokens=100, embedding_size=1536):
+    app = FastAPI()
+
+    def get_answer(body):
+        if body.get('tools'):
+            return [f'token{i} ' for i in range(tokens)]
+        return [line + '\n' for line in ADHOC_CODE.split('\n')]
+
+    def create_chunk(completion_id, model, delta, finish_reason=None):
+        return {
+            'id': completion_id,
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+        }
+
+    @app.post('/v1/chat/completions')
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get('model', 'stub')
+        completion_id = f'chatcmpl-{uuid.uuid4()}'
+        answer = get_answer(body)
+
+        if body.get('stream'):
+            async def stream():
+                await asyncio.sleep(first_token_ms / 1000)
+                for index, token in enumerate(answer):
+                    if index:
+                        await asyncio.sleep(1 / tokens_per_s)
+                    delta = {'role': 'assistant', 'content': token} if index == 0 else {'content': token}
+                    yield f"data: {json.dumps(create_chunk(completion_id, model, delta))}\n\n"
+                yield f"data: {json.dumps(create_chunk(completion_id, model, {}, 'stop'))}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(stream(), media_type='text/event-stream')
+
+        # without streaming the whole answer is generated before responding
+        await asyncio.sleep(first_token_ms / 1000 + (len(answer) - 1) / tokens_per_s)
+        return JSONResponse(content={
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(answer)}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': len(answer), 'total_tokens': len(answer)}
+        })
+
+    @app.post('/v1/embeddings')
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+        rng = np.random.default_rng(len(inputs))
+        data = []
+        for index in range(len(inputs)):
+            vector = rng.random(embedding_size, dtype=np.float32)
+            embedding = base64.b64encode(vector.tobytes()).decode() if body.get('encoding_format') == 'base64' else vector.tolist()
+            data.append({'object': 'embedding', 'index': index, 'embedding': embedding})
+        return JSONResponse(content={
+            'object': 'list',
+            'data': data,
+            'model': body.get('model', 'stub'),
+            'usage': {'prompt_tokens': 0, 'total_tokens': 0}
+        })
+
+    @app.get('/v1/models')
+    async def models():
+        # called by the warm-up of the agent to open its connections
+        return JSONResponse(content={'object': 'list', 'data': [{'id': 'stub', 'object': 'model', 'created': 0, 'owned_by': 'stub'}]})
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI compatible stub server")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--first-token-ms", type=float, default=300, help="Latency before the first token")
+    parser.add_argument("--tokens-per-s", type=float, default=50, help="Token rate after the first token")
+    parser.add_argument("--tokens", type=int, default=100, help="Tokens of each chat answer")
+    args = parser.parse_args()
+
+    app = create_stub_app(args.first_token_ms, args.tokens_per_s, args.tokens)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="error")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# Cold start time of the agent, fails when it goes over the budget so it can run as a regression check in CI.
+#
+# Run it from the exported agent directory:
+#   python benchmarks/startup.py --runs 5 --budget-ms 2000
+#
+# "http" is the time from starting the process until the server answers, "ready" until it finished the warm-up and
+# /readyz answers 200 (WARMUP_STEPS), "cli" the time to import the CLI.
+# Run the agent with --startup-report to see which modules the time goes to.
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+import urllib.request
+
+AGENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def get_env(port):
+    return {
+        **os.environ,
+        'PORT': str(port),
+        'SKIP_BANNER': 'true',
+        'OPENAI_API_KEY': os.environ.get('OPENAI_API_KEY', 'startup-benchmark'),
+        'OPENAI_MODEL': os.environ.get('OPENAI_MODEL', 'gpt-4o')
+    }
+
+def measure_http_startup(port, path='/healthz', timeout=120):
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join('src', 'main.py'), '--http'],
+        cwd=AGENT_DIR, env=get_env(port), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {process.returncode}")
+            try:
+                # /readyz answers 503 while warming up, urlopen raises it as an error
+                urllib.request.urlopen(f'http://127.0.0.1:{port}{path}', timeout=1)
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError(f"Server was not ready after {timeout} seconds")
+    finally:
+        process.terminate()
+        process.wait()
+
+def measure_cli_startup():
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, '-c', 'import components.cli_chat'],
+        cwd=os.path.join(AGENT_DIR, 'src'), env=get_env(0), check=True
+    )
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time of the agent")
+    parser.add_argument("--runs", type=int, default=5, help="Cold starts measured for each mode")
+    parser.add_argument("--budget-ms", type=float, default=2000, help="Maximum median cold start time")
+    parser.add_argument("--ready-budget-ms", type=float, default=0, help="Maximum median time until the server is warm, 0 to not check it")
+    parser.add_argument("--port", type=int, default=9200)
+    args = parser.parse_args()
+
+    results = {
+        'http': [measure_http_startup(args.port) for _ in range(args.runs)],
+        'ready': [measure_http_startup(args.port, '/readyz') for _ in range(args.runs)],
+        'cli': [measure_cli_startup() for _ in range(args.runs)]
+    }
+    budgets = {'http': args.budget_ms, 'ready': args.ready_budget_ms, 'cli': args.budget_ms}
+
+    over_budget = []
+    print(f"\n{'mode':<8}{'median ms':>12}{'min ms':>10}{'max ms':>10}{'budget ms':>12}")
+    for mode, durations in results.items():
+        median = statistics.median(durations) * 1000
+        if budgets[mode] and median > budgets[mode]:
+            over_budget.append(mode)
+        budget = f"{budgets[mode]:.0f}" if budgets[mode] else '-'
+        print(f"{mode:<8}{median:>12.0f}{min(durations) * 1000:>10.0f}{max(durations) * 1000:>10.0f}{budget:>12}")
+
+    if over_budget:
+        print(f"\nCold start over budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
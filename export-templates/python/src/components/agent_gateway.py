@@ -1,6 +1,6 @@
 from constants import AGENT_GATEWAY_URL, AGENT_GATEWAY_TOKEN
-from logger import log, logErr
-import requests
+from components.logger import log
+from components.http_client import http_client
 
 def get_delegation_token(target_agent_id, delegation_token):
 
@@ -12,7 +12,7 @@ def get_delegation_token(target_agent_id, delegation_token):
     if not delegation_token:
         raise Exception("Delegation token is not provided")
 
-    response = requests.post(
+    response = http_client.post(
         f"{AGENT_GATEWAY_URL}/auth/delegate",
         json={
             "target_agent_id": target_agent_id,
@@ -39,7 +39,7 @@ class AgentGateway:
 
         log("agent-gateway", "callAgent", { agent_id })
 
-        response = requests.post(
+        response = http_client.post(
             f"{AGENT_GATEWAY_URL}/completions", 
             json={
                 "messages": messages,
@@ -51,7 +51,7 @@ class AgentGateway:
                 "delegationToken": new_delegation_token
             },
             headers={
-                'Authorization': f'Bearer {self.AGENT_GATEWAY_TOKEN}',
+                'Authorization': f'Bearer {AGENT_GATEWAY_TOKEN}',
                 'Content-Type': 'application/json'
             }
         )
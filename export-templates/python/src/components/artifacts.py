@@ -0,0 +1,343 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import threading
+from functools import cmp_to_key
+from collections import OrderedDict
+from typing import Any, List, Literal, Optional
+from pydantic import BaseModel, Field
+from components.metrics import increment, observe
+from constants import IS_LAMBDA
+
+# Tool results whose JSON is longer than this many characters are stored as artifacts and replaced in the
+# conversation by a preview, 0 keeps every result in the conversation
+ARTIFACT_MIN_CHARS = int(os.getenv('ARTIFACT_MIN_CHARS', 20000))
+# Seconds an artifact can be queried after it was stored
+ARTIFACT_TTL = int(os.getenv('ARTIFACT_TTL', 3600))
+# Characters of artifacts kept in memory, the least recently used ones are only kept on disk
+ARTIFACT_MEMORY_MAX_CHARS = int(os.getenv('ARTIFACT_MEMORY_MAX_CHARS', 200_000_000))
+ARTIFACT_DIR = os.getenv('ARTIFACT_DIR') or ('/tmp/artifacts' if IS_LAMBDA else os.path.join(os.getcwd(), 'artifacts'))
+
+# Size of the preview that replaces the result in the conversation
+PREVIEW_ROWS = 3
+PREVIEW_MAX_CHARS = 2000
+# Rows a query can return at once
+QUERY_MAX_ROWS = 100
+# Expired artifacts are removed from disk every this many stores
+DISK_PURGE_INTERVAL = 50
+
+# Tools whose results are never stored, the artifact queries are already a page of an artifact
+EXCLUDED_TOOLS = {'query_artifact'}
+
+class Artifact:
+    """A stored tool result kept in memory."""
+    def __init__(self, handle, data, size, created_at):
+        self.handle = handle
+        self.data = data
+        self.size = size
+        self.created_at = created_at
+
+class ArtifactStore:
+    """Large tool results by handle, the recently used ones in memory and all of them on disk until they expire."""
+    def __init__(self, directory=ARTIFACT_DIR, ttl=ARTIFACT_TTL, memory_max_chars=ARTIFACT_MEMORY_MAX_CHARS):
+        self.directory = directory
+        self.ttl = ttl
+        self.memory_max_chars = memory_max_chars
+        self.artifacts = OrderedDict()
+        self.memory_chars = 0
+        self.stores = 0
+        self.disk_lock = threading.Lock()
+
+    def get_path(self, handle):
+        return os.path.join(self.directory, f'{handle}.json')
+
+    def is_expired(self, created_at):
+        return time.time() - created_at > self.ttl
+
+    async def store(self, data, serialized):
+        handle = f'artifact_{uuid.uuid4().hex[:16]}'
+        artifact = Artifact(handle, data, len(serialized), time.time())
+        self.artifacts[handle] = artifact
+        self.memory_chars += artifact.size
+        self.evict()
+        increment('artifacts.stored')
+        observe('artifacts.size_chars', artifact.size)
+
+        try:
+            await asyncio.to_thread(self.write, handle, serialized)
+        except OSError as e:
+            # it can still be queried while it's in memory
+            print(f"Failed to write artifact {handle}: {e}", flush=True)
+        return handle
+
+    async def get(self, handle):
+        artifact = self.artifacts.get(handle)
+        if artifact and self.is_expired(artifact.created_at):
+            self.remove(handle)
+            artifact = None
+
+        if artifact:
+            increment('artifacts.memory_hits')
+            self.artifacts.move_to_end(handle)
+            return artifact.data
+
+        # evicted from memory or stored by a previous process
+        loaded = await asyncio.to_thread(self.read, handle)
+        if loaded is None:
+            return None
+
+        increment('artifacts.disk_hits')
+        # another query may have loaded it meanwhile
+        if handle not in self.artifacts:
+            data, size, created_at = loaded
+            self.artifacts[handle] = Artifact(handle, data, size, created_at)
+            self.memory_chars += size
+            self.evict()
+        return loaded[0]
+
+    def evict(self):
+        # the most recently used artifact stays even when it's larger than the whole budget
+        while self.memory_chars > self.memory_max_chars and len(self.artifacts) > 1:
+            # the disk copy is kept, it's loaded again when it's queried
+            _, artifact = self.artifacts.popitem(last=False)
+            self.memory_chars -= artifact.size
+            increment('artifacts.evicted')
+
+    def remove(self, handle):
+        artifact = self.artifacts.pop(handle, None)
+        if artifact:
+            self.memory_chars -= artifact.size
+
+    def write(self, handle, serialized):
+        with self.disk_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.get_path(handle), 'w') as f:
+                f.write(serialized)
+
+            self.stores += 1
+            if self.stores % DISK_PURGE_INTERVAL == 0:
+                self.purge_disk()
+
+    def read(self, handle):
+        # handles are only letters, digits and underscores, anything else can't be one of our files
+        if not handle.replace('_', '').isalnum():
+            return None
+        path = self.get_path(handle)
+        try:
+            created_at = os.path.getmtime(path)
+            if self.is_expired(created_at):
+                return None
+            with open(path) as f:
+                serialized = f.read()
+            return json.loads(serialized), len(serialized), created_at
+        except (OSError, ValueError):
+            return None
+
+    def purge_disk(self):
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            try:
+                if file_name.endswith('.json') and self.is_expired(os.path.getmtime(path)):
+                    os.remove(path)
+            except OSError:
+                pass
+
+# Created with the first large result
+artifact_store = None
+
+def get_artifact_store():
+    global artifact_store
+    if artifact_store is None:
+        artifact_store = ArtifactStore()
+    return artifact_store
+
+def parse_result(result):
+    # ad-hoc tasks return their result as a JSON string
+    if isinstance(result, str) and result[:1] in ('[', '{'):
+        try:
+            return json.loads(result)
+        except ValueError:
+            pass
+    return result
+
+def describe_value(value):
+    if isinstance(value, list):
+        return f'list of {len(value)} items'
+    if isinstance(value, dict):
+        return f'object with {len(value)} keys'
+    if isinstance(value, str) and len(value) > 100:
+        return f'text of {len(value)} characters'
+    return value
+
+def get_fields(rows):
+    fields = {}
+    for row in rows[:100]:
+        if isinstance(row, dict):
+            fields.update(dict.fromkeys(row))
+    return list(fields)[:50]
+
+def create_preview(handle, tool_name, data, size):
+    preview = {
+        "artifact": handle,
+        "note": (
+            f"The result of {tool_name} is too large for the conversation ({size} characters), it was stored as an artifact. "
+            "Use the query_artifact tool with this handle to page through it, filter it or aggregate it."
+        )
+    }
+    if isinstance(data, list):
+        preview.update({"type": "list", "rows": len(data), "fields": get_fields(data), "first_rows": data[:PREVIEW_ROWS]})
+    elif isinstance(data, dict):
+        preview.update({"type": "object", "keys": {key: describe_value(value) for key, value in list(data.items())[:50]}})
+    else:
+        text = str(data)
+        preview.update({"type": "text", "lines": text.count('\n') + 1, "start": text[:PREVIEW_MAX_CHARS // 2]})
+
+    # rows can be large themselves
+    while preview.get("first_rows") and len(json.dumps(preview, default=str)) > PREVIEW_MAX_CHARS:
+        preview["first_rows"] = preview["first_rows"][:-1]
+    return preview
+
+async def store_if_large(result, tool_name):
+    # returns the result itself when it's small enough for the conversation, a preview of the stored artifact otherwise
+    if ARTIFACT_MIN_CHARS <= 0 or tool_name in EXCLUDED_TOOLS:
+        return result
+
+    serialized = result if isinstance(result, str) else json.dumps(result, default=str)
+    if len(serialized) < ARTIFACT_MIN_CHARS:
+        return result
+
+    data = parse_result(result)
+    if data is result and isinstance(result, str):
+        # plain text, the disk copy is JSON like the others
+        serialized = json.dumps(result)
+    handle = await get_artifact_store().store(data, serialized)
+    return create_preview(handle, tool_name, data, len(serialized))
+
+class ArtifactFilter(BaseModel):
+    field: str = Field(description="Field of the rows, nested fields separated by dots, empty when the rows aren't objects")
+    op: Literal['eq', 'ne', 'gt', 'gte', 'lt', 'lte', 'contains', 'in'] = 'eq'
+    value: Any = Field(description="Value to compare with, a list of values for 'in'")
+
+class QueryArtifactArguments(BaseModel):
+    handle: str = Field(description="Handle of the artifact")
+    path: Optional[str] = Field(None, description="Path of the list to query inside the artifact, keys separated by dots, empty for the artifact itself")
+    filters: Optional[List[ArtifactFilter]] = Field(None, description="Conditions every returned row must match")
+    fields: Optional[List[str]] = Field(None, description="Fields to return from every row, all of them when empty")
+    sort_by: Optional[str] = None
+    descending: bool = False
+    aggregate: Optional[Literal['count', 'sum', 'avg', 'min', 'max', 'distinct']] = Field(None, description="Aggregates the matching rows instead of returning them")
+    aggregate_field: Optional[str] = Field(None, description="Field to aggregate, not needed for count")
+    group_by: Optional[str] = Field(None, description="Field to group the aggregate by")
+    offset: int = 0
+    limit: int = Field(20, description=f"Rows or groups to return, at most {QUERY_MAX_ROWS}")
+
+def get_field(row, field):
+    # an empty field is the row itself, e.g. for lists of numbers
+    if not field:
+        return row
+    value = row
+    for key in field.split('.'):
+        if isinstance(value, dict):
+            value = value.get(key)
+        elif isinstance(value, list) and key.lstrip('-').isdigit() and -len(value) <= int(key) < len(value):
+            value = value[int(key)]
+        else:
+            return None
+    return value
+
+def to_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def compare(left, right):
+    # numbers are compared as numbers even when one of them is a string, anything else as text
+    left_number, right_number = to_number(left), to_number(right)
+    if left_number is not None and right_number is not None:
+        return (left_number > right_number) - (left_number < right_number)
+    left_text, right_text = str(left), str(right)
+    return (left_text > right_text) - (left_text < right_text)
+
+def matches(row, condition):
+    value = get_field(row, condition['field'])
+    op, expected = condition['op'], condition['value']
+    if op == 'contains':
+        return value is not None and str(expected).lower() in str(value).lower()
+    if op == 'in':
+        return any(compare(value, item) == 0 for item in (expected if isinstance(expected, list) else [expected]))
+    if value is None:
+        return op == 'ne' and expected is not None
+    result = compare(value, expected)
+    return {'eq': result == 0, 'ne': result != 0, 'gt': result > 0, 'gte': result >= 0, 'lt': result < 0, 'lte': result <= 0}[op]
+
+def aggregate_rows(rows, operation, field):
+    if operation == 'count':
+        return len(rows) if not field else sum(1 for row in rows if get_field(row, field) is not None)
+    values = [get_field(row, field) for row in rows]
+    if operation == 'distinct':
+        distinct = dict.fromkeys(json.dumps(value, default=str) for value in values if value is not None)
+        return [json.loads(value) for value in list(distinct)[:QUERY_MAX_ROWS]]
+    numbers = [number for number in map(to_number, values) if number is not None]
+    if not numbers:
+        return None
+    if operation == 'sum':
+        return sum(numbers)
+    if operation == 'avg':
+        return sum(numbers) / len(numbers)
+    return min(numbers) if operation == 'min' else max(numbers)
+
+def run_query(data, arguments):
+    rows = get_field(data, arguments['path']) if arguments.get('path') else data
+    if isinstance(rows, str):
+        rows = rows.splitlines()
+    if isinstance(rows, dict):
+        return {"error": "The path is an object, not a list", "keys": {key: describe_value(value) for key, value in list(rows.items())[:50]}}
+    if not isinstance(rows, list):
+        return {"error": "The path was not found or is not a list"}
+
+    for condition in arguments.get('filters') or []:
+        rows = [row for row in rows if matches(row, condition)]
+
+    offset = max(arguments.get('offset') or 0, 0)
+    limit = min(max(arguments.get('limit') or 20, 1), QUERY_MAX_ROWS)
+    operation = arguments.get('aggregate')
+    if operation:
+        field = arguments.get('aggregate_field')
+        if arguments.get('group_by'):
+            groups = {}
+            for row in rows:
+                groups.setdefault(json.dumps(get_field(row, arguments['group_by']), default=str), []).append(row)
+            results = [
+                {arguments['group_by']: json.loads(key), operation: aggregate_rows(group, operation, field)}
+                for key, group in groups.items()
+            ]
+            return {"matched_rows": len(rows), "total_groups": len(results), "offset": offset, "groups": results[offset:offset + limit]}
+        return {"matched_rows": len(rows), operation: aggregate_rows(rows, operation, field)}
+
+    if arguments.get('sort_by') is not None:
+        sort_by = arguments['sort_by']
+        # rows without the field go last
+        present = [row for row in rows if get_field(row, sort_by) is not None]
+        missing = [row for row in rows if get_field(row, sort_by) is None]
+        present.sort(key=cmp_to_key(lambda a, b: compare(get_field(a, sort_by), get_field(b, sort_by))), reverse=arguments.get('descending', False))
+        rows = present + missing
+
+    page = rows[offset:offset + limit]
+    if arguments.get('fields'):
+        page = [{field: get_field(row, field) for field in arguments['fields']} if isinstance(row, dict) else row for row in page]
+    return {"matched_rows": len(rows), "offset": offset, "rows": page, "has_more": offset + limit < len(rows)}
+
+async def query_artifact(input, faqtivGlobals=None):
+    data = await get_artifact_store().get(input['handle'])
+    if data is None:
+        return {"error": f"Artifact {input['handle']} was not found, it may have expired"}
+    increment('artifacts.queries')
+    # large artifacts take a while to filter and sort, other requests keep running meanwhile
+    return await asyncio.to_thread(run_query, data, input)
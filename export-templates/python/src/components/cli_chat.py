@@ -1,9 +1,9 @@
 import json
 import traceback
-import asyncio
 import uuid
 from components.completions import stream_completion
 from components.types import Message, CompletionRequest
+from components.http_client import run_in_new_loop
 
 async def async_cliAgent():
     print("Welcome, please type your request. Type 'exit' to quit.")
@@ -32,9 +32,11 @@ async def async_cliAgent():
             async for event in stream_completion(
                 completion_id=completion_id,
                 messages=request.messages,
-                include_tool_messages=request.include_tool_messages,
-                max_tokens=request.max_tokens,
-                temperature=request.temperature
+                params={
+                    "include_tool_messages": request.include_tool_messages,
+                    "max_tokens": request.max_tokens,
+                    "temperature": request.temperature
+                }
             ):
                 if event.startswith("data: ") and "[DONE]" not in event:
                     data = json.loads(event[6:])
@@ -55,4 +57,4 @@ async def async_cliAgent():
             traceback.print_exc()
 
 def start_cli_chat():
-    asyncio.run(async_cliAgent())
\ No newline at end of file
+    run_in_new_loop(async_cliAgent())
\ No newline at end of file
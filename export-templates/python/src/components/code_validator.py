@@ -0,0 +1,182 @@
+import os
+import ast
+import inspect
+import builtins
+from typing import List
+from components.task_context import TASK_GLOBAL_NAMES, SHARED_GLOBAL_NAMES, RESULT_FUNCTION_NAMES
+from components.task_helpers import ADHOC_HELPERS
+from constants import LIBS, FUNCTIONS
+
+ADHOC_DISALLOWED_IMPORTS = [
+    name.strip() for name in
+    os.getenv('ADHOC_DISALLOWED_IMPORTS', 'subprocess,socket,ctypes,multiprocessing,importlib').split(',')
+    if name.strip()
+]
+
+# Names available to generated code besides its own locals, see execute_generated_function
+AGENT_CALLABLES = {func.__name__: func for func in [*LIBS, *FUNCTIONS, *ADHOC_HELPERS]}
+KNOWN_NAMES = set(dir(builtins)) | set(AGENT_CALLABLES) | set(TASK_GLOBAL_NAMES) | set(SHARED_GLOBAL_NAMES) | set(RESULT_FUNCTION_NAMES) | {'json'}
+
+def get_local_names(function_node):
+    local_names = set()
+    for node in ast.walk(function_node):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            local_names.add(node.id)
+        elif isinstance(node, ast.arg):
+            local_names.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                local_names.add((alias.asname or alias.name).split('.')[0])
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            local_names.add(node.name)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            local_names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            local_names.update(node.names)
+        elif isinstance(node, (ast.MatchAs, ast.MatchStar)) and node.name:
+            local_names.add(node.name)
+    return local_names
+
+def check_names(function_node, local_names):
+    problems = []
+    reported = set()
+    for node in ast.walk(function_node):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            if node.id not in local_names and node.id not in KNOWN_NAMES and node.id not in reported:
+                reported.add(node.id)
+                problems.append(f"Line {node.lineno}: '{node.id}' is not defined, only the available functions can be used")
+    return problems
+
+def check_arity(function_node, local_names):
+    problems = []
+    for node in ast.walk(function_node):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)):
+            continue
+
+        name = node.func.id
+        if name not in AGENT_CALLABLES or name in local_names:
+            continue
+
+        # can't know how many arguments are unpacked from *args or **kwargs
+        if any(isinstance(arg, ast.Starred) for arg in node.args) or any(keyword.arg is None for keyword in node.keywords):
+            continue
+
+        try:
+            signature = inspect.signature(AGENT_CALLABLES[name])
+        except (TypeError, ValueError):
+            continue
+
+        try:
+            signature.bind(*node.args, **{keyword.arg: keyword.value for keyword in node.keywords})
+        except TypeError as e:
+            problems.append(f"Line {node.lineno}: wrong arguments for {name}{signature}: {e}")
+    return problems
+
+def check_imports(tree):
+    problems = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            modules = [node.module or '']
+        else:
+            continue
+
+        for module in modules:
+            if module.split('.')[0] in ADHOC_DISALLOWED_IMPORTS:
+                problems.append(f"Line {node.lineno}: importing '{module}' is not allowed")
+    return problems
+
+OUTPUT_FUNCTION_NAMES = {'print', *RESULT_FUNCTION_NAMES}
+
+def is_stdout(node):
+    return isinstance(node, ast.Attribute) and node.attr == 'stdout' and isinstance(node.value, ast.Name) and node.value.id == 'sys'
+
+# output_functions are the functions of the generated code that output the result, see get_output_functions
+def is_output_call(node, output_functions=frozenset()):
+    if not isinstance(node, ast.Call):
+        return False
+    if isinstance(node.func, ast.Name):
+        if node.func.id in OUTPUT_FUNCTION_NAMES or node.func.id in output_functions:
+            return True
+    # a helper that outputs can also be passed to another function, e.g. parallel_map(write_row, rows)
+    if any(isinstance(arg, ast.Name) and arg.id in output_functions for arg in node.args):
+        return True
+    # sys.stdout.write(...) and json.dump(..., sys.stdout) write the result too
+    if isinstance(node.func, ast.Attribute):
+        if node.func.attr in ('write', 'writelines') and is_stdout(node.func.value):
+            return True
+        if node.func.attr == 'dump' and isinstance(node.func.value, ast.Name) and node.func.value.id == 'json':
+            return any(is_stdout(arg) for arg in [*node.args[1:2], *[keyword.value for keyword in node.keywords if keyword.arg == 'fp']])
+    return False
+
+def get_blocks(statement):
+    if isinstance(statement, ast.Try) or (hasattr(ast, 'TryStar') and isinstance(statement, ast.TryStar)):
+        return [statement.body, *[handler.body for handler in statement.handlers], statement.orelse, statement.finalbody]
+    if isinstance(statement, ast.Match):
+        return [case.body for case in statement.cases]
+    if isinstance(statement, (ast.If, ast.For, ast.AsyncFor, ast.While)):
+        return [statement.body, statement.orelse]
+    if isinstance(statement, (ast.With, ast.AsyncWith)):
+        return [statement.body]
+    return None
+
+# Looks for an output call in statements that can run, i.e. not after a return or raise in the same block
+def has_reachable_output(statements, output_functions=frozenset()):
+    for statement in statements:
+        blocks = get_blocks(statement)
+        if blocks is None:
+            if any(is_output_call(node, output_functions) for node in ast.walk(statement)):
+                return True
+        else:
+            header = [getattr(statement, field) for field in ('test', 'iter', 'subject') if getattr(statement, field, None)]
+            header += [item.context_expr for item in getattr(statement, 'items', [])]
+            if any(is_output_call(node, output_functions) for expression in header for node in ast.walk(expression)):
+                return True
+            if any(has_reachable_output(block, output_functions) for block in blocks):
+                return True
+
+        if isinstance(statement, (ast.Return, ast.Raise)):
+            return False
+    return False
+
+# Functions defined in the generated code that output the result, themselves or through another one of them
+def get_output_functions(tree):
+    functions = [node for node in ast.walk(tree) if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))]
+    output_functions = set()
+    changed = True
+    while changed:
+        changed = False
+        for function in functions:
+            if function.name not in output_functions and has_reachable_output(function.body, output_functions):
+                output_functions.add(function.name)
+                changed = True
+    return output_functions
+
+# Static checks of the generated doTask before running it, returns a list of problems
+def validate_generated_code(function_code, target_function_name='doTask') -> List[str]:
+    try:
+        tree = ast.parse(function_code)
+    except SyntaxError as e:
+        return [f"Syntax error: {e}"]
+
+    function_node = next((
+        node for node in tree.body
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == target_function_name
+    ), None)
+
+    if not function_node:
+        return [f"Function {target_function_name} was not found"]
+
+    # names imported or defined next to the function, e.g. a module level import sys, are available to it too
+    local_names = get_local_names(tree) | {target_function_name}
+    problems = [
+        *check_names(function_node, local_names),
+        *check_arity(function_node, local_names),
+        *check_imports(tree)
+    ]
+
+    if not has_reachable_output(function_node.body, get_output_functions(tree)):
+        problems.append(f"{target_function_name} never outputs its result, it must finish by emitting its result or writing it as JSON to stdout")
+
+    return problems
@@ -1,40 +1,52 @@
 import os
 import json
 import traceback
+import contextlib
 import time
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, AIMessage, ToolMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from fastapi import HTTPException
-from fastapi.responses import JSONResponse
 from typing import Any
 from pydantic import create_model
 from components.logger import log_err
-from components.tools import generate_and_execute_adhoc, get_tool_call_description
+from components.tools import generate_and_execute_adhoc
 from constants import TASK_TOOL_SCHEMAS, COMPLETION_PROMPT_TEXT
-from components.context_manager import get_messages_within_context_limit
-from components.tools import create_tools_from_schemas
-from components.types import CompletionResponse
-
-# Create tools from schemas
-task_tools = create_tools_from_schemas(TASK_TOOL_SCHEMAS)
+from components.context_manager import get_messages_within_context_limit, get_model_limit, get_tokens
+from components.sessions import SessionStore
+from components.single_flight import SingleFlight
+from components.model_router import get_stage_model
+from components.llm_scheduler import llm_scheduler, estimate_tokens, PRIORITY_DEFAULT, PRIORITY_INTERACTIVE
+from components.tool_registry import ToolRegistry
+from components.http_client import openai_http_client
+from components.artifacts import ARTIFACT_MIN_CHARS, QueryArtifactArguments, query_artifact, store_if_large
+from components.metrics import observe
+from components.types import CompletionResponse, Message
 
 # Read the API key and model from environment variables
 api_key = os.getenv('OPENAI_API_KEY')
-model = os.getenv('OPENAI_MODEL')
 
 if not api_key:
     raise ValueError("OPENAI_API_KEY environment variable is not set")
 
-if not model:
+if not os.getenv('OPENAI_MODEL'):
     raise ValueError("OPENAI_MODEL environment variable is not set")
 
+# The completion loop can use its own model, its context limit and tokenizer are the ones of that model
+model = get_stage_model('completion')
+
+def replace_longest_tool_result(conversation, content):
+    tool_messages = [message for message in conversation if isinstance(message, ToolMessage)]
+    if not tool_messages:
+        return list(conversation)
+    longest_tool_message = max(tool_messages, key=lambda message: len(message.content))
+    replacement = longest_tool_message.model_copy(update={"content": content})
+    return [replacement if message is longest_tool_message else message for message in conversation]
+
 async def run_adhoc_task(input: str, faqtivGlobals=None) -> str:
     try:
         result = await generate_and_execute_adhoc(input["description"], faqtivGlobals)
         # Ensure the result is a string
         if isinstance(result, dict):
-            result = json.dumps(result)
+            result = json.dumps(result, default=str)
         elif not isinstance(result, str):
             result = str(result)
         return result
@@ -55,8 +67,40 @@ completion_tool_schemas = {
         "function": run_adhoc_task
     }
 }
-adhoc_tool = create_tools_from_schemas(completion_tool_schemas)
-completion_tools = adhoc_tool + task_tools
+
+# Large tool results are replaced in the conversation by a preview, the model reads them with this tool
+if ARTIFACT_MIN_CHARS > 0:
+    completion_tool_schemas["query_artifact"] = {
+        "description": (
+            "Reads a large tool result that was stored as an artifact: returns a page of its rows, optionally filtered, "
+            "sorted and with only some fields, or aggregates them (count, sum, avg, min, max, distinct) optionally grouped by a field"
+        ),
+        "input": {"handle": str},
+        "args_schema": QueryArtifactArguments,
+        "output": Any,
+        "function": query_artifact
+    }
+
+# The registry is built with the first completion
+tool_registry = None
+
+def get_tool_registry():
+    global tool_registry
+    if tool_registry is None:
+        tool_registry = ToolRegistry({**completion_tool_schemas, **TASK_TOOL_SCHEMAS})
+    return tool_registry
+
+def get_completion_tools():
+    return get_tool_registry().tools
+
+def create_chat_model(**completion_options):
+    # langchain_openai takes about a second to import, it's only loaded when the first completion needs it
+    from langchain_openai import ChatOpenAI
+    # retries go through the LLM scheduler, so rate limits are handled for the whole process, and the connections
+    # are kept in a shared pool, a model is created for every completion
+    return ChatOpenAI(
+        api_key=api_key, model=model, max_retries=0, stream_usage=True, http_async_client=openai_http_client.get_client(), **completion_options
+    )
 
 completion_prompt = ChatPromptTemplate.from_messages(
     [
@@ -65,6 +109,9 @@ completion_prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
+# Identical tool calls of concurrent completions run once when coalescing is enabled
+tool_call_flights = SingleFlight('tool_calls')
+
 async def process_tool_calls(tool_calls, faqtivGlobals=None):
     tool_messages = [
         AIMessage(
@@ -76,16 +123,26 @@ async def process_tool_calls(tool_calls, faqtivGlobals=None):
     for tool_call in tool_calls:
         print("Calling tool:", tool_call["function"]["name"], tool_call["function"]["arguments"], flush=True)
 
-        tool = next((t for t in completion_tools if t.name == tool_call["function"]["name"]), None)
-        if tool:
+        registered_tool = get_tool_registry().get(tool_call["function"]["name"])
+        if registered_tool:
             try:
+                dispatch_start = time.perf_counter()
                 args = json.loads(tool_call["function"]["arguments"])
-                tool_call_description = get_tool_call_description(tool_call["function"]["name"], args)
+                call_arguments = registered_tool.get_call_arguments(args)
+                tool_call_description = registered_tool.describe(args)
+                observe('tools.dispatch_ms', (time.perf_counter() - dispatch_start) * 1000)
                 
-                if tool_call_description and faqtivGlobals.streamWriter and faqtivGlobals.streamWriter.writeEvent:
-                    faqtivGlobals.streamWriter.writeEvent(tool_call_description, model)
+                stream_writer = faqtivGlobals.get("streamWriter") if faqtivGlobals else None
+                if tool_call_description and stream_writer:
+                    stream_writer.writeEvent(tool_call_description, model)
                 
-                tool_result = await tool.coroutine(args, faqtivGlobals=faqtivGlobals)
+                tool_result = await tool_call_flights.call(
+                    [registered_tool.name, call_arguments],
+                    lambda flight_globals: registered_tool.invoke(call_arguments, faqtivGlobals=flight_globals),
+                    faqtivGlobals
+                )
+                # a large result would be resent with every later request of the conversation
+                tool_result = await store_if_large(tool_result, registered_tool.name)
                 print("Tool result:", tool_result, flush=True)
             except Exception as e:
                 error_message = f"Error in tool '{tool_call['function']['name']}': {str(e)}"
@@ -97,7 +154,7 @@ async def process_tool_calls(tool_calls, faqtivGlobals=None):
                     content=json.dumps({
                         "type": "tool_result",
                         "result": tool_result
-                    }),
+                    }, default=str),
                     tool_call_id=tool_call["id"]
                 )
             )
@@ -115,41 +172,84 @@ async def process_tool_calls(tool_calls, faqtivGlobals=None):
     
     return tool_messages
 
-def get_conversation_from_messages_request(messages):
-    truncated_messages = get_messages_within_context_limit(model, messages)
-    
+def strip_consecutive_user_messages(messages):
     # Strip consecutive user messages if enabled
-    if os.getenv('STRIP_CONSECUTIVE_USER_MSGS', 'false').lower() == 'true':
-        filtered_messages = []
-        prev_role = None
-        
-        # Remove consecutive user messages
-        for msg in truncated_messages:
-            if msg.role == 'user':
-                if prev_role != 'user':
-                    filtered_messages.append(msg)
-            else:
+    if os.getenv('STRIP_CONSECUTIVE_USER_MSGS', 'false').lower() != 'true':
+        return messages
+
+    filtered_messages = []
+    prev_role = None
+    
+    # Remove consecutive user messages
+    for msg in messages:
+        if msg.role == 'user':
+            if prev_role != 'user':
                 filtered_messages.append(msg)
-            prev_role = msg.role
-        
-        truncated_messages = filtered_messages
+        else:
+            filtered_messages.append(msg)
+        prev_role = msg.role
     
-    def create_ai_message(msg):
-        content = msg.content
-        additional_kwargs = {}
-        if hasattr(msg, 'tool_calls') and msg.tool_calls:
-            additional_kwargs['tool_calls'] = msg.tool_calls
-        return AIMessage(content=content, additional_kwargs=additional_kwargs)
-
-    return [
+    return filtered_messages
+
+def create_ai_message(msg):
+    content = msg.content
+    additional_kwargs = {}
+    if hasattr(msg, 'tool_calls') and msg.tool_calls:
+        additional_kwargs['tool_calls'] = msg.tool_calls
+    return AIMessage(content=content, additional_kwargs=additional_kwargs)
+
+def convert_message(msg):
+    return (
         HumanMessage(msg.content) if msg.role == 'user'
         else create_ai_message(msg) if msg.role == 'assistant'
         else ToolMessage(content=msg.content, tool_call_id=msg.tool_call_id, name=msg.name) if msg.role == 'tool'
         else SystemMessage(msg.content) if msg.role == 'system'
         else None
-        for msg in truncated_messages
-        if msg is not None
-    ]
+    )
+
+def get_conversation_from_messages_request(messages):
+    truncated_messages = strip_consecutive_user_messages(get_messages_within_context_limit(model, messages))
+    return [convert_message(msg) for msg in truncated_messages]
+
+def count_message_tokens(msg):
+    return get_tokens(model, msg.content or '')
+
+# Sessions are created with the first request that has a session id
+session_store = None
+
+def get_session_store():
+    global session_store
+    if session_store is None:
+        session_store = SessionStore(convert_message, count_message_tokens, model)
+    return session_store
+
+def get_conversation_from_session(session, new_messages):
+    # only the new messages are converted and tokenized, the rest comes from the session
+    for msg in new_messages:
+        session.append(msg, convert_message(msg), count_message_tokens(msg))
+
+    if session.total_tokens <= get_model_limit(model):
+        truncated_messages = session.messages
+    else:
+        truncated_messages = get_messages_within_context_limit(model, session.messages, count_tokens=session.get_tokens)
+    return [session.get_converted(msg) for msg in strip_consecutive_user_messages(truncated_messages)]
+
+def get_conversation(messages, session=None):
+    if session is None:
+        return get_conversation_from_messages_request(messages)
+    return get_conversation_from_session(session, messages)
+
+def convert_message_from_langchain(message):
+    if isinstance(message, ToolMessage):
+        return Message(role='tool', content=message.content, tool_call_id=message.tool_call_id, name=message.name)
+    return Message(role='assistant', content=message.content or '', tool_calls=message.additional_kwargs.get('tool_calls') or None)
+
+async def save_session_turn(session, produced_messages):
+    # tool calls, tool results and the answer of the turn are kept with their token counts for the next turns
+    for message in produced_messages:
+        msg = convert_message_from_langchain(message)
+        session.append(msg, message, count_message_tokens(msg))
+    await get_session_store().save(session)
 
 def convert_ai_message_to_openai_format(ai_message):
     return {
@@ -166,25 +266,49 @@ def convert_tool_message_to_openai_format(tool_message):
         "content": tool_message.content
     }
 
-async def generate_completion(completion_id, messages, params):
+def estimate_conversation_tokens(conversation, max_tokens=None):
+    return estimate_tokens([COMPLETION_PROMPT_TEXT, *(str(message.content) for message in conversation)], max_tokens)
+
+def is_streamed_content(event):
+    # once content reached the client a failed stream can't be retried
+    return event['event'] == 'on_chat_model_stream' and bool(event['data']['chunk'].content)
+
+def get_event_usage(event):
+    if event['event'] != 'on_chat_model_end':
+        return None
+    usage = getattr(event['data'].get('output'), 'usage_metadata', None)
+    return usage.get('total_tokens') if usage else None
+
+async def generate_completion(completion_id, messages, params, session=None):
+    # only the HTTP server uses non-streaming completions, the CLI doesn't need fastapi
+    from fastapi import HTTPException
+    from fastapi.responses import JSONResponse
+
     completion_options = set_options_from_env(params)
     includeToolMessages = bool(params.get("include_tool_messages"))
 
-    llm = ChatOpenAI(
-        api_key=api_key,
-        model=model,
-        **completion_options
-    ).bind_tools(completion_tools)
+    llm = create_chat_model(**completion_options).bind_tools(get_tool_registry().openai_tools)
     completion_chain = completion_prompt.pipe(llm)
 
     current_time = int(time.time())
-    conversation = get_conversation_from_messages_request(messages)
+    turn_start = len(session.messages) if session else 0
+    try:
+        conversation = get_conversation(messages, session)
+    except Exception:
+        # the messages appended before the one that failed are not kept either
+        if session:
+            session.rollback(turn_start)
+        raise
     final_content = ''
     tool_results_messages = []
 
+    def invoke_chain(input_data):
+        estimated_tokens = estimate_conversation_tokens(input_data["conversation"], completion_options.get("max_tokens"))
+        return llm_scheduler.run(lambda: completion_chain.ainvoke(input_data), PRIORITY_DEFAULT, estimated_tokens, usage_name=f'completion.{model}')
+
     async def process_request(input_data):
         try:
-            result = completion_chain.invoke(input_data)
+            result = await invoke_chain(input_data)
             return result
         except Exception as e:
             error_message = str(e)
@@ -193,20 +317,16 @@ async def generate_completion(completion_id, messages, params):
                     f"Error: The tool returned too much data. "
                     "Please try to be more specific or choose a different approach that requires less data."
                 )
-                # Find the longest tool call result
-                tool_messages = [msg for msg in input_data["conversation"] if isinstance(msg, ToolMessage)]
-                if tool_messages:
-                    longest_tool_message = max(tool_messages, key=lambda x: len(x.content))
-                    # Modify the content of the longest tool message
-                    longest_tool_message.content = error_response
+                # the messages can be cached by a session, the longest tool result is replaced in a copy of the conversation
+                trimmed_conversation = replace_longest_tool_result(input_data["conversation"], error_response)
                 
                 # Retry with the updated conversation
                 retry_input = {
-                    "conversation": input_data["conversation"] + [
+                    "conversation": trimmed_conversation + [
                         HumanMessage(content="The previous tool call returned too much data. Please adjust your approach and try again.")
                     ]
                 }
-                return completion_chain.invoke(retry_input)
+                return await invoke_chain(retry_input)
             else:
                 raise
 
@@ -224,8 +344,13 @@ async def generate_completion(completion_id, messages, params):
         except Exception as e:
             print(f"Error during completion: {e}", flush=True)
             traceback.print_exc()
+            if session:
+                session.rollback(turn_start)
             raise HTTPException(status_code=500, detail=str(e))
 
+    if session:
+        await save_session_turn(session, tool_results_messages + [AIMessage(content=final_content)])
+
     response = CompletionResponse(
         id=completion_id,
         object="chat.completion",
@@ -240,7 +365,8 @@ async def generate_completion(completion_id, messages, params):
                 },
                 "finish_reason": "stop"
             }
-        ]
+        ],
+        session_id=session.id if session else None
     )
 
     if includeToolMessages:
@@ -264,30 +390,42 @@ async def generate_completion(completion_id, messages, params):
         
         response.tool_messages = tool_messages
 
-    return JSONResponse(content=response.dict())
+    return JSONResponse(content=response.dict(exclude_none=True))
 
-async def stream_completion(completion_id, messages, params={"include_tool_messages": None, "max_tokens": None, "temperature": None}, faqtivGlobals=None):
-    async for event in _stream_completion(completion_id, messages, params, faqtivGlobals):
+async def stream_completion(completion_id, messages, params={"include_tool_messages": None, "max_tokens": None, "temperature": None}, faqtivGlobals=None, session=None):
+    async for event in _stream_completion(completion_id, messages, params, faqtivGlobals, session):
         yield event
 
-async def _stream_completion(completion_id, messages, params, faqtivGlobals=None):
+async def _stream_completion(completion_id, messages, params, faqtivGlobals=None, session=None):
     includeToolMessages = bool(params.get("include_tool_messages"))
     completion_options = set_options_from_env(params)
 
-    llm = ChatOpenAI(
-        api_key=api_key,
-        model=model,
-        **completion_options
-    ).bind_tools(completion_tools)
+    llm = create_chat_model(**completion_options).bind_tools(get_tool_registry().openai_tools)
     completion_chain = completion_prompt.pipe(llm)
 
     current_time = int(time.time())
-    conversation = get_conversation_from_messages_request(messages)
+    turn_start = len(session.messages) if session else 0
+    tool_results_messages = []
+    turn_saved = False
+
+    def stream_chain(input_data):
+        # streaming completions are interactive, they go ahead of other requests waiting for the model
+        estimated_tokens = estimate_conversation_tokens(input_data["conversation"], completion_options.get("max_tokens"))
+        return llm_scheduler.stream(
+            lambda: completion_chain.astream_events(input_data, version="v2"),
+            PRIORITY_INTERACTIVE,
+            estimated_tokens,
+            is_output=is_streamed_content,
+            get_item_usage=get_event_usage,
+            usage_name=f'completion.{model}'
+        )
 
     async def process_request(input_data):
         try:
-            async for event in completion_chain.astream_events(input_data, version="v2"):
-                yield event
+            # closed as soon as the consumer stops, so the scheduler slot isn't held while tools run
+            async with contextlib.aclosing(stream_chain(input_data)) as events:
+                async for event in events:
+                    yield event
         except Exception as e:
             error_message = str(e)
             if "context length" in error_message.lower() or "too many tokens" in error_message.lower():
@@ -295,25 +433,24 @@ async def _stream_completion(completion_id, messages, params, faqtivGlobals=None
                     f"Error: The tool returned too much data. "
                     "Please try to be more specific or choose a different approach that requires less data."
                 )
-                # Find the longest tool call result
-                tool_messages = [msg for msg in input_data["conversation"] if isinstance(msg, ToolMessage)]
-                if tool_messages:
-                    longest_tool_message = max(tool_messages, key=lambda x: len(x.content))
-                    # Modify the content of the longest tool message
-                    longest_tool_message.content = error_response
+                # the messages can be cached by a session, the longest tool result is replaced in a copy of the conversation
+                trimmed_conversation = replace_longest_tool_result(input_data["conversation"], error_response)
 
                 # Retry with the updated conversation
                 retry_input = {
-                    "conversation": input_data["conversation"] + [
+                    "conversation": trimmed_conversation + [
                         HumanMessage(content="The previous tool call returned too much data. Please adjust your approach and try again.")
                     ]
                 }
-                async for retry_event in completion_chain.astream_events(retry_input, version="v2"):
-                    yield retry_event
+                async with contextlib.aclosing(stream_chain(retry_input)) as retry_events:
+                    async for retry_event in retry_events:
+                        yield retry_event
             else:
                 raise
 
     try:
+        # in the try so the rollback also drops the messages appended before one that can't be converted
+        conversation = get_conversation(messages, session)
         insert_newline = False
         while True:
             events = process_request({"conversation": conversation})
@@ -345,8 +482,11 @@ async def _stream_completion(completion_id, messages, params, faqtivGlobals=None
                 elif event['event'] == 'on_chain_end':
                     if event['data']['output'].additional_kwargs.get('tool_calls'):
                         tool_calls = event['data']['output'].additional_kwargs['tool_calls']
+                        # the model request is done, closing the stream frees its scheduler slot for the tools' own requests
+                        await events.aclose()
                         tool_messages = await process_tool_calls(tool_calls, faqtivGlobals)
                         conversation.extend(tool_messages)
+                        tool_results_messages.extend(tool_messages)
                         has_tool_calls = True
                         insert_newline = True # set flag to insert newline before next tokens
 
@@ -368,7 +508,14 @@ async def _stream_completion(completion_id, messages, params, faqtivGlobals=None
                                         "choices": [{'index': 0, 'delta': openai_message, 'finish_reason': None}],
                                     }   
                                     yield f"data: {json.dumps(message_chunk)}\n\n"
+
+                        # the stream was closed above, the next turn starts a new one
+                        break
                     else:
+                        if session:
+                            await save_session_turn(session, tool_results_messages + [AIMessage(content=event['data']['output'].content)])
+                            turn_saved = True
+
                         final_chunk = {
                             'id': completion_id,
                             'object': 'chat.completion.chunk',
@@ -402,6 +549,10 @@ async def _stream_completion(completion_id, messages, params, faqtivGlobals=None
         }
         yield f"data: {json.dumps(error_chunk)}\n\n"
         yield "data: [DONE]\n\n"
+    finally:
+        # failed or cancelled turns are not kept, the client can send the same messages again
+        if session and not turn_saved:
+            session.rollback(turn_start)
 
 def set_options_from_env(options):
     completion_options = {}
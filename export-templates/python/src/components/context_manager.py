@@ -1,4 +1,3 @@
-import tiktoken
 from typing import List
 from threading import Lock
 from components.types import Message
@@ -6,18 +5,31 @@ from components.types import Message
 encoder_cache = {}
 encoder_mutex = Lock()
 
+# Context window by model name, the longest name contained in the model wins, e.g. gpt-4o-mini uses gpt-4o
 model_limits = {
     'gpt-3.5': 16000,
+    'gpt-4': 8192,
+    'gpt-4-turbo': 128000,
     'gpt-4o': 128000,
     'gpt-4o-2024-11-20': 128000,
+    'gpt-4.1': 1000000,
+    'o1': 200000,
+    'o3': 200000,
+    'o4-mini': 200000,
     'sonar': 127000
 }
 
 def create_encoder(model_name):
+    # imported on first use to keep it out of the startup time
+    import tiktoken
     # todo: figure out support for gpt-4o-2024-11-20
     model = 'gpt-4o' if 'gpt-4o' in model_name else model_name
     if 'gpt-4' in model_name or 'gpt-3.5' in model_name:
-        return tiktoken.encoding_for_model(model)
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # models newer than the installed tiktoken, e.g. when a stage is routed to one
+            return tiktoken.get_encoding('o200k_base')
     return tiktoken.get_encoding('cl100k_base')
 
 # Using Lock to prevent race conditions
@@ -36,7 +48,8 @@ def get_tokens(model_name, text):
     return len(encoder_data['encoder'].encode(text))
 
 def get_model_limit(model):
-    return next((limit for key, limit in model_limits.items() if key in model), model_limits['gpt-4o'])
+    matches = [key for key in model_limits if key in model]
+    return model_limits[max(matches, key=len)] if matches else model_limits['gpt-4o']
 
 def is_assistant_with_tool_calls(message):
     return message.role == 'assistant' and message.tool_calls
@@ -44,13 +57,17 @@ def is_assistant_with_tool_calls(message):
 # Get the messages that fit within the context limit
 # This function is used to truncate the messages to fit within the context limit
 # Prioritizes user messages and assistant messages over tool messages
-def get_messages_within_context_limit(model: str, messages: List[Message]) -> List[Message]:
+# count_tokens can return cached token counts, e.g. the ones kept by sessions
+def get_messages_within_context_limit(model: str, messages: List[Message], count_tokens=None) -> List[Message]:
     context_limit = get_model_limit(model)
     if not context_limit:
         raise ValueError(f"Unknown context limit for model {model}")
     if not messages:
         return messages
 
+    if count_tokens is None:
+        count_tokens = lambda message: get_tokens(model, message.content or '')
+
     total_tokens = 0
 
     # Copy the original messages list
@@ -66,7 +83,7 @@ def get_messages_within_context_limit(model: str, messages: List[Message]) -> Li
             message.role == 'user' or
             (message.role == 'assistant' and not is_assistant_with_tool_calls(message))
         ):
-            tokens = get_tokens(model, message.content or '')
+            tokens = count_tokens(message)
             if total_tokens + tokens <= context_limit:
                 total_tokens += tokens
                 i -= 1
@@ -121,7 +138,7 @@ def get_messages_within_context_limit(model: str, messages: List[Message]) -> Li
             block_tokens = 0
             for j in range(block_start_index, block_end_index + 1):
                 block_message = messages_copy[j]
-                tokens = get_tokens(model, block_message.content or '')
+                tokens = count_tokens(block_message)
                 block_tokens += tokens
 
             if total_tokens + block_tokens <= context_limit:
@@ -1,58 +1,420 @@
 import os
+import re
 import json
+import time
 import base64
-import numpy as np
-from langchain_openai import OpenAIEmbeddings
+import asyncio
+import hashlib
+import threading
 from typing import List, Dict
-from langchain_community.vectorstores import FAISS
 from constants import IS_LAMBDA
+from components.metrics import increment, observe
+from components.lexical_index import BM25Index
+from components.context_manager import get_tokens
+from components.model_router import get_stage_model
+from components.llm_scheduler import llm_scheduler, estimate_tokens, PRIORITY_DEFAULT, PRIORITY_BACKGROUND
 
-# Initialize embeddings
-embeddings = OpenAIEmbeddings(model="text-embedding-ada-002")
+examples_directory = os.path.join(os.getenv('LAMBDA_TASK_ROOT', '/var/task'), 'examples') if IS_LAMBDA else os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+# The stored example embeddings were created with this model, queries have to use the same one
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_DIMENSION = 1536
+
+# Successful ad-hoc tasks are added to the example index, they are kept in memory only
+AUTO_ADD_EXAMPLES = os.getenv('AUTO_ADD_EXAMPLES', 'false').lower() == 'true'
+# Added examples kept at most, the ones that were retrieved least recently are evicted first
+AUTO_EXAMPLES_MAX = int(os.getenv('AUTO_EXAMPLES_MAX', 200))
+# Tasks at least this similar to an example already in the index are not added
+AUTO_EXAMPLES_DEDUP_SIMILARITY = float(os.getenv('AUTO_EXAMPLES_DEDUP_SIMILARITY', 0.97))
+# Seconds between checks of the examples directory for added, changed and removed files, 0 to disable
+EXAMPLES_WATCH_INTERVAL = float(os.getenv('EXAMPLES_WATCH_INTERVAL', 0 if IS_LAMBDA else 10))
+
+# Vector index of the example tasks: "flat" is exact, "ivf" and "hnsw" are approximate and scale to large libraries,
+# see components/vector_index.py
+EXAMPLES_INDEX = os.getenv('EXAMPLES_INDEX', 'flat').lower()
+# "sq8" stores the vectors in 8 bits per dimension, "pq" in 64 bytes, "none" keeps the float32 vectors
+EXAMPLES_INDEX_QUANTIZATION = os.getenv('EXAMPLES_INDEX_QUANTIZATION', 'none').lower()
+# Lists of an IVF index and candidates of an HNSW index visited by each search, more is slower with better recall
+EXAMPLES_IVF_PROBES = int(os.getenv('EXAMPLES_IVF_PROBES', 16))
+EXAMPLES_HNSW_EF_SEARCH = int(os.getenv('EXAMPLES_HNSW_EF_SEARCH', 64))
+# Where --build-examples-index writes the index, it's loaded from there on start when it exists
+EXAMPLES_INDEX_DIRECTORY = os.getenv('EXAMPLES_INDEX_DIRECTORY', os.path.join(examples_directory, 'index'))
+INDEX_VECTORS_FILE = 'vectors.faiss'
+INDEX_STATE_FILE = 'examples.json'
+
+# "hybrid" ranks the examples by vector similarity and BM25 score of the task within a token budget,
+# "vector" takes the k most similar ones whatever their size
+EXAMPLES_SELECTION = os.getenv('EXAMPLES_SELECTION', 'hybrid').lower()
+# Weight of the vector similarity in the hybrid score, the BM25 score gets the rest
+EXAMPLES_VECTOR_WEIGHT = float(os.getenv('EXAMPLES_VECTOR_WEIGHT', 0.7))
+# Examples less similar to the task than this are not used, cosine similarity, unrelated texts are still around 0.7 with ada-002
+EXAMPLES_MIN_SIMILARITY = float(os.getenv('EXAMPLES_MIN_SIMILARITY', 0.75))
+# Examples at least this similar to one that was already selected add nothing, cosine similarity of their tasks
+EXAMPLES_DEDUP_SIMILARITY = float(os.getenv('EXAMPLES_DEDUP_SIMILARITY', 0.95))
+# Tokens of the selected examples, task and code, 0 for no limit
+EXAMPLES_TOKEN_BUDGET = int(os.getenv('EXAMPLES_TOKEN_BUDGET', 2000))
+# Candidates taken from each of the vector and BM25 searches for every example selected
+CANDIDATES_PER_EXAMPLE = 3
+
+# Added examples waiting to be embedded are embedded together, in batches up to this size
+PROMOTION_BATCH_SIZE = 16
+PROMOTION_QUEUE_MAX = 100
+
+# The example index is built on first use, numpy, FAISS and the embeddings client are only imported then
+examples_with_embeddings = None
+embeddings = None
+example_index = None
+# task and code of the examples by id, the vector index only has their vectors
+documents = {}
+# the index is changed by the directory watcher and the added examples while requests search it
+index_mutex = threading.RLock()
+# id and modification time of the example files in the index
+indexed_files = {}
+# last time each added example was retrieved, in insertion order
+auto_examples = {}
+# BM25 index of the example tasks and code, by the same ids
+lexical_index = BM25Index()
+# token counts of the examples by id
+example_tokens = {}
+pending_examples = {}
+promotion_task = None
+watcher_thread = None
 
 def decode_base64_embedding(b64_string):
+    import numpy as np
     decoded_bytes = base64.b64decode(b64_string)
     return np.frombuffer(decoded_bytes, dtype=np.float32)
 
-examples_directory = os.path.join('/var/task/examples' if IS_LAMBDA else os.path.dirname(__file__), '..', 'examples')
-examples_with_embeddings = []
+def list_example_files():
+    return {
+        filename: os.path.getmtime(os.path.join(examples_directory, filename))
+        for filename in os.listdir(examples_directory) if filename.endswith('.json')
+    }
+
+def read_example_file(filename):
+    with open(os.path.join(examples_directory, filename), 'r') as f:
+        return json.load(f)
+
+def load_examples():
+    global examples_with_embeddings
+    if examples_with_embeddings is None:
+        loaded_examples = []
+        for filename in os.listdir(examples_directory):
+            if filename.endswith('.json'):
+                loaded_examples.append(read_example_file(filename))
+        examples_with_embeddings = loaded_examples
+    return examples_with_embeddings
+
+def get_embeddings():
+    global embeddings
+    if embeddings is None:
+        from langchain_openai import OpenAIEmbeddings
+        # retries go through the LLM scheduler
+        embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL, max_retries=0)
+    return embeddings
+
+def get_file_example_id(filename):
+    return f'file:{filename}'
+
+def get_lexical_text(document):
+    return f"{document['task']}\n{document['code']}"
+
+def get_index_config():
+    return f'{EXAMPLES_INDEX}/{EXAMPLES_INDEX_QUANTIZATION}'
+
+def create_vector_index():
+    from components.vector_index import VectorIndex
+    return VectorIndex(EMBEDDING_DIMENSION, EXAMPLES_INDEX, EXAMPLES_INDEX_QUANTIZATION, EXAMPLES_IVF_PROBES, EXAMPLES_HNSW_EF_SEARCH)
+
+def read_example_entries(files):
+    entries = []
+    for filename in files:
+        example = read_example_file(filename)
+        entries.append((get_file_example_id(filename), example['document'], decode_base64_embedding(example['taskEmbedding'])))
+    return entries
+
+def build_example_index(entries):
+    # replaces the whole index, the entries are (example id, document, task embedding)
+    global example_index, lexical_index
+    with index_mutex:
+        index = create_vector_index()
+        index.build([example_id for example_id, _, _ in entries], [embedding for _, _, embedding in entries])
+        example_index = index
+        lexical_index = BM25Index()
+        documents.clear()
+        example_tokens.clear()
+        auto_examples.clear()
+        for example_id, document, _ in entries:
+            documents[example_id] = {'task': document['task'], 'code': document['code']}
+            lexical_index.add(example_id, get_lexical_text(document))
+    return example_index
+
+def save_example_index():
+    # builds the index from the example files and writes it with the documents, so large libraries aren't indexed on every start
+    files = list_example_files()
+    with index_mutex:
+        index = build_example_index(read_example_entries(files))
+        os.makedirs(EXAMPLES_INDEX_DIRECTORY, exist_ok=True)
+        state = {
+            'config': get_index_config(),
+            'index': index.save(os.path.join(EXAMPLES_INDEX_DIRECTORY, INDEX_VECTORS_FILE)),
+            'documents': documents,
+            # copying the files when deploying changes their modification times, the sizes tell which ones changed
+            'files': {filename: os.path.getsize(os.path.join(examples_directory, filename)) for filename in files}
+        }
+        with open(os.path.join(EXAMPLES_INDEX_DIRECTORY, INDEX_STATE_FILE), 'w') as f:
+            json.dump(state, f)
+    return index
+
+def load_example_index():
+    # loads the index written by save_example_index, the example files added, removed or changed since are applied to it
+    global example_index, lexical_index
+    state_path = os.path.join(EXAMPLES_INDEX_DIRECTORY, INDEX_STATE_FILE)
+    if not os.path.exists(state_path):
+        return False
+    with open(state_path, 'r') as f:
+        state = json.load(f)
+    if state['config'] != get_index_config():
+        print(f"The example index in {EXAMPLES_INDEX_DIRECTORY} was built as {state['config']}, building it as {get_index_config()}", flush=True)
+        return False
+
+    index = create_vector_index()
+    index.load(os.path.join(EXAMPLES_INDEX_DIRECTORY, INDEX_VECTORS_FILE), state['index'])
+    example_index = index
+    lexical_index = BM25Index()
+    documents.clear()
+    documents.update(state['documents'])
+    for example_id, document in documents.items():
+        lexical_index.add(example_id, get_lexical_text(document))
+
+    files = list_example_files()
+    for filename, size in state['files'].items():
+        unchanged = filename in files and os.path.getsize(os.path.join(examples_directory, filename)) == size
+        indexed_files[filename] = files[filename] if unchanged else None
+    sync_example_files()
+    return True
+
+def get_example_index():
+    with index_mutex:
+        if example_index is None:
+            if not load_example_index():
+                files = list_example_files()
+                # examples can still be added at runtime when there are no files
+                build_example_index(read_example_entries(files))
+                indexed_files.update(files)
+            start_watcher()
+    return example_index
+
+def add_example(example_id, document, embedding, source='runtime'):
+    # adds an example to the index or replaces the one with the same id
+    with index_mutex:
+        get_example_index().add(example_id, embedding)
+        documents[example_id] = {'task': document['task'], 'code': document['code']}
+        lexical_index.add(example_id, get_lexical_text(document))
+        example_tokens.pop(example_id, None)
+    increment(f'examples.added.{source}')
+
+def remove_example(example_id):
+    with index_mutex:
+        # forgotten even when it's no longer indexed, the eviction loop relies on it
+        auto_examples.pop(example_id, None)
+        if not get_example_index().remove(example_id):
+            return False
+        documents.pop(example_id, None)
+        lexical_index.remove(example_id)
+        example_tokens.pop(example_id, None)
+    increment('examples.removed')
+    return True
 
-for filename in os.listdir(examples_directory):
-    if filename.endswith('.json'):
-        with open(os.path.join(examples_directory, filename), 'r') as f:
-            examples_with_embeddings.append(json.load(f))
+def sync_example_files():
+    # picks up the example files that were added, changed or removed since the index was built
+    files = list_example_files()
+    for filename, modified_at in files.items():
+        if indexed_files.get(filename) == modified_at:
+            continue
+        try:
+            example = read_example_file(filename)
+            add_example(get_file_example_id(filename), example['document'], decode_base64_embedding(example['taskEmbedding']), 'file')
+        except (OSError, ValueError, KeyError) as e:
+            # a file that's still being written is read again with the next check
+            print(f"Failed to load example {filename}: {e}", flush=True)
+            continue
+        indexed_files[filename] = modified_at
 
-# Create vector store from pre-computed embeddings
-texts = [json.dumps({**example['document'], 'embedding': None}) for example in examples_with_embeddings]
-embeddings_list = [decode_base64_embedding(example['taskEmbedding']) for example in examples_with_embeddings]
-metadatas = [{}] * len(examples_with_embeddings)
+    for filename in set(indexed_files) - set(files):
+        remove_example(get_file_example_id(filename))
+        del indexed_files[filename]
 
-# Convert list of numpy arrays to 2D numpy array
-embeddings_array = np.array(embeddings_list)
+def start_watcher():
+    global watcher_thread
+    if EXAMPLES_WATCH_INTERVAL <= 0 or watcher_thread is not None:
+        return
 
-vector_store = FAISS.from_embeddings(
-    text_embeddings=list(zip(texts, embeddings_list)),
-    embedding=embeddings,
-    metadatas=metadatas
-)
+    def watch():
+        while True:
+            time.sleep(EXAMPLES_WATCH_INTERVAL)
+            try:
+                sync_example_files()
+            except Exception as e:
+                print(f"Failed to check the examples directory: {e}", flush=True)
+
+    watcher_thread = threading.Thread(target=watch, name='examples-watcher', daemon=True)
+    watcher_thread.start()
+
+def normalize_task(task):
+    return re.sub(r'\s+', ' ', task).strip().lower()
+
+def get_auto_example_id(task):
+    return f"auto:{hashlib.sha1(normalize_task(task).encode()).hexdigest()[:16]}"
+
+def queue_example(task, code):
+    # called with every successful ad-hoc task, the examples are embedded and added in the background
+    global promotion_task
+    if not AUTO_ADD_EXAMPLES:
+        return
+
+    example_id = get_auto_example_id(task)
+    if example_id in auto_examples or example_id in pending_examples or len(pending_examples) >= PROMOTION_QUEUE_MAX:
+        return
+    pending_examples[example_id] = {'task': task, 'code': code}
+
+    if promotion_task is None or promotion_task.done():
+        promotion_task = asyncio.create_task(promote_pending_examples())
+
+async def promote_pending_examples():
+    while pending_examples:
+        batch = list(pending_examples.items())[:PROMOTION_BATCH_SIZE]
+        texts = [document['task'].replace("\n", " ") for _, document in batch]
+        try:
+            # it's optional work, it waits behind the requests of users
+            vectors = await llm_scheduler.run(
+                lambda: get_embeddings().aembed_documents(texts), PRIORITY_BACKGROUND, estimate_tokens(texts, 0), usage_name=f'embedding.{EMBEDDING_MODEL}'
+            )
+            await asyncio.to_thread(add_auto_examples, batch, vectors)
+        except Exception as e:
+            print(f"Failed to add examples: {e}", flush=True)
+        finally:
+            for example_id, _ in batch:
+                pending_examples.pop(example_id, None)
+
+def add_auto_examples(batch, vectors):
+    for (example_id, document), vector in zip(batch, vectors):
+        with index_mutex:
+            nearest = get_example_index().search(vector, 1)
+            if nearest and nearest[0][1] >= AUTO_EXAMPLES_DEDUP_SIMILARITY:
+                increment('examples.auto.duplicates')
+                continue
+
+            add_example(example_id, document, vector, 'auto')
+            auto_examples[example_id] = time.time()
+            evict_auto_examples()
+
+def evict_auto_examples():
+    # the added examples that weren't retrieved for the longest time go first, the example files are never evicted
+    while len(auto_examples) > AUTO_EXAMPLES_MAX:
+        stale_id = min(auto_examples, key=auto_examples.get)
+        remove_example(stale_id)
+        increment('examples.auto.evicted')
 
 def get_embedding(text):
     text = text.replace("\n", " ")
-    return embeddings.embed_query(text)
+    return get_embeddings().embed_query(text)
 
 def get_relevant_examples(query: str, k: int = 10) -> List[Dict]:
     # Generate embedding for the query using the same model as stored embeddings
     query_embedding = get_embedding(query)
- 
-    # Perform vector search
-    results = vector_store.similarity_search_by_vector(query_embedding, k=k)
+    return search_examples(query_embedding, k, query)
+
+# Same as get_relevant_examples, the query embedding request goes through the LLM scheduler
+async def get_relevant_examples_async(query: str, k: int = 10, priority=PRIORITY_DEFAULT) -> List[Dict]:
+    text = query.replace("\n", " ")
+    query_embedding = await llm_scheduler.run(
+        lambda: get_embeddings().aembed_query(text), priority, estimate_tokens([text], 0), usage_name=f'embedding.{EMBEDDING_MODEL}'
+    )
+    return search_examples(query_embedding, k, query)
+
+def search_examples(query_embedding, k, query=None):
+    with index_mutex:
+        if EXAMPLES_SELECTION == 'hybrid':
+            example_ids = select_examples(query_embedding, k, query)
+        else:
+            # Perform vector search
+            example_ids = [example_id for example_id, _ in get_example_index().search(query_embedding, k)]
+        selected = [documents[example_id] for example_id in example_ids]
+
+        # under the lock, an example evicted after this search must not get its timestamp back
+        now = time.time()
+        for example_id in example_ids:
+            if example_id in auto_examples and example_id in documents:
+                auto_examples[example_id] = now
 
     relevant_examples = []
-    for doc in results:
-        example = json.loads(doc.page_content)
+    for document in selected:
         relevant_examples.append({
-            "task": example["task"],
-            "code": example["code"]
+            "task": document["task"],
+            "code": document["code"]
         })
-    
-    return relevant_examples
\ No newline at end of file
+
+    return relevant_examples
+
+def get_example_tokens(example_id):
+    if example_id not in example_tokens:
+        document = documents[example_id]
+        # counted with the tokenizer of the model the examples are sent to
+        model_name = get_stage_model('adhoc')
+        example_tokens[example_id] = get_tokens(model_name, document['task']) + get_tokens(model_name, document['code'])
+    return example_tokens[example_id]
+
+# Ranks the candidates of the vector and BM25 searches by a weighted score, drops the ones that aren't relevant enough
+# or repeat a selected one, and fills the token budget with the best ones, at most k
+def select_examples(query_embedding, k, query=None):
+    import numpy as np
+    index = get_example_index()
+    candidate_count = k * CANDIDATES_PER_EXAMPLE
+    candidate_ids = [example_id for example_id, _ in index.search(query_embedding, candidate_count)]
+    lexical_scores = dict((example_id, score) for score, example_id in lexical_index.search(query, candidate_count)) if query else {}
+    # examples that share words with the task but weren't among the most similar vectors
+    vector_ids = set(candidate_ids)
+    candidate_ids += [example_id for example_id in lexical_scores if example_id not in vector_ids]
+    if not candidate_ids:
+        return []
+
+    vectors = index.get_vectors(candidate_ids)
+    query_vector = np.asarray(query_embedding, dtype=np.float32)
+    similarities = vectors @ (query_vector / max(np.linalg.norm(query_vector), 1e-12))
+    max_lexical_score = max(lexical_scores.values(), default=0) or 1
+    scores = [
+        EXAMPLES_VECTOR_WEIGHT * similarity + (1 - EXAMPLES_VECTOR_WEIGHT) * lexical_scores.get(example_id, 0) / max_lexical_score
+        for example_id, similarity in zip(candidate_ids, similarities)
+    ]
+
+    # similarities of the candidate tasks between them, for the near duplicates
+    pairwise_similarities = vectors @ vectors.T
+    selected = []
+    selected_positions = []
+    used_tokens = 0
+    for rank, position in enumerate(sorted(range(len(candidate_ids)), key=lambda i: scores[i], reverse=True)):
+        if len(selected) >= k:
+            break
+        # the best one is kept anyway, the model needs at least one example of how the functions are called,
+        # when it doesn't fit in the budget the next ones still need to be similar enough
+        if rank > 0 and similarities[position] < EXAMPLES_MIN_SIMILARITY:
+            increment('examples.skipped.irrelevant')
+            continue
+        if selected_positions and pairwise_similarities[position, selected_positions].max() >= EXAMPLES_DEDUP_SIMILARITY:
+            increment('examples.skipped.duplicate')
+            continue
+
+        tokens = get_example_tokens(candidate_ids[position])
+        if EXAMPLES_TOKEN_BUDGET and used_tokens + tokens > EXAMPLES_TOKEN_BUDGET:
+            # a smaller one further down can still fit
+            increment('examples.skipped.budget')
+            continue
+
+        selected.append(candidate_ids[position])
+        selected_positions.append(position)
+        used_tokens += tokens
+
+    observe('examples.selected', len(selected))
+    observe('examples.tokens', used_tokens)
+    return selected
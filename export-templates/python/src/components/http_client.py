@@ -0,0 +1,129 @@
+import os
+import random
+import asyncio
+import weakref
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared HTTP clients injected into the agent functions namespace as httpClient and asyncHttpClient
+HTTP_TIMEOUT = int(os.getenv('HTTP_TIMEOUT', 30000)) / 1000
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 3))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+HTTP_BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', 0.5))
+
+# The OpenAI clients share one pool per event loop, with enough kept alive connections for the requests the LLM
+# scheduler lets through and the OpenAI SDK's default timeouts, the SDK would take HTTP_TIMEOUT from the client
+OPENAI_POOL_SIZE = int(os.getenv('LLM_MAX_CONCURRENCY', 32))
+OPENAI_TIMEOUT = httpx.Timeout(600, connect=5)
+
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# Only requests that can be safely repeated are retried after a response
+RETRY_METHODS = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+
+class HttpClient(requests.Session):
+    """requests session with keep-alive connection pools per host, a default timeout and retries with backoff."""
+    def __init__(self, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, pool_size=HTTP_POOL_SIZE):
+        super().__init__()
+        self.timeout = timeout
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=HTTP_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=RETRY_METHODS,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        # pool_connections is the number of hosts with a cached pool, pool_maxsize the connections kept per host
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+class AsyncHttpClient:
+    """httpx based client for async functions, same defaults as HttpClient, with one connection pool per event loop."""
+    def __init__(self, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, pool_size=HTTP_POOL_SIZE):
+        self.timeout = timeout
+        self.retries = retries
+        self.limits = httpx.Limits(max_keepalive_connections=pool_size, max_connections=pool_size * 10)
+        self.clients = weakref.WeakKeyDictionary()
+
+    def get_client(self):
+        # httpx clients can't be shared between event loops, e.g. async functions run from worker threads
+        loop = asyncio.get_running_loop()
+        client = self.clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits, follow_redirects=True)
+            self.clients[loop] = client
+        return client
+
+    async def aclose(self):
+        # closes the pool of the running event loop, a later request on the loop opens a new one
+        client = self.clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    def get_retry_delay(self, attempt, response=None):
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return HTTP_BACKOFF_FACTOR * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    async def request(self, method, url, **kwargs):
+        client = self.get_client()
+        method = method.upper()
+
+        for attempt in range(self.retries + 1):
+            is_last_attempt = attempt == self.retries
+            try:
+                response = await client.request(method, url, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                # the request was never sent so it's safe to retry any method
+                if is_last_attempt:
+                    raise
+                await asyncio.sleep(self.get_retry_delay(attempt))
+                continue
+
+            if is_last_attempt or response.status_code not in RETRY_STATUSES or method not in RETRY_METHODS:
+                return response
+
+            await asyncio.sleep(self.get_retry_delay(attempt, response))
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request('PUT', url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request('DELETE', url, **kwargs)
+
+http_client = HttpClient()
+async_http_client = AsyncHttpClient()
+openai_http_client = AsyncHttpClient(timeout=OPENAI_TIMEOUT, pool_size=OPENAI_POOL_SIZE)
+
+async def close_clients():
+    # the pools of an event loop keep their connections open until they are closed, before the loop is closed
+    await async_http_client.aclose()
+    await openai_http_client.aclose()
+
+def run_in_new_loop(coroutine):
+    """asyncio.run that closes the connection pools opened on its event loop before the loop is closed."""
+    async def run_and_close():
+        try:
+            return await coroutine
+        finally:
+            await close_clients()
+
+    return asyncio.run(run_and_close())
@@ -2,6 +2,8 @@ import os
 import uuid
 import json
 import asyncio
+import threading
+import contextlib
 from typing import Callable
 import uvicorn
 from starlette.responses import Response
@@ -10,13 +12,20 @@ from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from constants import TASK_NAME_TO_FUNCTION_NAME_MAP, TASKS
-from components.completions import stream_completion, generate_completion
+from components.completions import stream_completion, generate_completion, get_session_store
 from components.logger import log, log_err
 from components.tools import capture_and_process_output, generate_and_execute_adhoc
 from components.agent_gateway import AgentGateway
 from components.types import CompletionRequest
+from components.metrics import get_metrics
+from components.single_flight import SingleFlight
+from components.profiler import PROFILING_ENABLED, start_profile, finish_profile, set_profile_id
+from components.warmup import warm_up, is_ready, warmup_durations
+from components.http_client import close_clients
 import time
 
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 8))
+
 class StreamWriter:
     def __init__(self, completion_id: str, response_writer: Callable[[str], None]):
         self.completion_id = completion_id
@@ -56,7 +65,81 @@ class StreamWriter:
         }
         self.response_writer(f"data: {json.dumps(chunk)}\n\n")
 
-app = FastAPI()
+# streamWriter used by the run_task and run_adhoc event streams, every write is a named SSE event
+class TaskEventWriter:
+    def __init__(self, response_writer: Callable[[str], None]):
+        self.response_writer = response_writer
+
+    def writeEvent(self, data: str, model: str = None):
+        self.writeProgress("agent-message", {"content": data})
+
+    def writeRaw(self, data: str, model: str = None):
+        self.writeProgress("raw", {"content": data})
+
+    def writeProgress(self, event: str, data: dict):
+        self.response_writer(f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n")
+
+def create_queue_writer(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    loop_thread = threading.get_ident()
+
+    # streamWriter can be called from task worker threads and asyncio queues are not thread safe,
+    # writes on the loop thread go straight to the queue so they keep their order with the other chunks
+    def write_chunk(chunk):
+        if threading.get_ident() == loop_thread:
+            queue.put_nowait(chunk)
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, chunk)
+
+    return write_chunk
+
+def is_streaming_request(data, raw_request: Request):
+    return bool(data.get("stream")) or raw_request.headers.get('accept') == 'text/event-stream'
+
+def stream_task_events(command, event, log_body, run):
+    async def event_stream():
+        queue = asyncio.Queue()
+        write_chunk = create_queue_writer(queue)
+        writer = TaskEventWriter(write_chunk)
+
+        async def execute():
+            try:
+                result = await run(writer)
+                writer.writeProgress("result", {"result": result})
+            except Exception as e:
+                log_err(command, event, log_body, e)
+                writer.writeProgress("error", {"error": str(e) or type(e).__name__})
+            finally:
+                write_chunk(None)  # Special marker for stream end
+
+        writer.writeProgress("start", {"id": log_body['id']})
+        execute_task = asyncio.create_task(execute())
+
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            if not execute_task.done():
+                execute_task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # the server accepts connections while it warms up, /readyz tells load balancers when to send traffic
+    warmup_task = asyncio.create_task(warm_up())
+    yield
+    warmup_task.cancel()
+    await close_clients()
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -72,53 +155,203 @@ async def increase_request_body_size(request: Request, call_next):
     response = await call_next(request)
     return response
 
+# Only the agent pipeline endpoints can be profiled, the middleware is not added at all when profiling is off
+PROFILED_PATHS = ('/completions', '/run_task', '/run_adhoc')
+
+if PROFILING_ENABLED:
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        profile = start_profile(request.headers, request.query_params) if request.url.path.startswith(PROFILED_PATHS) else None
+        if not profile:
+            return await call_next(request)
+
+        try:
+            response = await call_next(request)
+        except BaseException:
+            finish_profile(profile)
+            raise
+
+        # streaming responses keep running after the headers are sent, the profile ends with the body
+        body_iterator = response.body_iterator
+
+        async def profiled_body():
+            try:
+                async for chunk in body_iterator:
+                    yield chunk
+            finally:
+                await asyncio.to_thread(finish_profile, profile)
+
+        response.body_iterator = profiled_body()
+        response.headers['X-Profile-Id'] = profile.id
+        return response
+
 @app.post("/run_adhoc")
 async def run_adhoc_endpoint(request: Request):
     data = await request.json()
     user_input = data["input"]
     request_id = f"run-adhoc-{uuid.uuid4()}"
-    log('run_adhoc', 'run_adhoc', {'id': request_id, **data})
+    set_profile_id(request_id)
+    # the delegation token is a credential, the logs only say whether there was one
+    log_body = {'id': request_id, **data, 'delegation_token': True if data.get("delegation_token") else False}
+    log('run_adhoc', 'run_adhoc', log_body)
+
+    agentGateway = AgentGateway(data.get("delegation_token"))
+
+    if is_streaming_request(data, request):
+        async def run(streamWriter):
+            faqtivGlobals = {"streamWriter": streamWriter, "agentGateway": agentGateway}
+            return await generate_and_execute_adhoc(user_input, faqtivGlobals)
+
+        return stream_task_events('run_adhoc', 'run_adhoc', log_body, run)
     
     try:
-        result = await generate_and_execute_adhoc(user_input)
+        faqtivGlobals = {"streamWriter": None, "agentGateway": agentGateway}
+        result = await generate_and_execute_adhoc(user_input, faqtivGlobals)
         return JSONResponse(content={"result": result})
     except Exception as e:
-        log_err('run_adhoc', 'run_adhoc', {'id': request_id, **data}, e)
+        log_err('run_adhoc', 'run_adhoc', log_body, e)
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+def get_task_function(task_name):
+    valid_task_name = TASK_NAME_TO_FUNCTION_NAME_MAP.get(task_name, task_name)
+    
+    if valid_task_name not in TASKS.__dict__:  # Check if method exists in class
+        return None
+    
+    return getattr(TASKS, valid_task_name)  # Get the static method
+
+# Registered before /run_task/{task_name} so "batch" is not taken as a task name
+@app.post("/run_task/batch")
+async def run_task_batch_endpoint(request: Request):
+    data = await request.json()
+    items = data.get("items")
+    request_id = f"run-task-batch-{uuid.uuid4()}"
+    set_profile_id(request_id)
+
+    if not isinstance(items, list):
+        log_err('run_task', 'batch', {'id': request_id}, 'Invalid items')
+        return JSONResponse(content={"error": "Field 'items' must be a list of {task, args} objects"}, status_code=400)
+
+    concurrency = data.get("concurrency", BATCH_CONCURRENCY)
+    if not isinstance(concurrency, int) or isinstance(concurrency, bool):
+        log_err('run_task', 'batch', {'id': request_id}, 'Invalid concurrency')
+        return JSONResponse(content={"error": "Field 'concurrency' must be an integer"}, status_code=400)
+
+    # the request can lower the concurrency but never go above the configured limit
+    concurrency = max(1, min(concurrency, BATCH_CONCURRENCY))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    log('run_task', 'batch', {'id': request_id, 'count': len(items), 'concurrency': concurrency})
+
+    async def run_item(index, item):
+        task_name = item.get("task") if isinstance(item, dict) else None
+        args = item.get("args", {}) if isinstance(item, dict) else {}
+        item_result = {"index": index, "task": task_name}
+
+        async with semaphore:
+            start = time.perf_counter()
+            # a bad item is reported on its own line, the headers are already sent and the other items keep running
+            try:
+                if not isinstance(task_name, str) or not isinstance(args, dict):
+                    item_result["error"] = "Each item must be a {task, args} object with a task name and an args object"
+                else:
+                    task_function = get_task_function(task_name)
+                    if not task_function:
+                        item_result["error"] = f"Task '{task_name}' not found"
+                    else:
+                        item_result["result"] = await capture_and_process_output(task_function, **args)
+            except Exception as e:
+                log_err('run_task', str(task_name), {'id': request_id, 'index': index, 'args': args}, e)
+                item_result["error"] = str(e) or type(e).__name__
+
+            item_result["duration_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+        return item_result
+
+    async def stream_results():
+        start = time.perf_counter()
+        error_count = 0
+        pending = [asyncio.create_task(run_item(index, item)) for index, item in enumerate(items)]
+
+        try:
+            # one NDJSON line per item in completion order, clients match them by index
+            for completed in asyncio.as_completed(pending):
+                item_result = await completed
+                if "error" in item_result:
+                    error_count += 1
+                yield json.dumps(item_result, default=str) + "\n"
+
+            summary = {
+                "done": True,
+                "count": len(items),
+                "errors": error_count,
+                "duration_ms": round((time.perf_counter() - start) * 1000, 2)
+            }
+            log('run_task', 'batch_done', {'id': request_id, **summary})
+            yield json.dumps(summary) + "\n"
+        finally:
+            for task in pending:
+                if not task.done():
+                    task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+run_task_flights = SingleFlight('run_task')
+
 @app.post("/run_task/{task_name}")
 async def run_task_endpoint(task_name: str, request: Request):
     data = await request.json()
     args = data.get("args", {})
     request_id = f"run-task-{uuid.uuid4()}"
+    set_profile_id(request_id)
+    # the delegation token is a credential, the logs only say whether there was one
+    log_body = {'id': request_id, **data, 'delegation_token': True if data.get("delegation_token") else False}
     
-    log('run_task', task_name, {'id': request_id, **data})
+    log('run_task', task_name, log_body)
     
-    valid_task_name = TASK_NAME_TO_FUNCTION_NAME_MAP.get(task_name, task_name)
+    task_function = get_task_function(task_name)
     
-    if valid_task_name not in TASKS.__dict__:  # Check if method exists in class
-        log_err('run_task', task_name, {'id': request_id, **data}, 'Not found')
+    if not task_function:
+        log_err('run_task', task_name, log_body, 'Not found')
         return {"error": f"Task '{task_name}' not found"}
-    
-    task_function = getattr(TASKS, valid_task_name)  # Get the static method
+
+    agentGateway = AgentGateway(data.get("delegation_token"))
+
+    def run_task(faqtivGlobals):
+        # identical calls share one execution when coalescing is enabled, task aliases map to the same function
+        return run_task_flights.call(
+            [task_function.__name__, args],
+            lambda flight_globals: capture_and_process_output(task_function, faqtivGlobals=flight_globals, **args),
+            faqtivGlobals
+        )
 
     # todo: make sure the args are in the correct positional order
+    if is_streaming_request(data, request):
+        async def run(streamWriter):
+            faqtivGlobals = {"streamWriter": streamWriter, "agentGateway": agentGateway}
+            return await run_task(faqtivGlobals)
+
+        return stream_task_events('run_task', task_name, log_body, run)
+
     try:
-        result = await capture_and_process_output(task_function, **args)
+        faqtivGlobals = {"streamWriter": None, "agentGateway": agentGateway}
+        result = await run_task(faqtivGlobals)
         return {"result": result}
     except Exception as e:
-        log_err('run_task', task_name, {'id': request_id, **data}, e)
+        log_err('run_task', task_name, log_body, e)
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 @app.post("/completions")
 async def completions_endpoint(request: CompletionRequest, raw_request: Request):
     completion_id = f"cmpl-{uuid.uuid4()}"
+    set_profile_id(completion_id)
     messages = request.messages
     include_tool_messages = request.include_tool_messages
     max_tokens = request.max_tokens
     temperature = request.temperature
     stream = request.stream
     delegation_token = request.delegation_token
+    session = await get_session_store().get(request.session_id) if request.session_id else None
 
     log_body = {
         'id': completion_id,
@@ -128,7 +361,8 @@ async def completions_endpoint(request: CompletionRequest, raw_request: Request)
         'max_tokens': max_tokens,
         'temperature': temperature,
         'stream': stream,
-        'delegation_token': True if delegation_token else False
+        'delegation_token': True if delegation_token else False,
+        'session_id': request.session_id
     }
     log('completions', 'completions', log_body)
 
@@ -138,11 +372,15 @@ async def completions_endpoint(request: CompletionRequest, raw_request: Request)
         is_streaming = stream or raw_request.headers.get('accept') == 'text/event-stream'
         if is_streaming:
             async def stream_response():
+                # turns of the same session run one at a time
+                async with session.lock if session else contextlib.nullcontext():
+                    async for chunk in stream_completion_chunks():
+                        yield chunk
+
+            async def stream_completion_chunks():
                 # Create a queue for all events (both completion chunks and emitted events)
                 chunk_queue = asyncio.Queue()
-                
-                def write_chunk(chunk):
-                    chunk_queue.put_nowait(chunk)
+                write_chunk = create_queue_writer(chunk_queue)
 
                 streamWriter = StreamWriter(completion_id, write_chunk)
                 agentGateway = AgentGateway(delegation_token)
@@ -151,7 +389,7 @@ async def completions_endpoint(request: CompletionRequest, raw_request: Request)
                     "agentGateway": agentGateway
                 }
                 completion_task = asyncio.create_task(
-                    stream_chunks(stream_completion(completion_id, messages, params={"include_tool_messages": include_tool_messages, "max_tokens": max_tokens, "temperature": temperature}, faqtivGlobals=faqtivGlobals), chunk_queue)
+                    stream_chunks(stream_completion(completion_id, messages, params={"include_tool_messages": include_tool_messages, "max_tokens": max_tokens, "temperature": temperature}, faqtivGlobals=faqtivGlobals, session=session), write_chunk)
                 )
 
                 try:
@@ -164,21 +402,43 @@ async def completions_endpoint(request: CompletionRequest, raw_request: Request)
                     if not completion_task.done():
                         completion_task.cancel()
                     
-            return StreamingResponse(stream_response(), media_type="text/event-stream")
+            headers = {"X-Session-Id": session.id} if session else None
+            return StreamingResponse(stream_response(), media_type="text/event-stream", headers=headers)
         else:
-            return await generate_completion(completion_id, messages, params={"include_tool_messages": include_tool_messages, "max_tokens": max_tokens, "temperature": temperature})
+            async with session.lock if session else contextlib.nullcontext():
+                return await generate_completion(completion_id, messages, params={"include_tool_messages": include_tool_messages, "max_tokens": max_tokens, "temperature": temperature}, session=session)
     except Exception as e:
         print(f"Error during completion: {e}", flush=True)
         log_err('completions', 'completions', log_body, e)
         raise HTTPException(status_code=500, detail=str(e))
 
-async def stream_chunks(generator, queue):
-    """Helper function to stream chunks from a generator into a queue."""
+@app.delete("/sessions/{session_id}")
+async def delete_session_endpoint(session_id: str):
+    if not await get_session_store().delete(session_id):
+        raise HTTPException(status_code=404, detail=f"Session '{session_id}' not found")
+    return {"deleted": session_id}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return get_metrics()
+
+@app.get("/healthz")
+async def healthz_endpoint():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz_endpoint():
+    if not is_ready():
+        return JSONResponse({"status": "warming_up", "steps": warmup_durations}, status_code=503)
+    return {"status": "ready", "steps": warmup_durations}
+
+async def stream_chunks(generator, write_chunk):
+    """Helper function to stream chunks from a generator through the queue writer of its streamWriter events."""
     try:
         async for chunk in generator:
-            await queue.put(chunk)
+            write_chunk(chunk)
     finally:
-        await queue.put("[DONE]")  # Signal that the stream is complete
+        write_chunk("[DONE]")  # Signal that the stream is complete
 
 shutdown_key = os.getenv('SHUTDOWN_KEY')
 if shutdown_key:
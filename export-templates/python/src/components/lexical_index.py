@@ -0,0 +1,73 @@
+import re
+import math
+import heapq
+from collections import Counter
+
+# BM25 parameters, the usual defaults
+K1 = 1.2
+B = 0.75
+# Words in more than this share of the documents barely change the ranking and are the slowest to score, they're skipped
+MAX_DOCUMENT_FREQUENCY = 0.5
+# in smaller indexes every word is scored
+MIN_DOCUMENTS_TO_SKIP = 20
+
+WORD = re.compile(r'[a-z0-9]+')
+CAMEL_CASE_BOUNDARY = re.compile(r'(?<=[a-z0-9])(?=[A-Z])')
+
+def normalize_word(word):
+    # plurals match their singular, "branches" finds "branch"
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-2] if word.endswith('es') and word[-3] in 'sxz' or word.endswith('ches') or word.endswith('shes') else word[:-1]
+    return word
+
+def tokenize(text):
+    # identifiers in code are split into words too, getBranchBalances matches "branch balances"
+    return [normalize_word(word) for word in WORD.findall(CAMEL_CASE_BOUNDARY.sub(' ', text).lower())]
+
+class BM25Index:
+    """Inverted index of documents by id scored with BM25, documents can be added and removed at any time."""
+    def __init__(self):
+        self.postings = {}
+        self.lengths = {}
+        # words of every document, to remove its postings
+        self.terms = {}
+        self.total_length = 0
+
+    def add(self, document_id, text):
+        if document_id in self.lengths:
+            self.remove(document_id)
+        terms = Counter(tokenize(text))
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, {})[document_id] = frequency
+        self.lengths[document_id] = sum(terms.values())
+        self.terms[document_id] = list(terms)
+        self.total_length += self.lengths[document_id]
+
+    def remove(self, document_id):
+        if document_id not in self.lengths:
+            return
+        self.total_length -= self.lengths.pop(document_id)
+        for term in self.terms.pop(document_id):
+            documents = self.postings[term]
+            del documents[document_id]
+            if not documents:
+                del self.postings[term]
+
+    def search(self, query, k):
+        # the k best (score, id) pairs, only documents with at least one of the query words
+        count = len(self.lengths)
+        if not count:
+            return []
+        average_length = self.total_length / count
+        max_frequency = count * MAX_DOCUMENT_FREQUENCY if count >= MIN_DOCUMENTS_TO_SKIP else count
+        scores = {}
+        for term in set(tokenize(query)):
+            documents = self.postings.get(term)
+            if not documents or len(documents) > max_frequency:
+                continue
+            idf = math.log(1 + (count - len(documents) + 0.5) / (len(documents) + 0.5))
+            for document_id, frequency in documents.items():
+                length = self.lengths[document_id]
+                score = idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average_length))
+                scores[document_id] = scores.get(document_id, 0) + score
+        return heapq.nlargest(k, ((score, document_id) for document_id, score in scores.items()))
@@ -0,0 +1,242 @@
+import os
+import re
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import contextlib
+from components.metrics import increment, observe
+
+# Every chat and embedding request to OpenAI goes through the scheduler below
+
+# Requests running at the same time, the rest wait in the queue by priority
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 32))
+# Tokens per minute that can be sent, prompt and completion tokens together, 0 for no limit
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', 0))
+# Retries of rate limited (429), server error and connection error responses
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 2))
+LLM_BACKOFF_BASE_MS = int(os.getenv('LLM_BACKOFF_BASE_MS', 500))
+LLM_BACKOFF_MAX_MS = int(os.getenv('LLM_BACKOFF_MAX_MS', 60000))
+
+# Lower values run first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_DEFAULT: 'default', PRIORITY_BACKGROUND: 'background'}
+
+# Headers with the time until the rate limits reset, e.g. "20ms", "1s" or "6m0s"
+RATE_LIMIT_RESET_HEADERS = ['x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens']
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+def parse_duration(value):
+    parts = DURATION_PART.findall(value or '')
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts) if parts else None
+
+def get_retry_after(headers):
+    # seconds the rate limit headers ask to wait, None when there are none
+    if headers is None:
+        return None
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    if headers.get('retry-after'):
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            pass
+    resets = [parse_duration(headers.get(name)) for name in RATE_LIMIT_RESET_HEADERS]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+def is_rate_limit_error(error):
+    return getattr(error, 'status_code', None) == 429
+
+def is_retryable_error(error):
+    status_code = getattr(error, 'status_code', None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return type(error).__name__ in ('APIConnectionError', 'APITimeoutError')
+
+def get_backoff(error, attempt):
+    base = LLM_BACKOFF_BASE_MS / 1000 * 2 ** attempt
+    response = getattr(error, 'response', None)
+    delay = get_retry_after(getattr(response, 'headers', None)) if is_rate_limit_error(error) else None
+    delay = min(delay if delay is not None else base, LLM_BACKOFF_MAX_MS / 1000)
+    # jitter so the requests that were limited together don't all come back at the same moment
+    return delay * random.uniform(1, 1.5)
+
+def get_used_tokens(result):
+    usage = getattr(result, 'usage_metadata', None)
+    if usage:
+        return usage.get('total_tokens')
+    llm_output = getattr(result, 'llm_output', None) or {}
+    return (llm_output.get('token_usage') or {}).get('total_tokens')
+
+def estimate_tokens(texts, max_tokens=None):
+    # rough count, ~4 characters per token, tokenizing every prompt would cost more than the budget check is worth
+    return sum(len(text) for text in texts) // 4 + (1000 if max_tokens is None else max_tokens)
+
+class Slot:
+    """A request that was let through, its token estimate is corrected when the real usage is known."""
+    def __init__(self, estimated_tokens):
+        self.estimated_tokens = estimated_tokens
+        self.used_tokens = None
+
+class LLMScheduler:
+    """Process-wide limit on the LLM requests running at once and the tokens sent per minute, with priorities."""
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, tokens_per_minute=LLM_TOKENS_PER_MINUTE):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.available_tokens = tokens_per_minute
+        self.refilled_at = time.monotonic()
+        self.active = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+        # set by rate limited responses, nothing starts before this time
+        self.paused_until = 0
+        self.timer = None
+
+    def get_wait_time(self, tokens):
+        now = time.monotonic()
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.tokens_per_minute <= 0:
+            return 0
+
+        tokens_per_second = self.tokens_per_minute / 60
+        self.available_tokens = min(self.tokens_per_minute, self.available_tokens + (now - self.refilled_at) * tokens_per_second)
+        self.refilled_at = now
+        # a request over the whole budget waits for a full budget
+        tokens = min(tokens, self.tokens_per_minute)
+        return 0 if self.available_tokens >= tokens else (tokens - self.available_tokens) / tokens_per_second
+
+    def take(self, tokens):
+        self.active += 1
+        if self.tokens_per_minute > 0:
+            self.available_tokens -= min(tokens, self.tokens_per_minute)
+
+    def dispatch(self):
+        # starts waiting requests in priority order, a request that has to wait for tokens holds back the ones behind it
+        while self.waiting:
+            _, _, tokens, future = self.waiting[0]
+            if future.done():
+                heapq.heappop(self.waiting)
+                continue
+            if self.active >= self.max_concurrency:
+                return
+            wait_time = self.get_wait_time(tokens)
+            if wait_time > 0:
+                self.schedule_dispatch(wait_time)
+                return
+            heapq.heappop(self.waiting)
+            self.take(tokens)
+            future.set_result(None)
+
+    def schedule_dispatch(self, wait_time):
+        if self.timer:
+            self.timer.cancel()
+        self.timer = asyncio.get_running_loop().call_later(wait_time, self.dispatch)
+
+    async def acquire(self, priority, tokens):
+        if not self.waiting and self.active < self.max_concurrency and self.get_wait_time(tokens) == 0:
+            self.take(tokens)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.sequence), tokens, future))
+        self.dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # cancelled right after it was let through
+            if future.done() and not future.cancelled():
+                self.release(Slot(tokens))
+            raise
+
+    def release(self, slot):
+        self.active -= 1
+        if self.tokens_per_minute > 0 and slot.used_tokens is not None:
+            self.available_tokens += min(slot.estimated_tokens, self.tokens_per_minute) - slot.used_tokens
+        self.dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority, estimated_tokens):
+        wait_start = time.perf_counter()
+        await self.acquire(priority, estimated_tokens)
+        wait_ms = (time.perf_counter() - wait_start) * 1000
+        observe('llm.queue_wait_ms', wait_ms)
+        observe(f'llm.queue_wait_ms.{PRIORITY_NAMES.get(priority, priority)}', wait_ms)
+
+        slot = Slot(estimated_tokens)
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    def get_retry_delay(self, error, attempt):
+        # None when the error can't be retried
+        if attempt >= LLM_MAX_RETRIES or not is_retryable_error(error):
+            return None
+
+        delay = get_backoff(error, attempt)
+        increment('llm.retries')
+        if is_rate_limit_error(error):
+            # the limit is shared by the whole process, everything waits
+            increment('llm.rate_limited')
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            return 0
+        return delay
+
+    def record_usage(self, usage_name, used_tokens):
+        # usage by stage and model, e.g. llm.tokens.adhoc_retry.gpt-4o
+        if not usage_name:
+            return
+        increment(f'llm.requests.{usage_name}')
+        if used_tokens:
+            increment(f'llm.tokens.{usage_name}', used_tokens)
+
+    async def run(self, call, priority=PRIORITY_DEFAULT, estimated_tokens=0, usage_name=None):
+        for attempt in itertools.count():
+            async with self.slot(priority, estimated_tokens) as slot:
+                try:
+                    result = await call()
+                    slot.used_tokens = get_used_tokens(result)
+                    self.record_usage(usage_name, slot.used_tokens)
+                    return result
+                except Exception as e:
+                    delay = self.get_retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+            await asyncio.sleep(delay)
+
+    async def stream(self, create_stream, priority=PRIORITY_DEFAULT, estimated_tokens=0, is_output=lambda item: True, get_item_usage=None, usage_name=None):
+        # a failed stream is only retried when none of its output was yielded yet,
+        # get_item_usage returns the used tokens when an item has them
+        for attempt in itertools.count():
+            async with self.slot(priority, estimated_tokens) as slot:
+                has_output = False
+                delay = None
+                try:
+                    # closed right away when the consumer stops early, so the response isn't read to the end
+                    async with contextlib.aclosing(create_stream()) as items:
+                        async for item in items:
+                            has_output = has_output or is_output(item)
+                            if get_item_usage and slot.used_tokens is None:
+                                slot.used_tokens = get_item_usage(item)
+                            yield item
+                    return
+                except Exception as e:
+                    delay = None if has_output else self.get_retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                finally:
+                    # also when the consumer stops early, a retried attempt is counted by the next one
+                    if delay is None:
+                        self.record_usage(usage_name, slot.used_tokens)
+            await asyncio.sleep(delay)
+
+llm_scheduler = LLMScheduler()
@@ -70,7 +70,7 @@ def create_adhoc_log_file(description, code, result, error=None):
     delimiter = '\n\n---\n\n'
 
     if isinstance(result, dict):
-        pretty_result = json.dumps(result, indent=2)
+        pretty_result = json.dumps(result, indent=2, default=str)
     else:
         try:
             # Try to parse result as JSON if it's a string
@@ -0,0 +1,30 @@
+from threading import Lock
+
+# Process-wide counters and timings, exposed by the /metrics endpoint
+counters = {}
+timings = {}
+metrics_mutex = Lock()
+
+def increment(name, value=1):
+    with metrics_mutex:
+        counters[name] = counters.get(name, 0) + value
+
+def observe(name, value):
+    with metrics_mutex:
+        timing = timings.get(name)
+        if not timing:
+            timing = timings[name] = {'count': 0, 'sum': 0.0, 'min': value, 'max': value}
+        timing['count'] += 1
+        timing['sum'] += value
+        timing['min'] = min(timing['min'], value)
+        timing['max'] = max(timing['max'], value)
+
+def get_metrics():
+    with metrics_mutex:
+        return {
+            'counters': dict(counters),
+            'timings': {
+                name: {**timing, 'avg': timing['sum'] / timing['count']}
+                for name, timing in timings.items()
+            }
+        }
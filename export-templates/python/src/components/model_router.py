@@ -0,0 +1,32 @@
+import os
+
+# Model of each stage of the agent, OPENAI_MODEL is used for the stages that don't set one
+default_model = os.getenv('OPENAI_MODEL')
+
+STAGE_MODELS = {
+    # the completion loop that answers the user and calls tools
+    'completion': os.getenv('OPENAI_COMPLETION_MODEL') or default_model,
+    # first attempt of an ad-hoc task
+    'adhoc': os.getenv('OPENAI_ADHOC_MODEL') or default_model,
+}
+# ad-hoc retries use the first attempt's model unless they have their own
+STAGE_MODELS['adhoc_retry'] = os.getenv('OPENAI_ADHOC_RETRY_MODEL') or STAGE_MODELS['adhoc']
+
+# Escalation: ad-hoc attempts switch to this model once this many attempts have failed
+ADHOC_ESCALATION_MODEL = os.getenv('OPENAI_ADHOC_ESCALATION_MODEL')
+ADHOC_ESCALATE_AFTER = int(os.getenv('ADHOC_ESCALATE_AFTER', 2))
+
+def get_stage_model(stage):
+    return STAGE_MODELS[stage]
+
+def get_adhoc_stage(failures):
+    # stage name of an ad-hoc attempt after this many failed attempts, it's also the name used in the metrics
+    if failures == 0:
+        return 'adhoc'
+    if ADHOC_ESCALATION_MODEL and failures >= ADHOC_ESCALATE_AFTER:
+        return 'adhoc_escalation'
+    return 'adhoc_retry'
+
+def get_adhoc_model(failures):
+    stage = get_adhoc_stage(failures)
+    return ADHOC_ESCALATION_MODEL if stage == 'adhoc_escalation' else get_stage_model(stage)
@@ -16,4 +16,54 @@ def extract_function_code(input_text, target_function_name='doTask'):
         if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == target_function_name:
             return ast.get_source_segment(cleaned_text, node)
     
-    return ''
\ No newline at end of file
+    return ''
+
+CODE_FENCE = '```'
+# First lines that can start a parseable response, anything else is prose that extract_function_code would reject
+CODE_START = re.compile(r'(```|(async\s+)?def\s|import\s|from\s|class\s|@|#|[A-Za-z_][\w.]*\s*[=(\[])')
+
+class CodeStreamReader:
+    """Follows a code generation response as it streams, see generate_adhoc_code."""
+    def __init__(self, target_function_name='doTask'):
+        self.text = ''
+        self.function_start = re.compile(rf'(async\s+)?def\s+{target_function_name}\s*\(')
+        # offset of the first line that wasn't looked at yet
+        self.line_start = 0
+        self.code_start = 0
+        self.in_block = False
+        self.has_function = False
+        # the first line is prose
+        self.malformed = False
+        # offset where the code block with the target function was closed, nothing after it is needed
+        self.end = None
+        # code up to the last line that ended the target function, it's complete from then on if it parses
+        self.function_code = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        while self.end is None and not self.malformed:
+            line_end = self.text.find('\n', self.line_start)
+            if line_end == -1:
+                return
+            self.read_line(self.text[self.line_start:line_end], line_end + 1)
+            self.line_start = line_end + 1
+
+    def read_line(self, line, next_line_start):
+        if not line.strip():
+            return
+        if not self.text[:self.line_start].strip() and not CODE_START.match(line.lstrip()):
+            self.malformed = True
+            return
+
+        # a line at column 0 ends the function above it, comments can be anywhere
+        if self.has_function and not line[0].isspace() and not line.startswith('#'):
+            self.function_code = self.text[self.code_start:self.line_start]
+
+        if line.lstrip().startswith(CODE_FENCE):
+            if self.in_block and self.has_function:
+                self.end = self.line_start + line.index(CODE_FENCE) + len(CODE_FENCE)
+            elif not self.in_block:
+                self.code_start = next_line_start
+            self.in_block = not self.in_block
+        elif self.function_start.match(line):
+            self.has_function = True
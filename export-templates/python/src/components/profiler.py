@@ -0,0 +1,211 @@
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import random
+import marshal
+import threading
+import contextvars
+from functools import wraps
+from components.logger import log, log_err, log_dir
+
+# On-demand sampling profiler for single requests, disabled unless PROFILE_KEY or PROFILE_SAMPLE_RATE are set
+PROFILE_KEY = os.getenv('PROFILE_KEY')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_FORMAT = os.getenv('PROFILE_FORMAT', 'pstats').lower()
+PROFILE_INTERVAL = int(os.getenv('PROFILE_INTERVAL', 5)) / 1000
+
+PROFILING_ENABLED = bool(PROFILE_KEY) or PROFILE_SAMPLE_RATE > 0
+
+PROFILE_HEADER = 'x-profile'
+PROFILE_QUERY_PARAM = 'profile'
+PROFILE_FORMATS = {'pstats': 'pstats', 'speedscope': 'speedscope.json', 'collapsed': 'collapsed.txt'}
+
+profile_directory = os.path.join(log_dir, 'profiles')
+
+_active_profile = contextvars.ContextVar('faqtiv_active_profile', default=None)
+# Only one request is profiled at a time, its samples would include the work of any other profiled request
+_profile_mutex = threading.Lock()
+
+class RequestProfile:
+    """Samples the stacks of the event loop thread and of the worker threads running this request's tools."""
+    def __init__(self, output_format=PROFILE_FORMAT, interval=PROFILE_INTERVAL):
+        self.id = f"request-{uuid.uuid4()}"
+        self.output_format = output_format if output_format in PROFILE_FORMATS else 'pstats'
+        self.interval = interval
+        self.loop_thread_id = threading.get_ident()
+        self.worker_thread_ids = set()
+        self.samples = {}
+        self.stop_event = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, name='faqtiv-profiler', daemon=True)
+        self.start_time = None
+        self.duration = 0
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.sampler.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.sampler.join()
+        self.duration = time.perf_counter() - self.start_time
+
+    def get_stack(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    def sample(self):
+        while not self.stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in (self.loop_thread_id, *list(self.worker_thread_ids)):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                # the event loop waiting for io is idle time
+                if thread_id == self.loop_thread_id and frame.f_code.co_filename.endswith('selectors.py'):
+                    continue
+                stack = self.get_stack(frame)
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def get_pstats(self):
+        # same layout as cProfile's dump_stats, call counts are sample counts
+        stats = {}
+        for stack, count in self.samples.items():
+            seconds = count * self.interval
+            seen = set()
+            for index, function in enumerate(stack):
+                cc, nc, tt, ct, callers = stats.setdefault(function, (0, 0, 0.0, 0.0, {}))
+                is_leaf = index == len(stack) - 1
+                if function not in seen:
+                    ct += seconds
+                    seen.add(function)
+                stats[function] = (cc + count, nc + count, tt + (seconds if is_leaf else 0), ct, callers)
+
+                if index:
+                    caller = stack[index - 1]
+                    caller_cc, caller_nc, caller_tt, caller_ct = callers.get(caller, (0, 0, 0.0, 0.0))
+                    callers[caller] = (
+                        caller_cc + count, caller_nc + count,
+                        caller_tt + (seconds if is_leaf else 0), caller_ct + seconds
+                    )
+        return stats
+
+    def get_frame_name(self, function):
+        file_name, line, name = function
+        return f"{name} ({os.path.basename(file_name)}:{line})"
+
+    def get_collapsed(self):
+        return ''.join(
+            f"{';'.join(self.get_frame_name(function) for function in stack)} {count}\n"
+            for stack, count in sorted(self.samples.items(), key=lambda item: -item[1])
+        )
+
+    def get_speedscope(self):
+        frames = []
+        frame_indexes = {}
+        samples = []
+        weights = []
+        for stack, count in self.samples.items():
+            sample = []
+            for function in stack:
+                if function not in frame_indexes:
+                    frame_indexes[function] = len(frames)
+                    frames.append({'name': function[2], 'file': function[0], 'line': function[1]})
+                sample.append(frame_indexes[function])
+            samples.append(sample)
+            weights.append(count * self.interval * 1000)
+
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': {'frames': frames},
+            'profiles': [{
+                'type': 'sampled',
+                'name': self.id,
+                'unit': 'milliseconds',
+                'startValue': 0,
+                'endValue': sum(weights),
+                'samples': samples,
+                'weights': weights
+            }],
+            'name': self.id,
+            'exporter': 'faqtiv'
+        }
+
+    def save(self):
+        os.makedirs(profile_directory, exist_ok=True)
+        path = os.path.join(profile_directory, f"{self.id}.{PROFILE_FORMATS[self.output_format]}")
+
+        if self.output_format == 'pstats':
+            with open(path, 'wb') as f:
+                marshal.dump(self.get_pstats(), f)
+        elif self.output_format == 'speedscope':
+            with open(path, 'w') as f:
+                json.dump(self.get_speedscope(), f)
+        else:
+            with open(path, 'w') as f:
+                f.write(self.get_collapsed())
+
+        return path
+
+def is_profile_requested(headers, query_params):
+    if PROFILE_KEY:
+        key = headers.get(PROFILE_HEADER) or query_params.get(PROFILE_QUERY_PARAM)
+        if key and hmac.compare_digest(key, PROFILE_KEY):
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def start_profile(headers, query_params):
+    if not is_profile_requested(headers, query_params):
+        return None
+    if not _profile_mutex.acquire(blocking=False):
+        log('profiler', 'skipped', {'reason': 'Another request is being profiled'})
+        return None
+
+    profile = RequestProfile(query_params.get('profile_format', PROFILE_FORMAT))
+    _active_profile.set(profile)
+    profile.start()
+    return profile
+
+def finish_profile(profile):
+    try:
+        profile.stop()
+        path = profile.save()
+        log('profiler', 'saved', {'id': profile.id, 'path': path, 'duration': profile.duration, 'samples': sum(profile.samples.values())})
+    except Exception as e:
+        log_err('profiler', 'save', {'id': profile.id}, e)
+    finally:
+        _profile_mutex.release()
+
+# Names the profile after the completion or task id, a no-op when the request is not profiled
+def set_profile_id(profile_id):
+    if not PROFILING_ENABLED:
+        return
+    profile = _active_profile.get()
+    if profile:
+        profile.id = profile_id
+
+# Wraps functions that run in worker threads so the thread is sampled while it works for the profiled request
+def profile_thread(func):
+    if not PROFILING_ENABLED:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = _active_profile.get()
+        if not profile:
+            return func(*args, **kwargs)
+        thread_id = threading.get_ident()
+        profile.worker_thread_ids.add(thread_id)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.worker_thread_ids.discard(thread_id)
+
+    return wrapper
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from components.types import Message
+from components.metrics import increment
+
+# Sessions kept in memory, the least recently used ones are evicted first
+SESSION_MAX_COUNT = int(os.getenv('SESSION_MAX_COUNT', 1000))
+# Seconds without a turn after which a session expires
+SESSION_TTL = int(os.getenv('SESSION_TTL', 3600))
+# SQLite file where sessions are persisted, they are only kept in memory when it's not set
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', '')
+
+# Expired sessions are purged from the database every this many saves
+DB_PURGE_INTERVAL = 100
+
+class Session:
+    """Messages of a server-side conversation, with their converted form and token counts cached."""
+    def __init__(self, session_id):
+        self.id = session_id
+        self.messages = []
+        # converted message and token count by id() of the request message
+        self.cache = {}
+        self.total_tokens = 0
+        # messages already written to the database
+        self.saved_count = 0
+        self.updated_at = time.time()
+        self.lock = asyncio.Lock()
+
+    def append(self, message, converted, tokens):
+        self.messages.append(message)
+        self.cache[id(message)] = (converted, tokens)
+        self.total_tokens += tokens
+
+    def rollback(self, count):
+        # removes the messages of a turn that failed
+        for message in self.messages[count:]:
+            self.total_tokens -= self.cache.pop(id(message))[1]
+        del self.messages[count:]
+
+    def get_converted(self, message):
+        return self.cache[id(message)][0]
+
+    def get_tokens(self, message):
+        return self.cache[id(message)][1]
+
+class SessionStore:
+    """LRU of sessions with a TTL, optionally backed by SQLite so they survive evictions and restarts."""
+    def __init__(self, convert, count_tokens, model, max_count=SESSION_MAX_COUNT, ttl=SESSION_TTL, db_path=SESSION_DB_PATH):
+        # convert turns a request message into a langchain message, count_tokens gives its token count
+        self.convert = convert
+        self.count_tokens = count_tokens
+        self.model = model
+        self.max_count = max_count
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.db = None
+        self.db_lock = threading.Lock()
+        self.saves = 0
+        if db_path:
+            self.open_db(db_path)
+
+    def open_db(self, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        with self.db_lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, model TEXT, updated_at REAL)')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS session_messages ('
+                'session_id TEXT, position INTEGER, message TEXT, tokens INTEGER, PRIMARY KEY (session_id, position))'
+            )
+        self.purge_db()
+
+    def is_expired(self, session):
+        return time.time() - session.updated_at > self.ttl
+
+    async def get(self, session_id):
+        session = self.sessions.get(session_id)
+        if session and self.is_expired(session):
+            await self.delete(session_id)
+            session = None
+
+        if session:
+            increment('sessions.hits')
+        elif self.db:
+            session = await asyncio.to_thread(self.load, session_id)
+            # another request may have loaded it meanwhile
+            session = self.sessions.get(session_id, session)
+            if session:
+                increment('sessions.restored')
+
+        if session is None:
+            increment('sessions.created')
+            session = Session(session_id)
+
+        self.sessions[session_id] = session
+        self.sessions.move_to_end(session_id)
+        self.evict()
+        return session
+
+    def evict(self):
+        while self.sessions:
+            session_id, oldest = next(iter(self.sessions.items()))
+            # sessions with a turn in progress are not evicted, they'd lose the turn
+            if (len(self.sessions) <= self.max_count and not self.is_expired(oldest)) or oldest.lock.locked():
+                break
+            del self.sessions[session_id]
+            increment('sessions.evicted')
+
+    async def save(self, session):
+        session.updated_at = time.time()
+        if self.db:
+            await asyncio.to_thread(self.save_to_db, session)
+
+    async def delete(self, session_id):
+        found = self.sessions.pop(session_id, None) is not None
+        if self.db:
+            found = await asyncio.to_thread(self.delete_from_db, session_id) or found
+        return found
+
+    def load(self, session_id):
+        with self.db_lock:
+            row = self.db.execute('SELECT model, updated_at FROM sessions WHERE id = ?', (session_id,)).fetchone()
+            if not row:
+                return None
+            model, updated_at = row
+            if time.time() - updated_at > self.ttl:
+                return None
+            rows = self.db.execute(
+                'SELECT message, tokens FROM session_messages WHERE session_id = ? ORDER BY position', (session_id,)
+            ).fetchall()
+
+        session = Session(session_id)
+        session.updated_at = updated_at
+        for message_json, tokens in rows:
+            message = Message(**json.loads(message_json))
+            # token counts depend on the model's tokenizer
+            if model != self.model:
+                tokens = self.count_tokens(message)
+            session.append(message, self.convert(message), tokens)
+        session.saved_count = len(rows)
+        return session
+
+    def save_to_db(self, session):
+        # only the messages added since the last save are written
+        new_messages = session.messages[session.saved_count:]
+        with self.db_lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO sessions (id, model, updated_at) VALUES (?, ?, ?)',
+                (session.id, self.model, session.updated_at)
+            )
+            self.db.executemany(
+                'INSERT OR REPLACE INTO session_messages (session_id, position, message, tokens) VALUES (?, ?, ?, ?)',
+                [
+                    (session.id, session.saved_count + i, message.model_dump_json(exclude_none=True), session.get_tokens(message))
+                    for i, message in enumerate(new_messages)
+                ]
+            )
+        session.saved_count += len(new_messages)
+
+        self.saves += 1
+        if self.saves % DB_PURGE_INTERVAL == 0:
+            self.purge_db()
+
+    def delete_from_db(self, session_id):
+        with self.db_lock, self.db:
+            deleted = self.db.execute('DELETE FROM sessions WHERE id = ?', (session_id,)).rowcount
+            self.db.execute('DELETE FROM session_messages WHERE session_id = ?', (session_id,))
+        return deleted > 0
+
+    def purge_db(self):
+        expired_before = time.time() - self.ttl
+        with self.db_lock, self.db:
+            self.db.execute(
+                'DELETE FROM session_messages WHERE session_id IN (SELECT id FROM sessions WHERE updated_at < ?)', (expired_before,)
+            )
+            self.db.execute('DELETE FROM sessions WHERE updated_at < ?', (expired_before,))
@@ -0,0 +1,123 @@
+import os
+import json
+import asyncio
+import threading
+from components.metrics import increment
+
+# Levels where identical in-flight work is shared: run_task, adhoc and tool_calls, or all. Off by default because
+# coalesced tasks run once for all the callers, only enable it for tasks without side effects
+COALESCE_REQUESTS = os.getenv('COALESCE_REQUESTS', '').lower()
+# Milliseconds a finished result keeps being reused by identical calls, 0 only shares calls that are in flight
+COALESCE_WINDOW_MS = int(os.getenv('COALESCE_WINDOW_MS', 0))
+
+def is_coalescing_enabled(level):
+    levels = {name.strip() for name in COALESCE_REQUESTS.split(',')}
+    return 'all' in levels or level in levels
+
+def get_coalescing_key(*parts, faqtivGlobals=None):
+    # callers with different delegation tokens can be allowed to see different data, they never share results
+    agent_gateway = faqtivGlobals.get('agentGateway') if faqtivGlobals else None
+    delegation_token = getattr(agent_gateway, 'delegation_token', None)
+    return json.dumps([*parts, delegation_token], sort_keys=True, default=str)
+
+class Flight:
+    """One shared execution, its stream writer events are recorded and forwarded to every caller's writer."""
+    def __init__(self):
+        self.task = None
+        self.events = []
+        self.writers = []
+        self.waiters = 0
+        # streamWriter is called from task worker threads too
+        self.lock = threading.Lock()
+
+    def subscribe(self, writer):
+        if writer is None:
+            return
+        with self.lock:
+            # late callers get the events they missed first
+            for method, args in self.events:
+                forward_event(writer, method, args)
+            self.writers.append(writer)
+
+    def unsubscribe(self, writer):
+        with self.lock:
+            if writer in self.writers:
+                self.writers.remove(writer)
+
+    def publish(self, method, *args):
+        with self.lock:
+            self.events.append((method, args))
+            for writer in self.writers:
+                forward_event(writer, method, args)
+
+def forward_event(writer, method, args):
+    # progress events are only sent to writers that support them
+    write = getattr(writer, method, None)
+    if write:
+        write(*args)
+
+class BroadcastWriter:
+    """streamWriter of a shared execution."""
+    def __init__(self, flight):
+        self.flight = flight
+
+    def writeEvent(self, data: str, model: str = None):
+        self.flight.publish('writeEvent', data, model)
+
+    def writeRaw(self, data: str, model: str = None):
+        self.flight.publish('writeRaw', data, model)
+
+    def writeProgress(self, event: str, data: dict):
+        self.flight.publish('writeProgress', event, data)
+
+class SingleFlight:
+    """Runs one execution per key, callers with the same key share it and receive the same stream writer events."""
+    def __init__(self, level, window_ms=COALESCE_WINDOW_MS):
+        self.level = level
+        self.enabled = is_coalescing_enabled(level)
+        self.window = window_ms / 1000
+        self.flights = {}
+
+    async def call(self, key_parts, execute, faqtivGlobals=None):
+        # execute receives the faqtivGlobals to run with, it's called directly when the level is not enabled
+        if not self.enabled:
+            return await execute(faqtivGlobals)
+
+        key = get_coalescing_key(*key_parts, faqtivGlobals=faqtivGlobals)
+        stream_writer = faqtivGlobals.get('streamWriter') if faqtivGlobals else None
+        return await self.run(key, lambda writer: execute({**(faqtivGlobals or {}), 'streamWriter': writer}), stream_writer)
+
+    async def run(self, key, execute, stream_writer=None):
+        # execute receives the streamWriter of the shared execution
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight()
+            self.flights[key] = flight
+            # the execution runs in its own task so it isn't cancelled with the caller that started it
+            flight.task = asyncio.create_task(execute(BroadcastWriter(flight)))
+            flight.task.add_done_callback(lambda task: self.finish(key, flight, task))
+            increment(f'coalesce.{self.level}.executions')
+        else:
+            increment(f'coalesce.{self.level}.coalesced')
+
+        flight.subscribe(stream_writer)
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            flight.unsubscribe(stream_writer)
+            # nobody is waiting for it anymore
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+
+    def finish(self, key, flight, task):
+        failed = task.cancelled() or task.exception() is not None
+        if failed or self.window <= 0:
+            self.remove(key, flight)
+        else:
+            asyncio.get_running_loop().call_later(self.window, self.remove, key, flight)
+
+    def remove(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
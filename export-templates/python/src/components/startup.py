@@ -0,0 +1,66 @@
+import sys
+import time
+
+# Used by main.py --startup-report, keep this module free of heavy imports
+class ImportTimer:
+    """Meta path finder that times the execution of every module imported after it's installed."""
+    def __init__(self):
+        self.timings = {}
+        self.stack = []
+
+    def find_spec(self, name, path=None, target=None):
+        # let the other finders locate the module, then wrap its loader
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is None:
+                continue
+            # builtin and frozen importers are classes shared by many modules, they are not timed
+            if spec.loader is not None and not isinstance(spec.loader, type) and hasattr(spec.loader, 'exec_module'):
+                self.wrap_loader(name, spec.loader)
+            return spec
+        return None
+
+    def wrap_loader(self, name, loader):
+        exec_module = loader.exec_module
+
+        def timed_exec_module(module):
+            start = time.perf_counter()
+            self.stack.append(0.0)
+            try:
+                exec_module(module)
+            finally:
+                children = self.stack.pop()
+                total = time.perf_counter() - start
+                self.timings[name] = {'total': total, 'self': total - children}
+                if self.stack:
+                    self.stack[-1] += total
+
+        loader.exec_module = timed_exec_module
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+        return self
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+def print_startup_report(import_timer, startup_time, limit=30):
+    timings = import_timer.timings
+    # top level packages, their time includes everything they import
+    packages = {}
+    for name, timing in timings.items():
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + timing['self']
+
+    print(f"\nStartup took {startup_time * 1000:.0f} ms, {len(timings)} modules imported", file=sys.stderr)
+    print(f"\n{'package':<40}{'self ms':>10}", file=sys.stderr)
+    for package, seconds in sorted(packages.items(), key=lambda item: -item[1])[:limit]:
+        print(f"{package:<40}{seconds * 1000:>10.1f}", file=sys.stderr)
+
+    print(f"\n{'module':<60}{'self ms':>10}{'total ms':>10}", file=sys.stderr)
+    for name, timing in sorted(timings.items(), key=lambda item: -item[1]['self'])[:limit]:
+        print(f"{name:<60}{timing['self'] * 1000:>10.1f}{timing['total'] * 1000:>10.1f}", file=sys.stderr)
+    print(file=sys.stderr, flush=True)
@@ -0,0 +1,128 @@
+import io
+import sys
+import json
+import builtins
+import contextvars
+from contextlib import contextmanager
+
+# Names injected into the task namespace, resolved per running task
+TASK_GLOBAL_NAMES = ['streamWriter', 'agentGateway']
+# Names injected into the task namespace, shared by all tasks
+SHARED_GLOBAL_NAMES = ['httpClient', 'asyncHttpClient']
+# Functions injected into the task namespace to return results without printing them, see ResultChannel
+RESULT_FUNCTION_NAMES = ['emitResult', 'emitRow', 'emitRows']
+
+# Each running task gets its own stdout buffer and globals so concurrent tasks don't mix their output
+_stdout_buffer = contextvars.ContextVar('faqtiv_stdout_buffer', default=None)
+_task_globals = contextvars.ContextVar('faqtiv_task_globals', default=None)
+_result_channel = contextvars.ContextVar('faqtiv_result_channel', default=None)
+
+class ContextStdout:
+    """Replacement for sys.stdout that writes to the current task buffer, or to the real stdout outside tasks."""
+    def __init__(self, stream):
+        self.stream = stream
+
+    def _target(self):
+        buffer = _stdout_buffer.get()
+        return buffer if buffer is not None else self.stream
+
+    def write(self, data):
+        return self._target().write(data)
+
+    def flush(self):
+        return self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class TaskGlobal:
+    """Proxy for a faqtivGlobals entry, it's falsy when the current task didn't receive that global."""
+    def __init__(self, name):
+        self._name = name
+
+    def _target(self):
+        task_globals = _task_globals.get()
+        return task_globals.get(self._name) if task_globals else None
+
+    def __bool__(self):
+        return self._target() is not None
+
+    def __getattr__(self, attr):
+        target = self._target()
+        if target is None:
+            raise AttributeError(f"{self._name} is not available for this task")
+        return getattr(target, attr)
+
+class ResultChannel:
+    """Result of the running task as Python objects, either a single value or rows added one at a time."""
+    def __init__(self):
+        self.has_result = False
+        self.result = None
+        self.rows = None
+
+    def set_result(self, value):
+        if self.rows is not None:
+            raise ValueError("emitResult can't be used after emitRow or emitRows in the same task")
+        # the last value wins, like a variable assignment
+        self.has_result = True
+        self.result = value
+
+    def add_rows(self, rows):
+        if self.rows is None:
+            if self.has_result:
+                raise ValueError("emitRow and emitRows can't be used after emitResult in the same task")
+            self.has_result = True
+            self.rows = self.result = []
+        # list.extend holds the GIL, rows can be added from parallel_map worker threads
+        self.rows.extend(rows)
+
+def emit_result(value):
+    """Returns value as the task result, it must be JSON compatible."""
+    channel = _result_channel.get()
+    if channel is None:
+        # called outside the runtime, e.g. a task run as a plain script
+        print(json.dumps(value))
+        return
+    channel.set_result(value)
+
+def emit_rows(rows):
+    """Adds rows to the task result, a list with the rows of every call in order."""
+    channel = _result_channel.get()
+    if channel is None:
+        for row in rows:
+            print(json.dumps(row))
+        return
+    channel.add_rows(rows)
+
+def emit_row(row):
+    """Adds one row to the task result."""
+    emit_rows((row,))
+
+RESULT_FUNCTIONS = {'emitResult': emit_result, 'emitRow': emit_row, 'emitRows': emit_rows}
+
+def install_task_globals(*namespaces, shared_globals=None):
+    if not isinstance(sys.stdout, ContextStdout):
+        sys.stdout = ContextStdout(sys.stdout)
+
+    # functions check for the globals with `'streamWriter' in globals()` so they need to be in their module namespace too
+    for namespace in (builtins.__dict__, *namespaces):
+        for name in TASK_GLOBAL_NAMES:
+            if not isinstance(namespace.get(name), TaskGlobal):
+                namespace[name] = TaskGlobal(name)
+        namespace.update(RESULT_FUNCTIONS)
+        namespace.update(shared_globals or {})
+
+# Yields the stdout buffer and the result channel of the task
+@contextmanager
+def task_context(faqtivGlobals=None):
+    buffer = io.StringIO()
+    channel = ResultChannel()
+    buffer_token = _stdout_buffer.set(buffer)
+    globals_token = _task_globals.set(faqtivGlobals)
+    channel_token = _result_channel.set(channel)
+    try:
+        yield buffer, channel
+    finally:
+        _result_channel.reset(channel_token)
+        _task_globals.reset(globals_token)
+        _stdout_buffer.reset(buffer_token)
@@ -0,0 +1,57 @@
+import os
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from components.profiler import profile_thread
+from components.http_client import run_in_new_loop
+
+# Helpers available to generated ad-hoc code, they are advertised in ADHOC_PROMPT_TEXT
+PARALLEL_MAP_MAX_WORKERS = int(os.getenv('PARALLEL_MAP_MAX_WORKERS', 16))
+
+def get_worker_count(max_workers, item_count):
+    return max(1, min(int(max_workers), PARALLEL_MAP_MAX_WORKERS, item_count))
+
+def parallel_map(fn, items, max_workers=8):
+    """Calls fn(item) for every item in a bounded thread pool, returns the results in the order of items and raises the first error in that order."""
+    items = list(items)
+    if not items:
+        return []
+
+    def call(item):
+        result = fn(item)
+        # async functions get their own event loop in the worker thread
+        if asyncio.iscoroutine(result):
+            result = run_in_new_loop(result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=get_worker_count(max_workers, len(items))) as executor:
+        # each call runs in a copy of the task context so its prints and streamWriter events go to the running task
+        futures = [executor.submit(contextvars.copy_context().run, profile_thread(call), item) for item in items]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+async def async_parallel_map(fn, items, max_workers=8):
+    """Same as parallel_map for async code, sync functions run in worker threads and async ones on the current event loop."""
+    items = list(items)
+    if not items:
+        return []
+
+    semaphore = asyncio.Semaphore(get_worker_count(max_workers, len(items)))
+
+    async def call(item):
+        async with semaphore:
+            if asyncio.iscoroutinefunction(fn):
+                return await fn(item)
+            result = await asyncio.to_thread(profile_thread(fn), item)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+
+    # gather keeps the order of items and raises the first error
+    return await asyncio.gather(*[call(item) for item in items])
+
+ADHOC_HELPERS = [parallel_map, async_parallel_map]
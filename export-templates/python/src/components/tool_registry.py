@@ -0,0 +1,120 @@
+import re
+import asyncio
+import inspect
+from langchain_core.tools import StructuredTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from components.tools import run_and_capture_output
+from constants import TASK_TOOL_CALL_DESCRIPTION_TEMPLATES
+
+# Tools that receive the arguments object instead of one argument per parameter
+ARGUMENTS_OBJECT_TOOLS = {'run_adhoc_task', 'query_artifact'}
+
+TEMPLATE_PLACEHOLDER = re.compile(r'#(\w+)#')
+
+def create_validator(args_schema):
+    # the model validates and coerces the arguments of the model's tool calls, its validator is built once with the class,
+    # numbers are accepted for string parameters because models often send ids and years unquoted
+    return type(args_schema.__name__, (args_schema,), {
+        'model_config': {**args_schema.model_config, 'coerce_numbers_to_str': True}
+    })
+
+def get_parameter_order(function, field_names):
+    # pairs every schema field with the function parameter it's passed as, by name first and
+    # then by position for the fields whose name doesn't match a parameter
+    parameters = inspect.signature(function).parameters
+    accepts_any_keyword = any(parameter.kind == inspect.Parameter.VAR_KEYWORD for parameter in parameters.values())
+    free_parameters = [
+        name for name, parameter in parameters.items()
+        if name not in field_names and parameter.kind in (inspect.Parameter.POSITIONAL_OR_KEYWORD, inspect.Parameter.KEYWORD_ONLY)
+    ]
+
+    order = []
+    for field_name in field_names:
+        if field_name in parameters or accepts_any_keyword:
+            order.append((field_name, field_name))
+        elif free_parameters:
+            order.append((field_name, free_parameters.pop(0)))
+    return order
+
+def compile_description_template(template):
+    # literal text at even positions, argument names at odd positions
+    return TEMPLATE_PLACEHOLDER.split(template) if template else None
+
+class RegisteredTool:
+    """Everything needed to dispatch a call to a tool, worked out once when the tool is registered."""
+    def __init__(self, name, schema):
+        self.name = name
+        self.function = schema["function"]
+        self.takes_arguments_object = name in ARGUMENTS_OBJECT_TOOLS
+        self.is_async = asyncio.iscoroutinefunction(self.function)
+        self.validator = create_validator(schema["args_schema"])
+        self.parameter_order = [] if self.takes_arguments_object else get_parameter_order(self.function, list(schema["args_schema"].model_fields))
+        self.description_parts = compile_description_template(TASK_TOOL_CALL_DESCRIPTION_TEMPLATES.get(name))
+
+        description = schema["description"]
+        if "returns_description" in schema:
+            description += f" Returns: {schema['returns_description']}"
+
+        self.tool = StructuredTool(
+            name=name,
+            description=description,
+            args_schema=schema["args_schema"],
+            coroutine=self.run,
+            metadata={"output": schema["output"]}
+        )
+        self.openai_tool = convert_to_openai_tool(self.tool)
+
+    def get_call_arguments(self, arguments):
+        validated = self.validator.model_validate(arguments)
+        if self.takes_arguments_object:
+            return validated.model_dump()
+
+        # only the arguments the model sent are passed, the function's defaults apply to the rest
+        values = validated.__dict__
+        fields_set = validated.model_fields_set
+        return {parameter: values[field_name] for field_name, parameter in self.parameter_order if field_name in fields_set}
+
+    def describe(self, arguments):
+        if not self.description_parts:
+            return None
+
+        parts = self.description_parts
+        return ''.join(
+            part if i % 2 == 0 else str(arguments.get(part, f'#{part}#'))
+            for i, part in enumerate(parts)
+        )
+
+    async def invoke(self, call_arguments, faqtivGlobals=None):
+        if self.takes_arguments_object:
+            return await self.function(call_arguments, faqtivGlobals=faqtivGlobals)
+        return await run_and_capture_output(self.function, kwargs=call_arguments, faqtivGlobals=faqtivGlobals, is_async=self.is_async)
+
+    async def run(self, **arguments):
+        # used when the tool is called through langchain
+        return await self.invoke(self.get_call_arguments(arguments))
+
+class ToolRegistry:
+    """Tools by name, with their langchain and OpenAI definitions kept in registration order."""
+    def __init__(self, schemas=None):
+        self.tools_by_name = {}
+        self.tools = []
+        self.openai_tools = []
+        for name, schema in (schemas or {}).items():
+            self.register(name, schema)
+
+    def register(self, name, schema):
+        registered_tool = RegisteredTool(name, schema)
+        if name in self.tools_by_name:
+            self.unregister(name)
+        self.tools_by_name[name] = registered_tool
+        self.tools.append(registered_tool.tool)
+        self.openai_tools.append(registered_tool.openai_tool)
+        return registered_tool
+
+    def unregister(self, name):
+        registered_tool = self.tools_by_name.pop(name)
+        self.tools.remove(registered_tool.tool)
+        self.openai_tools.remove(registered_tool.openai_tool)
+
+    def get(self, name):
+        return self.tools_by_name.get(name)
@@ -1,49 +1,66 @@
 import os
 import asyncio
-import io
 import json
 import sys
 import traceback
-import re
-from typing import Dict, Any, List
-from langchain_core.tools import StructuredTool
-from langchain_openai import ChatOpenAI
-from langchain.schema import SystemMessage, HumanMessage, AIMessage
-from langchain.chat_models.base import BaseChatModel
-from functools import partial
-from contextlib import redirect_stdout
-from components.examples import get_relevant_examples
-from components.parser import extract_function_code
+import time
+import weakref
+import contextlib
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+from components.examples import get_relevant_examples_async, queue_example
+from components.parser import extract_function_code, CodeStreamReader
+from components.code_validator import validate_generated_code
 from components.logger import create_adhoc_log_file
-from constants import ADHOC_PROMPT_TEXT, LIBS, FUNCTIONS, TASK_TOOL_CALL_DESCRIPTION_TEMPLATES
+from components.context_manager import get_tokens
+from components.metrics import increment, observe
+from components.task_context import task_context, install_task_globals
+from components.http_client import http_client, async_http_client, openai_http_client
+from components.task_helpers import ADHOC_HELPERS
+from components.profiler import profile_thread
+from components.single_flight import SingleFlight
+from components.model_router import get_stage_model, get_adhoc_stage, get_adhoc_model
+from components.llm_scheduler import llm_scheduler, estimate_tokens, get_used_tokens, PRIORITY_DEFAULT, PRIORITY_BACKGROUND
+import constants
+from constants import ADHOC_PROMPT_TEXT, LIBS, FUNCTIONS
 
 TOOL_TIMEOUT = int(os.getenv('TOOL_TIMEOUT', 60000)) / 1000
 
+install_task_globals(vars(constants), shared_globals={
+    'httpClient': http_client,
+    'asyncHttpClient': async_http_client
+})
+
 # todo: do we need to handle warn and error logs?
 async def capture_and_process_output(func, *args, faqtivGlobals=None, **kwargs):
-    f = io.StringIO()
+    return await run_and_capture_output(func, args, kwargs, faqtivGlobals)
+
+# is_async can be passed by callers that already know it, e.g. the tool registry
+async def run_and_capture_output(func, args=(), kwargs=None, faqtivGlobals=None, is_async=None):
+    kwargs = kwargs or {}
+    if is_async is None:
+        is_async = asyncio.iscoroutinefunction(func)
     try:
         async def execute():
-            with redirect_stdout(f):
-                builtins_dict = sys.modules['builtins'].__dict__
-                builtins_dict['streamWriter'] = faqtivGlobals['streamWriter']
-                builtins_dict['agentGateway'] = faqtivGlobals['agentGateway']
-
-                if asyncio.iscoroutinefunction(func):
-                    return await func(*args, **kwargs)
+            with task_context(faqtivGlobals) as (f, channel):
+                if is_async:
+                    await func(*args, **kwargs)
                 else:
-                    return func(*args, **kwargs)
+                    # run sync tasks in a worker thread so they don't block other requests
+                    await asyncio.to_thread(profile_thread(func), *args, **kwargs)
+                if channel.has_result:
+                    # emitted results are used as they are, anything printed is only debug output
+                    increment('tools.result.emitted')
+                    return channel.result
+                output = f.getvalue()
 
-        result = await asyncio.wait_for(execute(), timeout=TOOL_TIMEOUT)
+            # tasks that print their result as JSON
+            increment('tools.result.stdout')
+            try:
+                return json.loads(output)
+            except json.JSONDecodeError:
+                return output.strip()
 
-        output = f.getvalue()
-        
-        try:
-            processed_result = json.loads(output)
-        except json.JSONDecodeError:
-            processed_result = output.strip()
-        
-        return processed_result
+        return await asyncio.wait_for(execute(), timeout=TOOL_TIMEOUT)
     except asyncio.TimeoutError:
         print(f"Execution timed out after {TOOL_TIMEOUT} seconds", file=sys.stderr)
         raise
@@ -52,43 +69,22 @@ async def capture_and_process_output(func, *args, faqtivGlobals=None, **kwargs):
         traceback.print_exc()
         raise
 
-# Capture stdout of tasks
-async def tool_wrapper(func, *args, faqtivGlobals=None, **kwargs):
-    # todo: make sure the args are in the correct positional order
-    # this code extracts the args map from the object and passes them as individual value arguments
-    arguments = args[0] if isinstance(args, tuple) and len(args) == 1 else args
-    arguments_json = json.dumps(arguments)
-    arguments_map = json.loads(arguments_json)
-    positional_args = list(arguments_map.values())
-            
-    return await capture_and_process_output(func, *positional_args, faqtivGlobals=faqtivGlobals, **kwargs)
-
-def create_tools_from_schemas(schemas: Dict[str, Dict[str, Any]]) -> List[StructuredTool]:
-    tools = []
-    for name, schema in schemas.items():
-        description = schema["description"]
-        if "returns_description" in schema:
-            description += f" Returns: {schema['returns_description']}"
-        
-        if name == "run_adhoc_task":
-            func = schema["function"]
-        else:
-            func = partial(tool_wrapper, schema["function"])
-        
-        tool = StructuredTool(
-            name=name,
-            description=description,
-            args_schema=schema["args_schema"],
-            coroutine=func,
-            metadata={"output": schema["output"]}
-        )
-        tools.append(tool)
-    return tools
-
 api_key = os.getenv('OPENAI_API_KEY')
 model = os.getenv('OPENAI_MODEL')
 
-adhoc_llm: BaseChatModel = ChatOpenAI(api_key=api_key, model=model)
+# Created with the first ad-hoc task that uses each model, langchain_openai is slow to import,
+# for each connection pool of the OpenAI clients, they're bound to an event loop
+adhoc_llms = weakref.WeakKeyDictionary()
+
+def get_adhoc_llm(model_name=None):
+    model_name = model_name or get_stage_model('adhoc')
+    http_async_client = openai_http_client.get_client()
+    llms = adhoc_llms.setdefault(http_async_client, {})
+    if model_name not in llms:
+        from langchain_openai import ChatOpenAI
+        # retries go through the LLM scheduler
+        llms[model_name] = ChatOpenAI(api_key=api_key, model=model_name, max_retries=0, stream_usage=True, http_async_client=http_async_client)
+    return llms[model_name]
 
 async def execute_generated_function(function_code):
     # Create a temporary module to execute the function
@@ -99,80 +95,407 @@ async def execute_generated_function(function_code):
     module.__dict__.update({
         **{func.__name__: func for func in LIBS},
         **{func.__name__: func for func in FUNCTIONS},
+        **{func.__name__: func for func in ADHOC_HELPERS},
         'json': json,
     })
     
-    # Execute the function code in the module's context
-    exec(function_code, module.__dict__)
+    # Execute the function code in the module's context, the file name lets retries find its frames in tracebacks
+    exec(compile(function_code, ADHOC_CODE_FILENAME, 'exec'), module.__dict__)
     
-    # Call the doTask function
-    result = module.doTask()
-    
-    # If the result is a coroutine, await it
-    if asyncio.iscoroutine(result):
-        result = await result
+    # Call the doTask function, sync code runs in a worker thread to keep the event loop free
+    if asyncio.iscoroutinefunction(module.doTask):
+        result = await module.doTask()
+    else:
+        result = await asyncio.to_thread(profile_thread(module.doTask))
     
     return result
 
-# Adhoc task execution
+REFUSAL_MESSAGE = 'The request cannot be fulfilled using the available functions'
+
+ADHOC_CODE_FILENAME = '<doTask>'
+
+# "full" resends the whole prompt with every previous error, "repair" only sends the failing code and its error
+ADHOC_RETRY_MODE = os.getenv('ADHOC_RETRY_MODE', 'full').lower()
+# Token budget for the failing code and error of a repair prompt
+ADHOC_REPAIR_TOKEN_BUDGET = int(os.getenv('ADHOC_REPAIR_TOKEN_BUDGET', 2000))
+
+REPAIR_INSTRUCTIONS = """The doTask code above failed with this error:
+
+{error}
+
+Make the smallest change to the code that fixes this error, keep everything that is not related to it as it is.
+Reply with the complete corrected doTask function in a code block, following the same rules as before."""
+
+ELIDED_CODE_INSTRUCTIONS = """
+Some lines of the code above were omitted to keep this message short, the complete function you reply with must also do what the omitted lines did."""
+
+# Tokens kept for the error when the failing code alone is over the repair budget
+REPAIR_MIN_ERROR_TOKENS = ADHOC_REPAIR_TOKEN_BUDGET // 4
+# Tokens of the omitted lines markers
+ELISION_MARKER_TOKENS = 20
+
+# Speculative ad-hoc generation, disabled unless more than one candidate is requested
+ADHOC_SPECULATIVE_CANDIDATES = int(os.getenv('ADHOC_SPECULATIVE_CANDIDATES', 1))
+# Cost cap: the prompt tokens of all candidates together can't go over this budget
+ADHOC_SPECULATIVE_TOKEN_BUDGET = int(os.getenv('ADHOC_SPECULATIVE_TOKEN_BUDGET', 60000))
+
+ADHOC_STATIC_VALIDATION = os.getenv('ADHOC_STATIC_VALIDATION', 'true').lower() == 'true'
+# Streams the generated code so it can stop early, e.g. on a refusal, disable it to wait for the whole response
+ADHOC_STREAMING = os.getenv('ADHOC_STREAMING', 'true').lower() == 'true'
+
+class CodeValidationError(ValueError):
+    def __init__(self, code, problems):
+        self.code = code
+        super().__init__("The generated code has these problems:\n" + "\n".join(f"- {problem}" for problem in problems))
+
+def build_adhoc_messages(user_input, relevant_examples, error_context=""):
+    example_messages = [
+        {"role": "human" if i % 2 == 0 else "assistant", "content": content}
+        for example in relevant_examples
+        for i, content in enumerate([example["task"], example["code"]])
+    ]
+    
+    return [
+        SystemMessage("You are a useful technical assistant."),
+        SystemMessage(ADHOC_PROMPT_TEXT),
+        *[HumanMessage(content=msg["content"]) if msg["role"] == "human" else AIMessage(content=msg["content"]) for msg in example_messages],
+        HumanMessage(content=f"{user_input}\n\n{error_context}")
+    ]
+
+def build_repair_messages(user_input, failing_code, error, elided=False):
+    # the system messages are the same as in the first attempt so the provider can reuse the cached prompt prefix
+    return [
+        SystemMessage("You are a useful technical assistant."),
+        SystemMessage(ADHOC_PROMPT_TEXT),
+        HumanMessage(content=user_input),
+        AIMessage(content=f"```python\n{failing_code}\n```"),
+        HumanMessage(content=REPAIR_INSTRUCTIONS.format(error=error) + (ELIDED_CODE_INSTRUCTIONS if elided else ''))
+    ]
+
+def truncate_to_tokens(text, max_tokens):
+    tokens = get_tokens(model, text)
+    if tokens <= max_tokens:
+        return text
+
+    # keep the start and the end of the text, the exception type and message are at the end of errors
+    keep_chars = max(int(len(text) * max_tokens / tokens) - 20, 0)
+    head = text[:keep_chars // 2]
+    tail = text[len(text) - keep_chars // 2:] if keep_chars else ''
+    return f"{head}\n... (truncated) ...\n{tail}"
+
+def render_code_window(lines, start, end):
+    # lines[start:end] with markers for the omitted lines, the first line with the signature is always kept
+    kept = lines[start:end]
+    if start > 1:
+        kept.insert(0, f"    # ... {start - 1} lines omitted ...")
+    if start > 0:
+        kept.insert(0, lines[0])
+    if end < len(lines):
+        kept.append(f"    # ... {len(lines) - end} lines omitted ...")
+    return "\n".join(kept)
+
+# Keeps the lines around the failing line that fit in max_tokens
+def elide_code(code, max_tokens, focus_line=None):
+    lines = code.splitlines()
+    if not lines or get_tokens(model, code) <= max_tokens:
+        return code
+
+    # line tokens are counted once, the newlines add about one token per line
+    line_tokens = [get_tokens(model, line) + 1 for line in lines]
+    focus = min(max(focus_line or 1, 1), len(lines)) - 1
+    budget = max_tokens - ELISION_MARKER_TOKENS - line_tokens[0]
+    start, end = focus, focus + 1
+    used = line_tokens[focus]
+    grew = True
+    while grew:
+        # grows the window one line down and one line up at a time
+        grew = False
+        if end < len(lines) and used + line_tokens[end] <= budget:
+            used += line_tokens[end]
+            end += 1
+            grew = True
+        if start > 1 and used + line_tokens[start - 1] <= budget:
+            start -= 1
+            used += line_tokens[start]
+            grew = True
+
+    # a failing line longer than the whole budget is cut too
+    return truncate_to_tokens(render_code_window(lines, start, end), max_tokens)
+
+# Reduces an error to the generated code frames plus the frame that raised it, and the failing code to the lines
+# around it, so the code and the error fit in the repair token budget together
+def format_repair_failure(error, failing_code):
+    frames = traceback.extract_tb(error.__traceback__) if error.__traceback__ else []
+    code_lines = failing_code.splitlines()
+    lines = []
+
+    code_frames = [frame for frame in frames if frame.filename == ADHOC_CODE_FILENAME]
+    for frame in code_frames:
+        line = code_lines[frame.lineno - 1].strip() if 0 < frame.lineno <= len(code_lines) else ''
+        lines.append(f"  doTask line {frame.lineno}, in {frame.name}: {line}")
+
+    if frames and code_frames and frames[-1] is not code_frames[-1]:
+        lines.append(f"  raised in {frames[-1].name}: {(frames[-1].line or '').strip()}")
+
+    message = f"{type(error).__name__}: {error}"
+    if lines:
+        message = "Traceback (most relevant frames):\n" + "\n".join(lines) + "\n" + message
+
+    error_budget = max(ADHOC_REPAIR_TOKEN_BUDGET - get_tokens(model, failing_code), REPAIR_MIN_ERROR_TOKENS)
+    message = truncate_to_tokens(message, error_budget)
+    code_budget = ADHOC_REPAIR_TOKEN_BUDGET - get_tokens(model, message)
+    code = elide_code(failing_code, code_budget, code_frames[-1].lineno if code_frames else None)
+    return code, message, code is not failing_code
+
+def check_generated_code(function_code):
+    # catch mistakes before running the code, the problems go to the retry prompt like any execution error
+    problems = validate_generated_code(function_code) if ADHOC_STATIC_VALIDATION else []
+    if problems:
+        increment('adhoc.validation.failures')
+        raise CodeValidationError(function_code, problems)
+
+async def generate_adhoc_code(messages, priority=PRIORITY_DEFAULT, failures=0, **llm_kwargs):
+    # the model depends on how many attempts failed, see model_router
+    stage = get_adhoc_stage(failures)
+    model_name = get_adhoc_model(failures)
+    usage_name = f'{stage}.{model_name}'
+    estimated_tokens = estimate_tokens([message.content for message in messages])
+
+    if ADHOC_STREAMING:
+        response_text, validated_code = await stream_adhoc_response(messages, priority, estimated_tokens, usage_name, model_name, llm_kwargs)
+    else:
+        response = await llm_scheduler.run(
+            lambda: get_adhoc_llm(model_name).agenerate([messages], **llm_kwargs),
+            priority,
+            estimated_tokens,
+            usage_name=usage_name
+        )
+        response_text, validated_code = response.generations[0][0].text, None
+
+    if REFUSAL_MESSAGE in response_text:
+        raise ValueError(response_text)
+    
+    function_code = extract_function_code(response_text)
+
+    if not function_code:
+        raise ValueError(f"Failed to parse function code: {response_text}")
+
+    if function_code != validated_code:
+        check_generated_code(function_code)
+
+    return function_code
+
+# Reads the response as it's generated, stops as soon as it's known to fail and at the end of the code block,
+# returns the response text and the doTask code that was already validated while the rest was arriving
+async def stream_adhoc_response(messages, priority, estimated_tokens, usage_name, model_name, llm_kwargs):
+    reader = CodeStreamReader()
+    validated_code = None
+    checked_code = None
+    chunks = llm_scheduler.stream(
+        lambda: get_adhoc_llm(model_name).astream(messages, **llm_kwargs),
+        priority,
+        estimated_tokens,
+        is_output=lambda chunk: bool(chunk.content),
+        get_item_usage=get_used_tokens,
+        usage_name=usage_name
+    )
+    async with contextlib.aclosing(chunks):
+        async for chunk in chunks:
+            reader.feed(chunk.content)
+
+            if REFUSAL_MESSAGE in reader.text:
+                increment('adhoc.codegen.early_aborts.refusal')
+                raise ValueError(reader.text)
+
+            if reader.malformed:
+                increment('adhoc.codegen.early_aborts.malformed')
+                raise ValueError(f"Failed to parse function code: {reader.text}")
+
+            if reader.function_code is not None and reader.function_code != checked_code:
+                # doTask is complete, its problems are known before the end of the response
+                checked_code = reader.function_code
+                try:
+                    function_code = extract_function_code(checked_code)
+                except SyntaxError:
+                    # the line that looked like the end of doTask was inside a string, wait for the next one
+                    function_code = None
+                if function_code and function_code != validated_code:
+                    try:
+                        check_generated_code(function_code)
+                    except CodeValidationError:
+                        increment('adhoc.codegen.early_aborts.validation')
+                        raise
+                    validated_code = function_code
+
+            if reader.end is not None:
+                # whatever comes after the code block is prose the code doesn't need
+                increment('adhoc.codegen.fence_stops')
+                return reader.text[:reader.end], validated_code
+
+    return reader.text, validated_code
+
+def get_speculative_candidate_count(messages):
+    if ADHOC_SPECULATIVE_CANDIDATES <= 1:
+        return 1
+
+    prompt_tokens = sum(get_tokens(model, message.content) for message in messages)
+    affordable = ADHOC_SPECULATIVE_TOKEN_BUDGET // max(prompt_tokens, 1)
+    return max(1, min(ADHOC_SPECULATIVE_CANDIDATES, affordable))
+
+# Candidate 0 is the regular attempt, the others vary the temperature and use fewer of the most relevant examples
+def get_speculative_candidate_inputs(user_input, relevant_examples, index):
+    if index == 0:
+        return build_adhoc_messages(user_input, relevant_examples), {}
+
+    examples_subset = relevant_examples[:max(1, len(relevant_examples) // (index + 1))]
+    temperature = min(1.0, 0.2 + 0.3 * index)
+    return build_adhoc_messages(user_input, examples_subset), {"temperature": temperature}
+
+class SpeculationFailedError(Exception):
+    def __init__(self, failures):
+        failures = sorted(failures, key=lambda failure: failure[0])
+        # the regular candidate's code is used as the previous code for the retry prompt
+        self.code = next((code for _, code, _ in failures if code), None)
+        super().__init__("\n".join(f"Candidate {index + 1}: {error}" for index, _, error in failures))
+
+# Generates and executes candidates concurrently, returns the first successful one and cancels the rest
+async def run_speculative_adhoc(user_input, relevant_examples, candidate_count, faqtivGlobals=None):
+    async def run_candidate(index):
+        function_code = None
+        try:
+            messages, llm_kwargs = get_speculative_candidate_inputs(user_input, relevant_examples, index)
+            # the extra candidates are optional work, they wait behind the regular ones
+            priority = PRIORITY_DEFAULT if index == 0 else PRIORITY_BACKGROUND
+            function_code = await generate_adhoc_code(messages, priority, **llm_kwargs)
+            result = await capture_and_process_output(execute_generated_function, function_code, faqtivGlobals=faqtivGlobals)
+            return index, function_code, result, None
+        except Exception as e:
+            return index, getattr(e, 'code', function_code), None, str(e)
+
+    start = time.perf_counter()
+    increment('adhoc.speculation.rounds')
+    increment('adhoc.speculation.candidates', candidate_count)
+    emit_progress(faqtivGlobals, "codegen", {"attempt": 1, "candidates": candidate_count})
+
+    pending = [asyncio.create_task(run_candidate(index)) for index in range(candidate_count)]
+    failures = []
+
+    try:
+        for completed in asyncio.as_completed(pending):
+            index, function_code, result, error = await completed
+
+            if error is None:
+                # the regular attempt failed but another candidate succeeded, that's a retry we didn't have to wait for
+                saved_retry = any(failed_index == 0 for failed_index, _, _ in failures)
+                increment('adhoc.speculation.wins')
+                if index != 0:
+                    increment('adhoc.speculation.alternate_wins')
+                if saved_retry:
+                    increment('adhoc.speculation.saved_retries')
+                observe('adhoc.speculation.duration_ms', (time.perf_counter() - start) * 1000)
+
+                print(f"Speculative candidate {index} succeeded", flush=True)
+                return function_code, result
+
+            print(f"Speculative candidate {index} failed: {error}", flush=True)
+            failures.append((index, function_code, error))
+    finally:
+        # worker threads of cancelled candidates can't be interrupted, their output is discarded
+        for task in pending:
+            if not task.done():
+                task.cancel()
+
+    increment('adhoc.speculation.failures')
+    observe('adhoc.speculation.duration_ms', (time.perf_counter() - start) * 1000)
+    raise SpeculationFailedError(failures)
+
+# Progress is only reported to writers that support it, e.g. the run_adhoc event stream
+def emit_progress(faqtivGlobals, event, data):
+    stream_writer = faqtivGlobals.get("streamWriter") if faqtivGlobals else None
+    write_progress = getattr(stream_writer, "writeProgress", None) if stream_writer else None
+    if write_progress:
+        write_progress(event, data)
+
+adhoc_flights = SingleFlight('adhoc')
+
+# Adhoc task execution, identical descriptions running at the same time share one generation when coalescing is enabled
 async def generate_and_execute_adhoc(user_input: str, faqtivGlobals=None, max_retries: int = 5):
+    return await adhoc_flights.call(
+        [user_input, max_retries],
+        lambda flight_globals: run_adhoc(user_input, flight_globals, max_retries),
+        faqtivGlobals
+    )
+
+async def run_adhoc(user_input: str, faqtivGlobals=None, max_retries: int = 5):
     retry_count = 0
     errors = []
     previous_code = None
 
     # Get relevant examples
-    relevant_examples = get_relevant_examples(user_input)
+    relevant_examples = await get_relevant_examples_async(user_input)
+
+    last_failure = None
 
     while retry_count < max_retries:
+        function_code = None
+        retry_mode = 'repair' if last_failure else 'full'
         try:
-            # Prepare the prompt with error information if available
-            error_context = ""
-            if errors:
-                error_context = f"This is retry attempt ${retry_count}.\nPrevious errors:\n"
-                for index, error in enumerate(errors, 1):
-                    # faking a syntax error seems to improve the retry success rate
-                    modified_error = "Syntax error" if "The request cannot be fulfilled using the available functions" in error else error
-                    error_context += f"{index}. {'-' * 40}\n{modified_error}\n\n"
-                
-                if previous_code:
-                    error_context += f"Previous code:\n```python\n{previous_code}\n```\n\n"
+            if retry_mode == 'repair':
+                # bounded retry prompt, only the failing code and its error
+                messages = build_repair_messages(user_input, *last_failure)
+            else:
+                # Prepare the prompt with error information if available
+                error_context = ""
+                if errors:
+                    error_context = f"This is retry attempt ${retry_count}.\nPrevious errors:\n"
+                    for index, error in enumerate(errors, 1):
+                        # faking a syntax error seems to improve the retry success rate
+                        modified_error = "Syntax error" if REFUSAL_MESSAGE in error else error
+                        error_context += f"{index}. {'-' * 40}\n{modified_error}\n\n"
+                    
+                    if previous_code:
+                        error_context += f"Previous code:\n```python\n{previous_code}\n```\n\n"
+                    
+                    error_context += "The previously generated code failed because of these issues, please re-write the code to address them.\nIf the errors are not clear or useful please write the code again based on the instructions and available functions.\nAssume you are more capable than the agent that generated the previous attempt and you can make better decisions."
                 
-                error_context += "The previously generated code failed because of these issues, please re-write the code to address them.\nIf the errors are not clear or useful please write the code again based on the instructions and available functions.\nAssume you are more capable than the agent that generated the previous attempt and you can make better decisions."
-            
-            example_messages = [
-                {"role": "human" if i % 2 == 0 else "assistant", "content": content}
-                for example in relevant_examples
-                for i, content in enumerate([example["task"], example["code"]])
-            ]
-            
-            # Use the generic language model for the completion
-            messages = [
-                SystemMessage("You are a useful technical assistant."),
-                SystemMessage(ADHOC_PROMPT_TEXT),
-                *[HumanMessage(content=msg["content"]) if msg["role"] == "human" else AIMessage(content=msg["content"]) for msg in example_messages],
-                HumanMessage(content=f"{user_input}\n\n{error_context}")
-            ]
-            response = await adhoc_llm.agenerate([messages])
-
-            if 'The request cannot be fulfilled using the available functions' in response.generations[0][0].text:
-                raise ValueError(response.generations[0][0].text)
-            
-            function_code = extract_function_code(response.generations[0][0].text)
+                messages = build_adhoc_messages(user_input, relevant_examples, error_context)
 
-            if not function_code:
-                raise ValueError(f"Failed to parse function code: {response.generations[0][0].text}")
+            if retry_count > 0:
+                observe(f'adhoc.retry.{retry_mode}.prompt_tokens', sum(get_tokens(model, message.content) for message in messages))
+
+            candidate_count = get_speculative_candidate_count(messages) if retry_count == 0 else 1
+            if candidate_count > 1:
+                function_code, result = await run_speculative_adhoc(user_input, relevant_examples, candidate_count, faqtivGlobals)
+                create_adhoc_log_file(user_input, function_code, result)
+                queue_example(user_input, function_code)
+                return result
+
+            emit_progress(faqtivGlobals, "codegen", {"attempt": retry_count + 1})
+            codegen_start = time.perf_counter()
+            # retries wait behind first attempts and interactive completions
+            function_code = await generate_adhoc_code(messages, PRIORITY_DEFAULT if retry_count == 0 else PRIORITY_BACKGROUND, failures=retry_count)
+            if retry_count > 0:
+                observe(f'adhoc.retry.{retry_mode}.codegen_ms', (time.perf_counter() - codegen_start) * 1000)
             
             previous_code = function_code
 
             print("Generated code:", function_code, flush=True)
+            emit_progress(faqtivGlobals, "execute", {"attempt": retry_count + 1, "code": function_code})
 
             result = await capture_and_process_output(execute_generated_function, function_code, faqtivGlobals=faqtivGlobals)
             
             create_adhoc_log_file(user_input, function_code, result)
+            # working code is a good example for similar tasks
+            queue_example(user_input, function_code)
             
             return result
         except Exception as e:
             error_message = str(e)
+            # errors raised after code generation carry the failing code for the retry prompt
+            failing_code = getattr(e, 'code', None) or function_code
+            previous_code = failing_code or previous_code
+            # only code that was generated can be repaired, otherwise the next attempt uses the full prompt
+            last_failure = format_repair_failure(e, failing_code) if failing_code and ADHOC_RETRY_MODE == 'repair' else None
             print(f"Error during execution (attempt {retry_count + 1}): {error_message}", flush=True)
             errors.append(error_message)
             retry_count += 1
@@ -183,13 +506,7 @@ async def generate_and_execute_adhoc(user_input: str, faqtivGlobals=None, max_re
                 raise ValueError(f"Max retries reached. Last error: {error_message}")
 
             print(f"Retrying... (attempt {retry_count} of {max_retries})", flush=True)
+            emit_progress(faqtivGlobals, "retry", {"attempt": retry_count + 1, "max_retries": max_retries, "error": error_message})
 
     # This line should never be reached, but just in case
     raise ValueError("Unexpected error occurred")
-
-def get_tool_call_description(tool_name, args):
-    tool_call_description_template = TASK_TOOL_CALL_DESCRIPTION_TEMPLATES[tool_name]
-    if not tool_call_description_template:
-        return None
-
-    return re.sub(r'#(\w+)#', lambda match: args[match.group(1)], tool_call_description_template)
\ No newline at end of file
@@ -16,10 +16,15 @@ class CompletionRequest(BaseModel):
     temperature: Optional[float] = Field(default=0.7, ge=0, le=2)
     stream: Optional[bool] = False
     include_tool_messages: Optional[bool] = False
+    delegation_token: Optional[str] = None
+    # with a session id the server keeps the conversation and messages only has the new messages
+    session_id: Optional[str] = Field(default=None, min_length=1, max_length=200)
 
 class CompletionResponse(BaseModel):
     id: str
     object: str
     created: int
     model: str
-    choices: List[dict]
\ No newline at end of file
+    choices: List[dict]
+    tool_messages: Optional[List[dict]] = None
+    session_id: Optional[str] = None
\ No newline at end of file
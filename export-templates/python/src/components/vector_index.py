@@ -0,0 +1,188 @@
+import math
+import numpy as np
+import faiss
+
+INDEX_TYPES = ['flat', 'ivf', 'hnsw']
+QUANTIZATIONS = ['none', 'sq8', 'pq']
+
+# Neighbors per node of the HNSW graph
+HNSW_NEIGHBORS = 32
+# Bytes per vector with product quantization, 1536 dimensions are split in 64 sub-vectors of 8 bit codes
+PQ_SUBQUANTIZERS = 64
+# IVF and quantization need enough vectors to be trained, smaller indexes are exact flat ones
+MIN_TRAINING_VECTORS = 1000
+MAX_TRAINING_VECTORS = 50000
+# Removed vectors of an HNSW index are only skipped, the index is rebuilt when there are this many
+MAX_DELETED = 256
+
+def get_factory_string(index_type, quantization, count):
+    encoding = {'none': 'Flat', 'sq8': 'SQ8', 'pq': f'PQ{PQ_SUBQUANTIZERS}'}[quantization]
+    if index_type == 'ivf':
+        # about 4 * sqrt(n) lists, with at least 39 training vectors each
+        lists = max(1, min(int(4 * math.sqrt(count)), count // 39))
+        return f'IVF{lists},{encoding}'
+    if index_type == 'hnsw':
+        return f'HNSW{HNSW_NEIGHBORS},{encoding}'
+    return encoding
+
+def normalize(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+class VectorIndex:
+    """FAISS index of normalized vectors by string id, flat, IVF or HNSW with optional quantization, vectors can be added and removed at any time."""
+    def __init__(self, dimension, index_type='flat', quantization='none', probes=16, ef_search=64):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type}, use one of {', '.join(INDEX_TYPES)}")
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization}, use one of {', '.join(QUANTIZATIONS)}")
+        self.dimension = dimension
+        self.index_type = index_type
+        self.quantization = quantization
+        self.probes = probes
+        self.ef_search = ef_search
+        self.factory_string = None
+        self.index = None
+        self.labels = {}
+        self.ids = {}
+        # labels of the removed vectors that are still in an HNSW graph
+        self.deleted = set()
+        self.next_label = 0
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, vector_id):
+        return vector_id in self.labels
+
+    def build(self, ids, vectors):
+        # trains the index with the vectors when its type needs it and adds them
+        vectors = normalize(vectors) if len(ids) else np.zeros((0, self.dimension), dtype=np.float32)
+        index_type, quantization = self.index_type, self.quantization
+        if len(ids) < MIN_TRAINING_VECTORS and (index_type == 'ivf' or quantization != 'none'):
+            index_type, quantization = 'flat', 'none'
+
+        self.factory_string = get_factory_string(index_type, quantization, len(ids))
+        self.index = self.create_index(self.factory_string)
+        if not self.index.is_trained:
+            sample = vectors
+            if len(vectors) > MAX_TRAINING_VECTORS:
+                sample = vectors[np.random.default_rng(0).choice(len(vectors), MAX_TRAINING_VECTORS, replace=False)]
+            self.index.train(sample)
+
+        self.labels = {}
+        self.ids = {}
+        self.deleted = set()
+        self.next_label = 0
+        self.add_normalized(list(ids), vectors)
+
+    def create_index(self, factory_string):
+        # the vectors are normalized, the L2 distance gives the cosine similarity
+        index = faiss.index_factory(self.dimension, factory_string, faiss.METRIC_L2)
+        codes = faiss.downcast_index(index.storage) if factory_string.startswith('HNSW') else index
+        if hasattr(codes, 'do_polysemous_training'):
+            # the polysemous codes are only used to filter by Hamming distance, training them takes minutes
+            codes.do_polysemous_training = False
+        if factory_string.startswith('IVF'):
+            # IVF indexes keep the ids themselves, the direct map finds the vectors to remove and reconstruct
+            index.set_direct_map_type(faiss.DirectMap.Hashtable)
+            index.nprobe = self.probes
+            return index
+        if factory_string.startswith('HNSW'):
+            index.hnsw.efSearch = self.ef_search
+        return faiss.IndexIDMap2(index)
+
+    def is_graph(self):
+        return self.factory_string.startswith('HNSW')
+
+    def add(self, vector_id, vector):
+        if vector_id in self.labels:
+            self.remove(vector_id)
+        self.add_normalized([vector_id], normalize([vector]))
+
+    def add_normalized(self, ids, vectors):
+        if not ids:
+            return
+        labels = np.arange(self.next_label, self.next_label + len(ids), dtype=np.int64)
+        self.index.add_with_ids(vectors, labels)
+        for vector_id, label in zip(ids, labels.tolist()):
+            self.labels[vector_id] = label
+            self.ids[label] = vector_id
+        self.next_label += len(ids)
+
+    def remove(self, vector_id):
+        label = self.labels.pop(vector_id, None)
+        if label is None:
+            return False
+        del self.ids[label]
+        if not self.is_graph():
+            self.index.remove_ids(np.array([label], dtype=np.int64))
+        else:
+            # HNSW graphs can't remove nodes
+            self.deleted.add(label)
+            if len(self.deleted) >= MAX_DELETED:
+                self.compact()
+        return True
+
+    def compact(self):
+        # rebuilds the graph without the removed vectors, quantized vectors are added back as they were decoded
+        ids = list(self.labels)
+        if not ids:
+            self.build([], [])
+            return
+        vectors = self.get_vectors(ids)
+        index = self.create_index(self.factory_string)
+        if not index.is_trained:
+            index.train(vectors)
+        self.index = index
+        self.labels = {}
+        self.ids = {}
+        self.deleted = set()
+        self.add_normalized(ids, vectors)
+
+    def search(self, vector, k):
+        # the k most similar (id, cosine similarity) pairs
+        if not self.labels or k <= 0:
+            return []
+        query = normalize([vector])
+        distances, labels = self.index.search(query, min(k + len(self.deleted), self.index.ntotal))
+        results = []
+        for distance, label in zip(distances[0].tolist(), labels[0].tolist()):
+            vector_id = self.ids.get(label)
+            if vector_id is None:
+                continue
+            results.append((vector_id, 1 - distance / 2))
+            if len(results) == k:
+                break
+        return results
+
+    def get_vectors(self, ids):
+        # quantized indexes give back an approximation of the vectors
+        if not ids:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        return normalize([self.index.reconstruct(self.labels[vector_id]) for vector_id in ids])
+
+    def get_memory_size(self):
+        return len(faiss.serialize_index(self.index))
+
+    def save(self, path):
+        faiss.write_index(self.index, path)
+        return {
+            'factory_string': self.factory_string,
+            'labels': self.labels,
+            'next_label': self.next_label,
+            'deleted': sorted(self.deleted)
+        }
+
+    def load(self, path, state):
+        self.index = faiss.read_index(path)
+        self.factory_string = state['factory_string']
+        self.labels = state['labels']
+        self.ids = {label: vector_id for vector_id, label in self.labels.items()}
+        self.next_label = state['next_label']
+        self.deleted = set(state['deleted'])
+        if self.factory_string.startswith('IVF'):
+            self.index.set_direct_map_type(faiss.DirectMap.Hashtable)
+            self.index.nprobe = self.probes
+        elif self.is_graph():
+            faiss.downcast_index(self.index.index).hnsw.efSearch = self.ef_search
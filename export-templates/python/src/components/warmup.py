@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import asyncio
+import importlib
+from components.logger import log, log_err
+
+WARMUP_STEP_NAMES = ['encoders', 'examples', 'tools', 'models', 'dispatch', 'connections']
+
+# Steps run on start before the server reports ready on /readyz, comma separated, "none" to be ready right away.
+# They do the work of the first requests ahead of time, a step that fails is done again by the first request that needs it
+WARMUP_STEPS = [
+    step.strip() for step in os.getenv('WARMUP_STEPS', ','.join(WARMUP_STEP_NAMES)).lower().split(',')
+    if step.strip() and step.strip() != 'none'
+]
+# Seconds after which the server reports ready even if the warm-up didn't finish
+WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', 60))
+
+ready = False
+# duration of every step that finished, in ms
+warmup_durations = {}
+
+def warm_encoders():
+    # tiktoken loads the BPE ranks of every encoding the first time it's used
+    from components.context_manager import get_tokens
+    from components.model_router import STAGE_MODELS, ADHOC_ESCALATION_MODEL
+    for model_name in {*STAGE_MODELS.values(), ADHOC_ESCALATION_MODEL} - {None}:
+        get_tokens(model_name, 'warm-up')
+
+def warm_examples():
+    from components import examples
+    index = examples.get_example_index()
+    index.search([1.0] * examples.EMBEDDING_DIMENSION, 1)
+    examples.lexical_index.search('warm-up', 1)
+
+def warm_tools():
+    from components.completions import get_tool_registry
+    get_tool_registry()
+
+async def warm_models():
+    # the models are bound to the connection pool of the event loop, only the import runs in a worker thread
+    from components.completions import create_chat_model
+    from components.tools import get_adhoc_llm
+    from components.model_router import get_adhoc_model, ADHOC_ESCALATE_AFTER
+    await asyncio.to_thread(importlib.import_module, 'langchain_openai')
+    create_chat_model()
+    for failures in range(ADHOC_ESCALATE_AFTER + 1):
+        get_adhoc_llm(get_adhoc_model(failures))
+
+def warmup_task(value: str):
+    print(json.dumps({'value': value}))
+
+async def warm_dispatch():
+    # a no-op task goes through the same argument validation, output capture and worker thread as the agent tasks
+    from pydantic import create_model
+    from components.tool_registry import RegisteredTool
+    tool = RegisteredTool('warmup_task', {
+        'description': 'Warm-up',
+        'args_schema': create_model('warmup_task', value=(str, ...)),
+        'output': dict,
+        'function': warmup_task
+    })
+    await tool.invoke(tool.get_call_arguments({'value': 'warm-up'}))
+
+async def warm_connections():
+    # opens the TLS connections of the shared pools, listing the models costs no tokens and the embedding a couple
+    from components.completions import create_chat_model
+    from components.examples import get_embeddings, EMBEDDING_MODEL
+    from components.llm_scheduler import llm_scheduler, PRIORITY_BACKGROUND
+    await create_chat_model().root_async_client.models.list()
+    await llm_scheduler.run(
+        lambda: get_embeddings().aembed_query('warm-up'), PRIORITY_BACKGROUND, 2, usage_name=f'embedding.{EMBEDDING_MODEL}'
+    )
+
+WARMUP_STEP_FUNCTIONS = {
+    'encoders': warm_encoders,
+    'examples': warm_examples,
+    'tools': warm_tools,
+    'models': warm_models,
+    'dispatch': warm_dispatch,
+    'connections': warm_connections
+}
+
+async def run_warmup_steps(steps):
+    for name in steps:
+        step = WARMUP_STEP_FUNCTIONS.get(name)
+        if step is None:
+            print(f"Unknown warm-up step {name}, use {', '.join(WARMUP_STEP_NAMES)}", flush=True)
+            continue
+        start = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(step):
+                await step()
+            else:
+                # the server keeps answering /healthz while the slow steps run
+                await asyncio.to_thread(step)
+        except Exception as e:
+            log_err('warmup', 'step', {'step': name}, e)
+        warmup_durations[name] = round((time.perf_counter() - start) * 1000, 2)
+
+async def warm_up(steps=None):
+    global ready
+    steps = WARMUP_STEPS if steps is None else steps
+    try:
+        await asyncio.wait_for(run_warmup_steps(steps), WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        log_err('warmup', 'timeout', {'completed': warmup_durations}, f"Warm-up took longer than {WARMUP_TIMEOUT} seconds")
+    ready = True
+    log('warmup', 'ready', warmup_durations)
+    return warmup_durations
+
+def is_ready():
+    return ready
@@ -24,7 +24,14 @@ TASK_NAME_TO_FUNCTION_NAME_MAP = {{ taskNameToFunctionNameMap }}
 
 TASK_TOOL_CALL_DESCRIPTION_TEMPLATES = {{ taskToolCallDescriptionTemplates }}
 
-ADHOC_PROMPT_TEXT = """{{ generateAnsweringFunctionPrompt }}"""
+ADHOC_PROMPT_TEXT = """{{ generateAnsweringFunctionPrompt }}
+
+# RUNTIME HELPERS:
+Besides the public functions, doTask can use these helpers without importing them:
+- parallel_map(fn, items, max_workers=8): calls fn(item) for every item concurrently in a thread pool and returns the list of results in the same order as items, errors are raised as usual. Use it instead of a loop when calling a public function for many items, e.g. results = parallel_map(lambda item_id: some_public_function(item_id), item_ids).
+- async_parallel_map(fn, items, max_workers=8): same as parallel_map for an async doTask, it must be awaited.
+- emitResult(value): returns a JSON compatible value as the result of doTask without converting it to text, it can be used instead of print(json.dumps(value)) and other prints are then ignored.
+- emitRow(row) and emitRows(rows): add rows to the result of doTask as they are produced instead of building the whole list first, the result is the list of every emitted row. They can't be combined with emitResult."""
 
 LIBS = { {{ libsNames }} }
 
@@ -0,0 +1,199 @@
+# AWS Lambda entrypoint, it runs the FastAPI app in-process for API Gateway and function URL events.
+#
+# handler(event, context) works with the managed python runtime and returns buffered responses.
+# Running this file starts a runtime loop that streams responses through the Lambda runtime API, use it as the
+# bootstrap of a custom runtime or through AWS_LAMBDA_EXEC_WRAPPER with the bootstrap script, and set the function
+# URL invoke mode to RESPONSE_STREAM.
+#
+# Everything that can be reused across invocations is created at module scope, during the init phase.
+import os
+import json
+import base64
+import asyncio
+from urllib.parse import urlencode
+import httpx
+from constants import ENV_VARS
+
+for key, value in ENV_VARS.items():
+    if key not in os.environ:
+        os.environ[key] = value
+
+from components.http_server import app
+from components.logger import log, log_err
+
+# Set to false to build the example index and the clients with the first invocation instead of during init
+LAMBDA_EAGER_INIT = os.getenv('LAMBDA_EAGER_INIT', 'true').lower() == 'true'
+
+RUNTIME_API_VERSION = '2018-06-01'
+STREAMING_CONTENT_TYPE = 'application/vnd.awslambda.http-integration-response'
+# Separates the JSON prelude with the status and headers from the body of a streamed response
+PRELUDE_DELIMITER = b'\x00' * 8
+
+# One event loop for the whole execution environment, so connection pools bound to it are reused
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+
+def initialize():
+    # the warm-up steps of WARMUP_STEPS, in the loop the invocations run in so the connections they open are reused
+    from components.warmup import warm_up
+    durations = loop.run_until_complete(warm_up())
+    log('lambda', 'init', durations)
+
+if LAMBDA_EAGER_INIT:
+    initialize()
+
+def get_request(event):
+    request_context = event.get('requestContext') or {}
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+
+    if 'http' in request_context:
+        # function URL and API Gateway HTTP API (payload format 2.0)
+        method = request_context['http']['method']
+        path = event.get('rawPath') or '/'
+        query_string = event.get('rawQueryString') or ''
+        client_ip = request_context['http'].get('sourceIp')
+        if event.get('cookies'):
+            headers['cookie'] = '; '.join(event['cookies'])
+    else:
+        # API Gateway REST API (payload format 1.0)
+        method = event.get('httpMethod', 'GET')
+        path = event.get('path') or '/'
+        query_parameters = event.get('multiValueQueryStringParameters') or event.get('queryStringParameters') or {}
+        query_string = urlencode(query_parameters, doseq=True)
+        client_ip = (request_context.get('identity') or {}).get('sourceIp')
+
+    body = event.get('body') or ''
+    body = base64.b64decode(body) if event.get('isBase64Encoded') else body.encode()
+
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'https',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query_string.encode(),
+        'root_path': '',
+        'headers': [(key.encode(), str(value).encode()) for key, value in headers.items()],
+        'client': (client_ip or '127.0.0.1', 0),
+        'server': ('lambda', 443)
+    }
+    return scope, body
+
+def get_response_headers(raw_headers):
+    headers = {}
+    cookies = []
+    for key, value in raw_headers:
+        key, value = key.decode().lower(), value.decode()
+        if key == 'set-cookie':
+            cookies.append(value)
+        else:
+            headers[key] = f"{headers[key]}, {value}" if key in headers else value
+    return headers, cookies
+
+async def run_app(event, on_response_start, on_body):
+    scope, body = get_request(event)
+    request_sent = False
+    disconnected = asyncio.Event()
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        # streaming responses listen for a client disconnect until they are done
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            await on_response_start(message['status'], message.get('headers', []))
+        elif message['type'] == 'http.response.body':
+            await on_body(message.get('body', b''))
+
+    await app(scope, receive, send)
+
+async def handle_buffered(event):
+    response = {'statusCode': 500, 'headers': {}, 'cookies': []}
+    chunks = []
+
+    async def on_response_start(status, raw_headers):
+        response['statusCode'] = status
+        response['headers'], response['cookies'] = get_response_headers(raw_headers)
+
+    async def on_body(chunk):
+        chunks.append(chunk)
+
+    await run_app(event, on_response_start, on_body)
+
+    body = b''.join(chunks)
+    try:
+        response['body'] = body.decode()
+        response['isBase64Encoded'] = False
+    except UnicodeDecodeError:
+        response['body'] = base64.b64encode(body).decode()
+        response['isBase64Encoded'] = True
+    return response
+
+def handler(event, context):
+    return loop.run_until_complete(handle_buffered(event))
+
+async def stream_response(event):
+    # the app runs in its own task and its output is forwarded as it's produced
+    queue = asyncio.Queue()
+
+    async def on_response_start(status, raw_headers):
+        headers, cookies = get_response_headers(raw_headers)
+        prelude = json.dumps({'statusCode': status, 'headers': headers, 'cookies': cookies}).encode()
+        await queue.put(prelude + PRELUDE_DELIMITER)
+
+    async def on_body(chunk):
+        if chunk:
+            await queue.put(chunk)
+
+    async def run():
+        try:
+            await run_app(event, on_response_start, on_body)
+        finally:
+            await queue.put(None)
+
+    app_task = asyncio.create_task(run())
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        if not app_task.done():
+            app_task.cancel()
+        else:
+            # surfaces app errors to the runtime loop
+            app_task.result()
+
+async def run_streaming_runtime():
+    runtime_url = f"http://{os.environ['AWS_LAMBDA_RUNTIME_API']}/{RUNTIME_API_VERSION}/runtime"
+
+    async with httpx.AsyncClient(timeout=None) as client:
+        while True:
+            invocation = await client.get(f"{runtime_url}/invocation/next")
+            request_id = invocation.headers['lambda-runtime-aws-request-id']
+            try:
+                await client.post(
+                    f"{runtime_url}/invocation/{request_id}/response",
+                    content=stream_response(invocation.json()),
+                    headers={
+                        'Lambda-Runtime-Function-Response-Mode': 'streaming',
+                        'Content-Type': STREAMING_CONTENT_TYPE
+                    }
+                )
+            except Exception as e:
+                log_err('lambda', 'invocation', {'id': request_id}, e)
+                await client.post(
+                    f"{runtime_url}/invocation/{request_id}/error",
+                    json={'errorMessage': str(e), 'errorType': type(e).__name__}
+                )
+
+if __name__ == "__main__":
+    loop.run_until_complete(run_streaming_runtime())
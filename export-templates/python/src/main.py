@@ -1,23 +1,55 @@
 import os
-from components.http_server import start_http_server
-from components.cli_chat import start_cli_chat
-from constants import ENV_VARS
+import time
+import argparse
 
-for key, value in ENV_VARS.items():
-    if key not in os.environ:
-        os.environ[key] = value
+def set_default_env():
+    from constants import ENV_VARS
 
-if __name__ == "__main__":
-    import pyfiglet
-    import argparse
+    for key, value in ENV_VARS.items():
+        if key not in os.environ:
+            os.environ[key] = value
 
-    print(pyfiglet.figlet_format("FAQtiv"), flush=True)
+if __name__ == "__main__":
+    startup_start = time.perf_counter()
 
     parser = argparse.ArgumentParser(description="FAQtiv Agent CLI/HTTP Server")
     parser.add_argument("--http", action="store_true", help="Run as HTTP server")
+    parser.add_argument("--no-banner", action="store_true", help="Don't print the banner, same as SKIP_BANNER=true")
+    parser.add_argument("--startup-report", action="store_true", help="Print the import time of every module before starting")
+    parser.add_argument("--build-examples-index", action="store_true", help="Build the example index and write it to the examples directory, then exit")
     args = parser.parse_args()
 
+    if args.build_examples_index:
+        set_default_env()
+        from components.examples import save_example_index, EXAMPLES_INDEX_DIRECTORY
+        index = save_example_index()
+        print(f"Indexed {len(index)} examples as {index.factory_string} in {time.perf_counter() - startup_start:.1f}s, "
+              f"{index.get_memory_size() / 1e6:.1f} MB, written to {EXAMPLES_INDEX_DIRECTORY}", flush=True)
+        raise SystemExit(0)
+
+    import_timer = None
+    if args.startup_report:
+        from components.startup import ImportTimer
+        import_timer = ImportTimer().install()
+
+    # the env defaults are set before importing the components, some of them read their settings on import
+    set_default_env()
+
+    if not args.no_banner and os.getenv('SKIP_BANNER', 'false').lower() != 'true':
+        import pyfiglet
+        print(pyfiglet.figlet_format("FAQtiv"), flush=True)
+
+    # only the components of the selected mode are imported
     if args.http:
-        start_http_server()
+        from components.http_server import start_http_server
+        start = start_http_server
     else:
-        start_cli_chat() 
\ No newline at end of file
+        from components.cli_chat import start_cli_chat
+        start = start_cli_chat
+
+    if import_timer:
+        import_timer.uninstall()
+        from components.startup import print_startup_report
+        print_startup_report(import_timer, time.perf_counter() - startup_start)
+
+    start()